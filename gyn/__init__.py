@@ -106,12 +106,24 @@ def Load(build_files, default_variables={},
         getattr(generator, 'generator_wants_sorted_dependencies', False),
     'generator_filelist_paths':
         getattr(generator, 'generator_filelist_paths', None),
+    'build_file_cache_dir': None,
+    'command_cache_path': None,
   }
 
+  # Parsed build files and command results are cached on disk only when asked
+  # to, and only if the generator tells us where its output lives.
+  cache_dir = getattr(generator, 'generator_build_file_cache_dir', None)
+  if cache_dir and params.get('build_file_cache'):
+    generator_input_info['build_file_cache_dir'] = cache_dir
+  if cache_dir and params.get('cache_commands'):
+    generator_input_info['command_cache_path'] = os.path.join(cache_dir,
+                                                              'commands')
+
   # Process the input specific to this generator.
   result = gyn.input.Load(build_files, default_variables, includes[:],
                           depth, generator_input_info, check, circular_check,
-                          params['parallel'], params['root_targets'])
+                          params['parallel'], params['root_targets'],
+                          params.get('jobs'))
   return [generator] + result
 
 def NameValueListToDict(name_value_list):
@@ -268,8 +280,21 @@ def gyp_main(args):
   parser.set_usage(usage.replace('%s', '%prog'))
   parser.add_option('--build', dest='configs', action='append',
                     help='configuration for build after project generation')
+  parser.add_option('--build-file-cache', dest='build_file_cache',
+                    action='store_true', default=False, regenerate=False,
+                    help='cache parsed build files in the output directory; '
+                         'an entry is reused while the size and mtime, or '
+                         'else the contents, of its file are unchanged')
   parser.add_option('--check', dest='check', action='store_true',
                     help='check format of gyp files')
+  parser.add_option('--cache-commands', dest='cache_commands',
+                    action='store_true', default=False, regenerate=False,
+                    help='reuse the output of <!() commands from previous '
+                         'runs while their inputs, the files named by their '
+                         'arguments or listed in the command_cache_inputs '
+                         'variable, are unchanged; commands without inputs '
+                         'are reused until they change, so use <!nocache() '
+                         'for commands that must always run')
   parser.add_option('--config-dir', dest='config_dir', action='store',
                     env_name='GYP_CONFIG_DIR', default=None,
                     help='The location for configuration files like '
@@ -296,6 +321,10 @@ def gyp_main(args):
   parser.add_option('-I', '--include', dest='includes', action='append',
                     metavar='INCLUDE', type='path',
                     help='files to include in all loaded .gyp files')
+  parser.add_option('-j', '--jobs', dest='jobs', action='store', type='int',
+                    default=None, regenerate=False,
+                    help='number of worker processes to use, defaults to '
+                         'GYP_JOBS if set, else the number of CPUs')
   # --no-circular-check disables the check for circular relationships between
   # .gyp files.  These relationships should not exist, but they've only been
   # observed to be harmful with the Xcode generator.  Chromium's .gyp files
@@ -454,6 +483,9 @@ def gyp_main(args):
             'gyp_binary': sys.argv[0],
             'home_dot_gyp': home_dot_gyp,
             'parallel': options.parallel,
+            'jobs': options.jobs,
+            'build_file_cache': options.build_file_cache,
+            'cache_commands': options.cache_commands,
             'root_targets': options.root_targets}
 
   # Start with the default variables from the command line.
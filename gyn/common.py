@@ -7,6 +7,7 @@
 import collections
 import errno
 import filecmp
+import io
 import os.path
 import re
 import tempfile
@@ -373,11 +374,9 @@ def WriteOnDiff(filename):
           # There's no reason to not respect the umask here, which means that
           # an extra hoop is required to fetch it and reset the new file's mode.
           #
-          # No way to get the umask without setting a new one?  Set a safe one
-          # and then set it back to the old value.
-          umask = os.umask(0o77)
-          os.umask(umask)
-          os.chmod(self.tmp_path, 0o666 & ~umask)
+          # The umask was read into process_umask when this module was
+          # imported.
+          os.chmod(self.tmp_path, 0o666 & ~process_umask)
           if sys.platform == 'win32' and os.path.exists(filename):
             # NOTE: on windows (but not cygwin) rename will not replace an
             # existing file, so it must be preceded with a remove. Sadly there
@@ -400,6 +399,133 @@ def EnsureDirExists(path):
     pass
 
 
+# The process's umask.  It can only be read by setting it, which would race
+# with other threads creating files, so that is done once here.
+process_umask = os.umask(0o77)
+os.umask(process_umask)
+
+
+class _FileIfChangedWriter(object):
+  """The file-like object WriteFileIfChanged returns to stream contents to.
+
+  The text is compared with the existing file as it is written, so neither
+  the old nor the new contents are held in memory.  Once they differ, the new
+  contents go to a temporary file that replaces |path| on close().  Text is
+  encoded and newlines translated just as open(path, 'w') would.
+  """
+
+  # Bytes to copy at a time from the existing file.
+  COPY_CHUNK_SIZE = 1 << 16
+
+  def __init__(self, path):
+    self.path = path
+    self.size = 0
+    self.tmp_path = None
+    self.tmp_file = None
+    # The existing file, and how much of it was found to match.
+    self.matched = 0
+    try:
+      self.existing_file = open(path, 'rb')
+    except (IOError, OSError):
+      self.existing_file = None
+    # The encoding open(path, 'w') would use.
+    self.encoding = io.TextIOWrapper(io.BytesIO()).encoding
+
+  def write(self, text):
+    if not isinstance(text, bytes):
+      text = text.encode(self.encoding)
+    if os.linesep != '\n':
+      text = text.replace(b'\n', os.linesep.encode('ascii'))
+    self.size += len(text)
+    if self.tmp_file is None:
+      if (self.existing_file is not None and
+          self.existing_file.read(len(text)) == text):
+        self.matched += len(text)
+        return
+      self._StartWriting()
+    self.tmp_file.write(text)
+
+  def tell(self):
+    """Returns the number of bytes written so far."""
+    return self.size
+
+  def _StartWriting(self):
+    # Pick temporary file, and give it the part of the existing file that
+    # matched what was written so far.
+    EnsureDirExists(self.path)
+    tmp_fd, self.tmp_path = tempfile.mkstemp(
+        suffix='.tmp',
+        prefix=os.path.split(self.path)[1] + '.gyp.',
+        dir=os.path.split(self.path)[0])
+    self.tmp_file = os.fdopen(tmp_fd, 'wb')
+    if self.existing_file is not None:
+      self.existing_file.seek(0)
+      remaining = self.matched
+      while remaining:
+        chunk = self.existing_file.read(min(remaining, self.COPY_CHUNK_SIZE))
+        self.tmp_file.write(chunk)
+        remaining -= len(chunk)
+      self.existing_file.close()
+      self.existing_file = None
+
+  def close(self):
+    """Finishes the file.
+
+    Returns:
+      True if |path| was written, False if it was already up to date.
+    """
+    try:
+      if self.tmp_file is None:
+        if (self.existing_file is not None and
+            not self.existing_file.read(1)):
+          self.existing_file.close()
+          self.existing_file = None
+          return False
+        self._StartWriting()
+      self.tmp_file.close()
+      # tempfile.mkstemp uses an overly restrictive mode; respect the umask like
+      # WriteOnDiff does.
+      os.chmod(self.tmp_path, 0o666 & ~process_umask)
+      if sys.platform == 'win32' and os.path.exists(self.path):
+        # On windows rename will not replace an existing file.
+        os.remove(self.path)
+      os.rename(self.tmp_path, self.path)
+      self.tmp_path = None
+      return True
+    finally:
+      self.discard()
+
+  def discard(self):
+    """Leaves |path| as it was, dropping everything written."""
+    if self.existing_file is not None:
+      self.existing_file.close()
+      self.existing_file = None
+    if self.tmp_path is not None:
+      self.tmp_file.close()
+      os.unlink(self.tmp_path)
+      self.tmp_path = None
+
+
+def WriteFileIfChanged(path, contents=None):
+  """Write |contents| to the text file |path| unless it already holds them.
+
+  Leaving an unchanged file alone keeps its mtime, so tools watching it don't
+  consider it modified.  Directories are created as necessary.
+
+  If |contents| is None, a file-like object is returned instead, to write the
+  contents to piece by piece.  Its close() finishes the file and returns what
+  this function would; discard() leaves the file as it was.
+
+  Returns:
+    True if the file was written, False if it was already up to date.
+  """
+  output_file = _FileIfChangedWriter(path)
+  if contents is None:
+    return output_file
+  output_file.write(contents)
+  return output_file.close()
+
+
 def GetFlavor(params):
   """Returns |params.flavor| if it's set, the system's default flavor else."""
   flavors = {
@@ -426,7 +552,10 @@ def GetFlavor(params):
 
 def CopyTool(flavor, out_path):
   """Finds (flock|mac|win)_tool.gyp in the gyp directory and copies it
-  to |out_path|."""
+  to |out_path|.
+
+  Returns True if the tool was written, False if it was already up to date and
+  None if |flavor| doesn't need a tool."""
   # aix and solaris just need flock emulation. mac and win use more complicated
   # support scripts.
   prefix = {
@@ -446,12 +575,13 @@ def CopyTool(flavor, out_path):
 
   # Add header and write it out.
   tool_path = os.path.join(out_path, 'gyp-%s-tool' % prefix)
-  with open(tool_path, 'w') as tool_file:
-    tool_file.write(
-        ''.join([source[0], '# Generated by gyp. Do not edit.\n'] + source[1:]))
+  written = WriteFileIfChanged(
+      tool_path,
+      ''.join([source[0], '# Generated by gyp. Do not edit.\n'] + source[1:]))
 
   # Make file executable.
   os.chmod(tool_path, 0o755)
+  return written
 
 
 # From Alex Martelli,
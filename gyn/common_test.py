@@ -7,6 +7,9 @@
 """Unit tests for the common.py file."""
 
 import gyn.common
+import os
+import shutil
+import tempfile
 import unittest
 import sys
 
@@ -68,5 +71,44 @@ class TestGetFlavor(unittest.TestCase):
     self.assertFlavor('foobar', 'linux2' , {'flavor': 'foobar'})
 
 
+class TestWriteFileIfChanged(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'obj', 'a.ninja')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_writes_only_changes(self):
+    self.assertTrue(gyn.common.WriteFileIfChanged(self.path, 'a\nb\n'))
+    os.utime(self.path, (1, 1))
+    self.assertFalse(gyn.common.WriteFileIfChanged(self.path, 'a\nb\n'))
+    self.assertEqual(1, os.stat(self.path).st_mtime)
+    self.assertTrue(gyn.common.WriteFileIfChanged(self.path, 'a\n'))
+    with open(self.path) as f:
+      self.assertEqual('a\n', f.read())
+
+  def test_file_if_changed(self):
+    gyn.common.WriteFileIfChanged(self.path, 'abc\ndef\n')
+    for chunks, written in [(['abc\n', 'def\n'], False),
+                            (['abc\n', 'de'], True),
+                            (['abc\n', 'dxf\n', 'ghi\n'], True),
+                            (['abc\n', 'dxf\n', 'ghi\n'], False)]:
+      f = gyn.common.WriteFileIfChanged(self.path)
+      for chunk in chunks:
+        f.write(chunk)
+      self.assertEqual(written, f.close())
+      with open(self.path) as f:
+        self.assertEqual(''.join(chunks), f.read())
+    self.assertEqual([os.path.basename(self.path)],
+                     os.listdir(os.path.dirname(self.path)))
+
+  def test_discard(self):
+    f = gyn.common.WriteFileIfChanged(self.path)
+    f.write('abc')
+    f.discard()
+    self.assertEqual([], os.listdir(os.path.dirname(self.path)))
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -14,8 +14,11 @@ import re
 import signal
 import subprocess
 import sys
+import textwrap
+import traceback
 import gyn
 import gyn.common
+import gyn.input
 import gyn.msvs_emulation
 import gyn.MSVSUtil as MSVSUtil
 import gyn.xcode_emulation
@@ -66,6 +69,7 @@ generator_additional_non_configuration_keys = []
 generator_additional_path_sections = []
 generator_extra_sources_for_rules = []
 generator_filelist_paths = None
+generator_build_file_cache_dir = None
 
 # TODO: figure out how to not build extra host objects in the non-cross-compile
 # case when this is enabled, and enable unconditionally.
@@ -113,6 +117,114 @@ def AddArch(output, arch):
   return '%s.%s%s' % (output, arch, extension)
 
 
+class FastNinjaWriter(ninja_syntax.Writer):
+  """A ninja_syntax.Writer that escapes all the paths of a build statement at
+  once, and doesn't wrap lines if |width| is None.  Ninja doesn't need long
+  lines to be wrapped; it only makes the files easier to read."""
+
+  def _line(self, text, indent=0):
+    if self.width is None:
+      self.output.write('  ' * indent + text + '\n')
+    else:
+      super(FastNinjaWriter, self)._line(text, indent)
+
+  def comment(self, text):
+    if self.width is None:
+      for line in textwrap.wrap(text, sys.maxsize):
+        self.output.write('# ' + line + '\n')
+    else:
+      super(FastNinjaWriter, self).comment(text)
+
+  def _escape_paths(self, paths):
+    # Paths can't contain newlines, so a newline can stand in for the spaces
+    # between them while ninja_syntax.escape_path's replacements are applied.
+    if not paths:
+      return ''
+    return ('\n'.join(paths).replace('$ ', '$$ ').replace(' ', '$ ')
+            .replace(':', '$:').replace('\n', ' '))
+
+  def build(self, outputs, rule, inputs=None, implicit=None, order_only=None,
+            variables=None):
+    outputs = self._as_list(outputs)
+    line = ['build ', self._escape_paths(outputs), ': ', rule]
+    inputs = self._as_list(inputs)
+    if inputs:
+      line += [' ', self._escape_paths(inputs)]
+    if implicit:
+      line += [' | ', self._escape_paths(self._as_list(implicit))]
+    if order_only:
+      line += [' || ', self._escape_paths(self._as_list(order_only))]
+    self._line(''.join(line))
+
+    if variables:
+      if isinstance(variables, dict):
+        variables = variables.items()
+      for key, val in variables:
+        self.variable(key, val, indent=1)
+
+    return outputs
+
+
+class SharedNinjaDefinitions(object):
+  """The variables and rules that the targets of a configuration share through
+  a file included by build.ninja, instead of each writing its own copy.
+
+  Definitions are named after a hash of their contents, so identical ones
+  collected by different targets, in any order or process, get the same name.
+  Rules have no description, which names the target; their build edges bind
+  it instead.
+  """
+
+  def __init__(self):
+    # Maps variable names to their values.
+    self.variables = {}
+    # Maps rule names to (command, depfile, pool) tuples.
+    self.rules = {}
+
+  def Variable(self, var, value):
+    """Returns what a target should bind |var| to for it to have |value|: a
+    reference to a shared variable, or |value| itself if it refers to other
+    variables (which must be evaluated in the target's scope) or is no
+    longer than the reference."""
+    if '$' in value:
+      return value
+    name = '%s_%s' % (var, self._Hash(value))
+    if len(value) <= len(name) + 1:
+      return value
+    self.variables[name] = value
+    return '$' + name
+
+  def Rule(self, command, depfile, pool):
+    """Returns the name of a shared rule with the given properties."""
+    rule = (command, depfile, pool)
+    name = 'rule_' + self._Hash(json.dumps(rule))
+    self.rules[name] = rule
+    return name
+
+  def _Hash(self, text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()[:16]
+
+  def update(self, other):
+    """Adds the definitions collected in |other|."""
+    for (definitions, other_definitions) in ((self.variables, other.variables),
+                                             (self.rules, other.rules)):
+      for (name, value) in other_definitions.items():
+        if definitions.setdefault(name, value) != value:
+          raise gyn.common.GypError(
+              'Shared ninja definitions with different contents have the '
+              'same name %s' % name)
+
+  def Write(self, ninja_file):
+    for name in sorted(self.variables):
+      ninja_file.variable(name, self.variables[name])
+    if self.variables:
+      ninja_file.newline()
+    for name in sorted(self.rules):
+      (command, depfile, pool) = self.rules[name]
+      ninja_file.rule(name, command, depfile=depfile, restat=True, pool=pool)
+      ninja_file.newline()
+
+
 class Target(object):
   """Target represents the paths used within a single gyp target.
 
@@ -220,21 +332,30 @@ class Target(object):
 class NinjaWriter(object):
   def __init__(self, hash_for_rules, target_outputs, base_dir, build_dir,
                output_file, toplevel_build, output_file_name, flavor,
-               toplevel_dir=None):
+               toplevel_dir=None, line_width=78, shared=None):
     """
     base_dir: path from source root to directory containing this gyp file,
               by gyp semantics, all input paths are relative to this
     build_dir: path from source root to build output
     toplevel_dir: path to the toplevel directory
+    line_width: width to wrap lines at, None to not wrap them
+    shared: SharedNinjaDefinitions to move variables and rules to, None to
+            write them all to the target's own files
     """
 
     self.hash_for_rules = hash_for_rules
     self.target_outputs = target_outputs
     self.base_dir = base_dir
     self.build_dir = build_dir
-    self.ninja = ninja_syntax.Writer(output_file)
+    self.line_width = line_width
+    self.ninja = FastNinjaWriter(output_file, line_width)
+    self.shared = shared
     self.toplevel_build = toplevel_build
     self.output_file_name = output_file_name
+    # (path, output) pairs of the per-arch subninjas written next to
+    # output_file_name, see _SubninjaNameForArch.  Each output is a writer
+    # returned by gyn.common.WriteFileIfChanged.
+    self.arch_subninja_outputs = []
 
     self.flavor = flavor
     self.abs_build_dir = None
@@ -406,12 +527,14 @@ class NinjaWriter(object):
     if self.flavor == 'mac':
       self.archs = self.xcode_settings.GetActiveArchs(config_name)
       if len(self.archs) > 1:
-        self.arch_subninjas = dict(
-            (arch, ninja_syntax.Writer(
-                OpenOutput(os.path.join(self.toplevel_build,
-                                        self._SubninjaNameForArch(arch)),
-                           'w')))
-            for arch in self.archs)
+        self.arch_subninjas = {}
+        for arch in self.archs:
+          arch_output_file = self._SubninjaNameForArch(arch)
+          arch_output = gyn.common.WriteFileIfChanged(
+              os.path.join(self.toplevel_build, arch_output_file))
+          self.arch_subninja_outputs.append((arch_output_file, arch_output))
+          self.arch_subninjas[arch] = FastNinjaWriter(arch_output,
+                                                      self.line_width)
 
     # Compute predepends for all rules.
     # actions_depends is the dependencies this target depends on before running
@@ -609,9 +732,8 @@ class NinjaWriter(object):
       if depfile:
         depfile = self.ExpandSpecial(depfile, self.base_to_build)
       pool = 'console' if int(action.get('ninja_use_console', 0)) else None
-      rule_name, _ = self.WriteNewNinjaRule(name, args, description,
-                                            is_cygwin, env, pool,
-                                            depfile=depfile)
+      rule_name, _, description = self.WriteNewNinjaRule(
+          name, args, description, is_cygwin, env, pool, depfile=depfile)
 
       inputs = [self.GypPathToNinja(i, env) for i in action['inputs']]
       if int(action.get('process_outputs_as_sources', False)):
@@ -622,7 +744,8 @@ class NinjaWriter(object):
 
       # Then write out an edge using the rule.
       self.ninja.build(outputs, rule_name, inputs,
-                       order_only=prebuild)
+                       order_only=prebuild,
+                       variables=self.DescriptionBinding(description))
       all_outputs += outputs
 
       self.ninja.newline()
@@ -649,7 +772,7 @@ class NinjaWriter(object):
       is_cygwin = (self.msvs_settings.IsRuleRunUnderCygwin(rule)
                    if self.flavor == 'win' else False)
       pool = 'console' if int(rule.get('ninja_use_console', 0)) else None
-      rule_name, args = self.WriteNewNinjaRule(
+      rule_name, args, description = self.WriteNewNinjaRule(
           name, args, description, is_cygwin, env, pool)
 
       # TODO: if the command references the outputs directly, we should
@@ -737,6 +860,13 @@ class NinjaWriter(object):
           # WriteNewNinjaRule uses unique_name for creating an rsp file on win.
           extra_bindings.append(('unique_name',
               hashlib.md5(outputs[0]).hexdigest()))
+        if description is not None:
+          # Edge bindings are evaluated in the file's scope, so substitute the
+          # values bound above for the rule variables the description uses.
+          bound = dict(extra_bindings)
+          extra_bindings += self.DescriptionBinding(re.sub(
+              r'\$\{(%s)\}' % '|'.join(special_locals),
+              lambda match: bound.get(match.group(1), ''), description))
         self.ninja.build(outputs, rule_name, self.GypPathToNinja(source),
                          implicit=inputs,
                          order_only=prebuild,
@@ -1513,14 +1643,18 @@ class NinjaWriter(object):
     assert not isinstance(values, str)
     if values is None:
       values = []
-    ninja_file.variable(var, ' '.join(values))
+    value = ' '.join(values)
+    if self.shared is not None:
+      value = self.shared.Variable(var, value)
+    ninja_file.variable(var, value)
 
   def WriteNewNinjaRule(self, name, args, description, is_cygwin, env, pool,
                         depfile=None):
     """Write out a new ninja "rule" statement for a given command.
 
-    Returns the name of the new rule, and a copy of |args| with variables
-    expanded."""
+    Returns the name of the new rule, a copy of |args| with variables
+    expanded, and the description that the build edges using the rule must
+    bind (None if the rule has it)."""
 
     if self.flavor == 'win':
       args = [self.msvs_settings.ConvertVSMacros(
@@ -1571,6 +1705,11 @@ class NinjaWriter(object):
       command = gyn.common.EncodePOSIXShellList(args)
       command = 'cd %s; ' % self.build_to_base + env + command
 
+    # Rules with a response file keep their own name, which the response file
+    # is named after.
+    if self.shared is not None and not rspfile:
+      return self.shared.Rule(command, depfile, pool), args, description
+
     # GYP rules/actions express being no-ops by not touching their outputs.
     # Avoid executing downstream dependencies in this case by specifying
     # restat=1 to ninja.
@@ -1579,7 +1718,14 @@ class NinjaWriter(object):
                     rspfile=rspfile, rspfile_content=rspfile_content)
     self.ninja.newline()
 
-    return rule_name, args
+    return rule_name, args, None
+
+  def DescriptionBinding(self, description):
+    """Returns the variables binding |description| on a build edge, if it is
+    not None."""
+    if description is None:
+      return []
+    return [('description', description)]
 
 
 def CalculateVariables(default_variables, params):
@@ -1692,6 +1838,11 @@ def CalculateGeneratorInputInfo(params):
       'qualified_out_dir': qualified_out_dir,
   }
 
+  # E.g. "out/gypfiles/build_file_cache"
+  global generator_build_file_cache_dir
+  generator_build_file_cache_dir = os.path.join(qualified_out_dir,
+                                                'build_file_cache')
+
 
 def OpenOutput(path, mode='w'):
   """Open |path| for writing, creating directories if necessary."""
@@ -1699,6 +1850,32 @@ def OpenOutput(path, mode='w'):
   return open(path, mode)
 
 
+def NinjaLineWidth(generator_flags, width):
+  """Returns the width to wrap the lines of .ninja files at, None if the
+  ninja_no_line_wrapping generator flag is set."""
+  if int(generator_flags.get('ninja_no_line_wrapping', 0)):
+    return None
+  return width
+
+
+def SharedNinjaDefinitionsFor(generator_flags):
+  """Returns a SharedNinjaDefinitions to collect the variables and rules shared
+  between targets in, None unless the ninja_shared_rules generator flag is
+  set."""
+  if int(generator_flags.get('ninja_shared_rules', 0)):
+    return SharedNinjaDefinitions()
+  return None
+
+
+def WriteOutputIfChanged(path, contents, write_counts):
+  """Write |contents| to |path| unless it already holds them, counting the
+  files written and left unchanged in the |write_counts| Counter."""
+  if gyn.common.WriteFileIfChanged(path, contents):
+    write_counts['written'] += 1
+  else:
+    write_counts['unchanged'] += 1
+
+
 def CommandWithWrapper(cmd, wrappers, prog):
   wrapper = wrappers.get(cmd, '')
   if wrapper:
@@ -1814,8 +1991,176 @@ def _AddWinLinkRules(master_ninja, embed_manifest):
                     pool='link_pool')
 
 
+def WriteTargetNinja(qualified_target, spec, target_outputs, data, params,
+                     config_name, write_counts, shared=None):
+  """Writes the .ninja files of one target for |config_name|.
+
+  |target_outputs| maps targets to their Target objects, and must hold those of
+  the target's dependencies.  The variables and rules the target can share with
+  others are added to |shared| if it is a SharedNinjaDefinitions.  Returns a
+  (target, output_file) tuple, where target is the target's Target object (None
+  if it has no outputs) and output_file the path of its .ninja file relative to
+  the build directory (None if it has nothing to write)."""
+  options = params['options']
+  flavor = gyn.common.GetFlavor(params)
+  generator_flags = params.get('generator_flags', {})
+  build_dir = os.path.normpath(
+      os.path.join(ComputeOutputDir(params), config_name))
+  toplevel_build = os.path.join(options.toplevel_dir, build_dir)
+
+  build_file, name, toolset = \
+      gyn.common.ParseQualifiedTarget(qualified_target)
+  if flavor == 'mac':
+    gyn.xcode_emulation.MergeGlobalXcodeSettingsToSpec(data[build_file], spec)
+
+  build_file = gyn.common.RelativePath(build_file, options.toplevel_dir)
+
+  qualified_target_for_hash = gyn.common.QualifiedTarget(build_file, name,
+                                                         toolset)
+  hash_for_rules = hashlib.md5(qualified_target_for_hash.encode('utf-8')).hexdigest()
+
+  base_path = os.path.dirname(build_file)
+  obj = 'obj'
+  if toolset != 'target':
+    obj += '.' + toolset
+  output_file = os.path.join(obj, base_path, name + '.ninja')
+
+  # The target's .ninja file is compared with the existing one as it is
+  # written, rather than collected in memory first.
+  ninja_output = gyn.common.WriteFileIfChanged(
+      os.path.join(toplevel_build, output_file))
+  writer = NinjaWriter(hash_for_rules, target_outputs, base_path, build_dir,
+                       ninja_output,
+                       toplevel_build, output_file,
+                       flavor, toplevel_dir=options.toplevel_dir,
+                       line_width=NinjaLineWidth(generator_flags, 78),
+                       shared=shared)
+
+  try:
+    target = writer.WriteSpec(spec, config_name, generator_flags)
+  except:
+    ninja_output.discard()
+    for (arch_output_file, arch_output) in writer.arch_subninja_outputs:
+      arch_output.discard()
+    raise
+
+  if ninja_output.tell() > 0:
+    # Only create files for ninja files that actually have contents.
+    write_counts['written' if ninja_output.close() else 'unchanged'] += 1
+  else:
+    ninja_output.discard()
+    output_file = None
+  for (arch_output_file, arch_output) in writer.arch_subninja_outputs:
+    write_counts['written' if arch_output.close() else 'unchanged'] += 1
+  return (target, output_file)
+
+
+# The targets of a configuration are only written by a pool of worker processes
+# if there are at least this many of them.
+PARALLEL_NINJA_MIN_TARGETS = 256
+
+# The (target_dicts, data, params, config_name) arguments of the configuration
+# being written, in the worker processes of WriteTargetNinjasParallel.
+per_process_config_args = None
+
+
+def InitWriteTargetNinjaWorker(target_dicts, data, params, config_name):
+  # Ignore the interrupt signal so that the parent process catches it and
+  # kills all multiprocessing children.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+  global per_process_config_args
+  per_process_config_args = (target_dicts, data, params, config_name)
+
+
+def CallWriteTargetNinja(arglist):
+  """Wrapper around WriteTargetNinja for the workers of
+  WriteTargetNinjasParallel.
+
+  |arglist| is a (qualified_target, dependency_outputs) tuple, where
+  dependency_outputs maps the target's dependencies to their Target objects.
+  """
+  (qualified_target, dependency_outputs) = arglist
+  (target_dicts, data, params, config_name) = per_process_config_args
+  write_counts = collections.Counter()
+  shared = SharedNinjaDefinitionsFor(params.get('generator_flags', {}))
+  try:
+    (target, output_file) = WriteTargetNinja(
+        qualified_target, target_dicts[qualified_target], dependency_outputs,
+        data, params, config_name, write_counts, shared)
+  except gyn.common.GypError:
+    raise
+  except Exception as e:
+    # Not every exception survives pickling with its message intact, so send
+    # anything but a GypError as one with the message and traceback it would
+    # have printed.
+    raise gyn.common.GypError('%s: %s\n%s' % (type(e).__name__, e,
+                                              traceback.format_exc()))
+  return (qualified_target, target, output_file, write_counts, shared)
+
+
+def TargetWaves(target_list, target_dicts):
+  """Splits |target_list|, which has every target after its dependencies, into
+  waves: lists of targets that only depend on targets of earlier waves."""
+  waves = []
+  target_waves = {}
+  for qualified_target in target_list:
+    wave = 0
+    for dep in target_dicts[qualified_target].get('dependencies', []):
+      if dep in target_waves:
+        wave = max(wave, target_waves[dep] + 1)
+    target_waves[qualified_target] = wave
+    if wave == len(waves):
+      waves.append([])
+    waves[wave].append(qualified_target)
+  return waves
+
+
+def WriteTargetNinjasParallel(target_list, target_dicts, data, params,
+                              config_name, jobs, write_counts, shared=None):
+  """Writes the .ninja files of the targets in |target_list| for |config_name|
+  using a pool of |jobs| worker processes.  The definitions the workers share
+  between targets are added to |shared|.
+
+  A target's NinjaWriter needs the Target objects of its dependencies, so the
+  targets are written in waves, each holding the targets whose dependencies
+  were all written by earlier waves.  Returns a dict mapping each target to the
+  (target, output_file) tuple WriteTargetNinja returned for it.
+  """
+  waves = TargetWaves(target_list, target_dicts)
+  gyn.DebugOutput(gyn.DEBUG_GENERAL,
+                  'Writing %d targets for %s in %d waves on %d jobs',
+                  len(target_list), config_name, len(waves), jobs)
+
+  target_ninjas = {}
+  pool = multiprocessing.Pool(jobs, InitWriteTargetNinjaWorker,
+                              (target_dicts, data, params, config_name))
+  try:
+    for wave in waves:
+      arglists = []
+      for qualified_target in wave:
+        dependency_outputs = {}
+        for dep in target_dicts[qualified_target].get('dependencies', []):
+          if dep in target_ninjas and target_ninjas[dep][0]:
+            dependency_outputs[dep] = target_ninjas[dep][0]
+        arglists.append((qualified_target, dependency_outputs))
+      for (qualified_target, target, output_file, counts,
+           target_shared) in pool.map(CallWriteTargetNinja, arglists):
+        target_ninjas[qualified_target] = (target, output_file)
+        write_counts.update(counts)
+        if shared is not None:
+          shared.update(target_shared)
+  except:
+    # Also stop the workers if a target fails or on a KeyboardInterrupt.
+    pool.terminate()
+    raise
+  pool.close()
+  pool.join()
+  return target_ninjas
+
+
 def GenerateOutputForConfig(target_list, target_dicts, data, params,
-                            config_name):
+                            config_name, jobs=1):
   options = params['options']
   flavor = gyn.common.GetFlavor(params)
   generator_flags = params.get('generator_flags', {})
@@ -1827,11 +2172,18 @@ def GenerateOutputForConfig(target_list, target_dicts, data, params,
 
   toplevel_build = os.path.join(options.toplevel_dir, build_dir)
 
-  master_ninja_file = OpenOutput(os.path.join(toplevel_build, 'build.ninja'))
-  master_ninja = ninja_syntax.Writer(master_ninja_file, width=120)
+  # Generated files are only written if their contents change, so that ninja
+  # doesn't consider the build files it already knows modified.
+  write_counts = collections.Counter()
+
+  master_ninja_file = StringIO()
+  master_ninja = FastNinjaWriter(master_ninja_file,
+                                 NinjaLineWidth(generator_flags, 120))
 
   # Put build-time support tools in out/{config_name}.
-  gyn.common.CopyTool(flavor, toplevel_build)
+  tool_written = gyn.common.CopyTool(flavor, toplevel_build)
+  if tool_written is not None:
+    write_counts['written' if tool_written else 'unchanged'] += 1
 
   # Grab make settings for CC/CXX.
   # The rules are
@@ -2298,44 +2650,41 @@ def GenerateOutputForConfig(target_list, target_dicts, data, params,
   non_empty_target_names = set()
 
   for qualified_target in target_list:
-    # qualified_target is like: third_party/icu/icu.gyp:icui18n#target
-    build_file, name, toolset = \
-        gyn.common.ParseQualifiedTarget(qualified_target)
-
+    build_file = gyn.common.BuildFile(qualified_target)
     this_make_global_settings = data[build_file].get('make_global_settings', [])
     assert make_global_settings == this_make_global_settings, (
         "make_global_settings needs to be the same for all targets. %s vs. %s" %
         (this_make_global_settings, make_global_settings))
 
-    spec = target_dicts[qualified_target]
-    if flavor == 'mac':
-      gyn.xcode_emulation.MergeGlobalXcodeSettingsToSpec(data[build_file], spec)
-
-    build_file = gyn.common.RelativePath(build_file, options.toplevel_dir)
-
-    qualified_target_for_hash = gyn.common.QualifiedTarget(build_file, name,
-                                                           toolset)
-    hash_for_rules = hashlib.md5(qualified_target_for_hash.encode('utf-8')).hexdigest()
-
-    base_path = os.path.dirname(build_file)
-    obj = 'obj'
-    if toolset != 'target':
-      obj += '.' + toolset
-    output_file = os.path.join(obj, base_path, name + '.ninja')
+  # With the ninja_shared_rules generator flag, the targets share identical
+  # variables and rules through shared.ninja, which has to be included before
+  # them but can only be written after them.
+  shared = SharedNinjaDefinitionsFor(generator_flags)
+  if shared is not None:
+    master_ninja.include('shared.ninja')
+    master_ninja.newline()
 
-    ninja_output = StringIO()
-    writer = NinjaWriter(hash_for_rules, target_outputs, base_path, build_dir,
-                         ninja_output,
-                         toplevel_build, output_file,
-                         flavor, toplevel_dir=options.toplevel_dir)
+  if jobs > 1 and len(target_list) >= PARALLEL_NINJA_MIN_TARGETS:
+    target_ninjas = WriteTargetNinjasParallel(target_list, target_dicts, data,
+                                              params, config_name, jobs,
+                                              write_counts, shared)
+  else:
+    target_ninjas = {}
 
-    target = writer.WriteSpec(spec, config_name, generator_flags)
+  for qualified_target in target_list:
+    # qualified_target is like: third_party/icu/icu.gyp:icui18n#target
+    build_file, name, toolset = \
+        gyn.common.ParseQualifiedTarget(qualified_target)
+    spec = target_dicts[qualified_target]
 
-    if ninja_output.tell() > 0:
-      # Only create files for ninja files that actually have contents.
-      with OpenOutput(os.path.join(toplevel_build, output_file)) as ninja_file:
-        ninja_file.write(ninja_output.getvalue())
-      ninja_output.close()
+    if qualified_target in target_ninjas:
+      (target, output_file) = target_ninjas[qualified_target]
+    else:
+      (target, output_file) = WriteTargetNinja(qualified_target, spec,
+                                               target_outputs, data, params,
+                                               config_name, write_counts,
+                                               shared)
+    if output_file:
       master_ninja.subninja(output_file)
 
     if target:
@@ -2354,7 +2703,7 @@ def GenerateOutputForConfig(target_list, target_dicts, data, params,
     # able to run actions and build libraries by their short name.
     master_ninja.newline()
     master_ninja.comment('Short names for targets.')
-    for short_name in target_short_names:
+    for short_name in sorted(target_short_names):
       master_ninja.build(short_name, 'phony', [x.FinalOutput() for x in
                                                target_short_names[short_name]])
 
@@ -2370,10 +2719,24 @@ def GenerateOutputForConfig(target_list, target_dicts, data, params,
 
   if all_outputs:
     master_ninja.newline()
-    master_ninja.build('all', 'phony', list(all_outputs))
+    master_ninja.build('all', 'phony', sorted(all_outputs))
     master_ninja.default(generator_flags.get('default_target', 'all'))
 
+  if shared is not None:
+    shared_ninja_file = StringIO()
+    shared.Write(FastNinjaWriter(shared_ninja_file,
+                                 NinjaLineWidth(generator_flags, 120)))
+    WriteOutputIfChanged(os.path.join(toplevel_build, 'shared.ninja'),
+                         shared_ninja_file.getvalue(), write_counts)
+    shared_ninja_file.close()
+
+  WriteOutputIfChanged(os.path.join(toplevel_build, 'build.ninja'),
+                       master_ninja_file.getvalue(), write_counts)
   master_ninja_file.close()
+  gyn.DebugOutput(gyn.DEBUG_GENERAL,
+                  'Generated files for %s: %d written, %d unchanged',
+                  config_name, write_counts['written'],
+                  write_counts['unchanged'])
 
 
 def PerformBuild(data, configurations, params):
@@ -2394,6 +2757,74 @@ def CallGenerateOutputForConfig(arglist):
   GenerateOutputForConfig(target_list, target_dicts, data, params, config_name)
 
 
+# The (target_list, target_dicts, data, params) arguments of GenerateOutput, in
+# the forked worker processes writing its configurations.
+per_process_generator_args = None
+
+
+def InitGenerateOutputForConfigWorker(generator_args):
+  # Ignore the interrupt signal so that the parent process catches it and
+  # kills all multiprocessing children.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+  global per_process_generator_args
+  per_process_generator_args = generator_args
+
+
+def CallGenerateOutputForConfigName(config_name):
+  (target_list, target_dicts, data, params) = per_process_generator_args
+  GenerateOutputForConfig(target_list, target_dicts, data, params, config_name)
+
+
+def WorkersInheritMemory():
+  """Returns whether multiprocessing forks its worker processes, which then
+  share the memory of the parent process instead of unpickling their
+  arguments."""
+  get_start_method = getattr(multiprocessing, 'get_start_method', None)
+  if get_start_method is None:
+    # Python 2 forks everywhere but on Windows.
+    return sys.platform != 'win32'
+  return get_start_method() == 'fork'
+
+
+def ConfigurationSlice(target_dicts, data, config_name, flavor):
+  """Returns copies of |target_dicts| and |data| cut down to what
+  GenerateOutputForConfig needs to write |config_name|.
+
+  The targets only keep their own settings for |config_name|, and the build
+  files lose their lists of targets.  The copies are shallow: they share
+  everything else with the originals.
+  """
+  if flavor == 'mac':
+    # XcodeSettings looks at all the configurations of a target.
+    config_names = None
+  elif flavor == 'win':
+    # MsvsSettings can switch to the _x64 variant of a configuration and back.
+    config_names = set([config_name, config_name + '_x64',
+                        config_name.rsplit('_', 1)[0]])
+  else:
+    config_names = set([config_name])
+
+  sliced_target_dicts = {}
+  for qualified_target, target_dict in target_dicts.items():
+    target_dict = dict(target_dict)
+    if config_names is not None:
+      target_dict['configurations'] = dict(
+          (name, config)
+          for name, config in target_dict['configurations'].items()
+          if name in config_names)
+    sliced_target_dicts[qualified_target] = target_dict
+
+  sliced_data = {}
+  for build_file, build_file_data in data.items():
+    if type(build_file_data) is dict:
+      build_file_data = dict(
+          (key, value) for key, value in build_file_data.items()
+          if key != 'targets')
+    sliced_data[build_file] = build_file_data
+  return (sliced_target_dicts, sliced_data)
+
+
 def GenerateOutput(target_list, target_dicts, data, params):
   # Update target_dicts for iOS device builds.
   target_dicts = gyn.xcode_emulation.CloneConfigurationForDeviceAndEmulator(
@@ -2405,23 +2836,43 @@ def GenerateOutput(target_list, target_dicts, data, params):
     target_list, target_dicts = MSVSUtil.InsertLargePdbShims(
         target_list, target_dicts, generator_default_variables)
 
+  if params['parallel']:
+    jobs = gyn.input.GetJobs(params.get('jobs'))
+  else:
+    jobs = 1
+
   if user_config:
     GenerateOutputForConfig(target_list, target_dicts, data, params,
-                            user_config)
+                            user_config, jobs)
   else:
     config_names = list(target_dicts[target_list[0]]['configurations'].keys())
-    if params['parallel']:
+    if jobs > 1 and len(config_names) > 1:
+      # Write the configurations in parallel, and the targets of each one
+      # serially.  Forked workers already have the loaded build files and are
+      # only told which configuration to write.  Otherwise each worker is only
+      # sent its configuration's slice of them.
       try:
-        pool = multiprocessing.Pool(len(config_names))
-        arglists = []
-        for config_name in config_names:
-          arglists.append(
-              (target_list, target_dicts, data, params, config_name))
-        pool.map(CallGenerateOutputForConfig, arglists)
+        if WorkersInheritMemory():
+          pool = multiprocessing.Pool(
+              min(len(config_names), jobs), InitGenerateOutputForConfigWorker,
+              ((target_list, target_dicts, data, params),))
+          pool.map(CallGenerateOutputForConfigName, config_names)
+        else:
+          pool = multiprocessing.Pool(min(len(config_names), jobs))
+          flavor = gyn.common.GetFlavor(params)
+          arglists = []
+          for config_name in config_names:
+            (sliced_target_dicts, sliced_data) = ConfigurationSlice(
+                target_dicts, data, config_name, flavor)
+            arglists.append((target_list, sliced_target_dicts, sliced_data,
+                             params, config_name))
+          pool.map(CallGenerateOutputForConfig, arglists)
+        pool.close()
+        pool.join()
       except KeyboardInterrupt as e:
         pool.terminate()
         raise e
     else:
       for config_name in config_names:
         GenerateOutputForConfig(target_list, target_dicts, data, params,
-                                config_name)
+                                config_name, jobs)
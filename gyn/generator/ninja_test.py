@@ -6,10 +6,20 @@
 
 """ Unit tests for the ninja.py file. """
 
+import gyn.common
 import gyn.generator.ninja as ninja
+import os
+import shutil
+import subprocess
+import tempfile
 import unittest
 import sys
 
+try:
+  from cStringIO import StringIO    # python 2
+except ImportError:
+  from io import StringIO           # python 3
+
 
 class TestPrefixesAndSuffixes(unittest.TestCase):
   def test_BinaryNamesWindows(self):
@@ -41,5 +51,164 @@ class TestPrefixesAndSuffixes(unittest.TestCase):
     self.assertTrue(writer.ComputeOutputFileName(spec, 'static_library').
         endswith('.a'))
 
+
+class TestFastNinjaWriter(unittest.TestCase):
+  def _write(self, writer_class, width):
+    output = StringIO()
+    writer = writer_class(output, width)
+    writer.comment('A comment long enough to be wrapped at the narrow widths '
+                   'used here.')
+    writer.variable('cflags', ['-O2', '', '-Wall -Wextra'] * 4)
+    writer.build(['out 1:x', 'out$ 2'], 'cc', ['in$', 'in 2', ''],
+                 implicit='dep:1', order_only=['a', 'b'],
+                 variables={'defines': '-DA -DB'})
+    writer.build([], 'phony', implicit=['x y'])
+    return output.getvalue()
+
+  def test_same_output(self):
+    for width in (20, 40, 78):
+      self.assertEqual(self._write(ninja.ninja_syntax.Writer, width),
+                       self._write(ninja.FastNinjaWriter, width))
+
+  def test_no_wrapping(self):
+    self.assertEqual(self._write(ninja.ninja_syntax.Writer, 1000),
+                     self._write(ninja.FastNinjaWriter, None))
+
+
+class TestSharedNinjaDefinitions(unittest.TestCase):
+  def test_variable(self):
+    shared = ninja.SharedNinjaDefinitions()
+    defines = '-DFOO -DBAR -DBAZ -DQUX -DQUUX -DCORGE'
+    reference = shared.Variable('defines', defines)
+    self.assertTrue(reference.startswith('$defines_'))
+    self.assertEqual(reference, shared.Variable('defines', defines))
+    self.assertEqual({reference[1:]: defines}, shared.variables)
+    self.assertEqual('-DFOO', shared.Variable('defines', '-DFOO'))
+    self.assertEqual('$cflags_c ' + defines,
+                     shared.Variable('cflags_objc', '$cflags_c ' + defines))
+    self.assertEqual(1, len(shared.variables))
+
+  def test_update(self):
+    shared = ninja.SharedNinjaDefinitions()
+    name = shared.Rule('cd ..; python a.py', None, None)
+    other = ninja.SharedNinjaDefinitions()
+    self.assertEqual(name, other.Rule('cd ..; python a.py', None, None))
+    other.Rule('cd ..; python b.py', None, 'console')
+    shared.update(other)
+    self.assertEqual(other.rules, shared.rules)
+    other.rules[name] = ('cd ..; python c.py', None, None)
+    self.assertRaises(gyn.common.GypError, shared.update, other)
+
+  def test_write(self):
+    shared = ninja.SharedNinjaDefinitions()
+    includes = shared.Variable('includes', '-Ia/longer/include/directory')
+    rule = shared.Rule('python a.py', 'a.d', None)
+    output = StringIO()
+    shared.Write(ninja.FastNinjaWriter(output, None))
+    self.assertEqual('%s = -Ia/longer/include/directory\n\n'
+                     'rule %s\n'
+                     '  command = python a.py\n'
+                     '  depfile = a.d\n'
+                     '  restat = 1\n\n' % (includes[1:], rule),
+                     output.getvalue())
+
+
+class TestTargetWaves(unittest.TestCase):
+  def test_TargetWaves(self):
+    target_dicts = {
+      'a': {},
+      'b': {'dependencies': ['a']},
+      'c': {},
+      'd': {'dependencies': ['b', 'c']},
+      'e': {'dependencies': ['a']},
+    }
+    self.assertEqual([['a', 'c'], ['b', 'e'], ['d']],
+                     ninja.TargetWaves(['a', 'b', 'c', 'd', 'e'], target_dicts))
+
+
+class TestConfigurationSlice(unittest.TestCase):
+  def test_ConfigurationSlice(self):
+    target_dict = {'target_name': 'a', 'sources': ['a.c'],
+                   'configurations': {'Debug': {'defines': ['D']},
+                                      'Debug_x64': {}, 'Release': {}}}
+    data = {'a.gyp': {'targets': [target_dict], 'variables': {'x': 1}},
+            'target_build_files': set(['a.gyp'])}
+    target_dicts, sliced_data = ninja.ConfigurationSlice(
+        {'a.gyp:a#target': target_dict}, data, 'Debug', 'linux')
+    sliced_dict = target_dicts['a.gyp:a#target']
+    self.assertEqual({'Debug': {'defines': ['D']}},
+                     sliced_dict['configurations'])
+    self.assertTrue(sliced_dict['sources'] is target_dict['sources'])
+    self.assertEqual({'variables': {'x': 1}}, sliced_data['a.gyp'])
+    self.assertEqual(3, len(target_dict['configurations']))
+    self.assertEqual(['Debug', 'Debug_x64'], sorted(ninja.ConfigurationSlice(
+        {'a.gyp:a#target': target_dict}, data, 'Debug', 'win')[0][
+            'a.gyp:a#target']['configurations']))
+
+def _Generate(directory, targets, args=(), hash_seed='0'):
+  """Runs gyn in a separate process on a test.gyp holding |targets|."""
+  with open(os.path.join(directory, 'test.gyp'), 'w') as f:
+    f.write(repr({'targets': targets}))
+  env = dict(os.environ, PYTHONHASHSEED=hash_seed, PYTHONPATH=os.pathsep.join(
+      [os.path.dirname(os.path.dirname(os.path.abspath(gyn.__file__)))] +
+      os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+  subprocess.check_call([sys.executable, '-m', 'gyn', '--depth=.',
+                         '--no-parallel', 'test.gyp'] + list(args),
+                        cwd=directory, env=env)
+
+
+class TestRegeneration(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_unchanged_files_are_not_rewritten(self):
+    # Different hash seeds, so that nothing in the output may depend on the
+    # iteration order of sets or dicts.
+    targets = [{'target_name': 't%d' % i, 'type': 'static_library',
+                'sources': ['t%d.c' % i]} for i in range(20)]
+    _Generate(self.tmpdir, targets, hash_seed='1')
+    out_dir = os.path.join(self.tmpdir, 'out', 'Default')
+    stats = {}
+    for dir_path, _, file_names in os.walk(out_dir):
+      for file_name in file_names:
+        path = os.path.join(dir_path, file_name)
+        stats[path] = (os.stat(path).st_ino, os.stat(path).st_mtime)
+    self.assertTrue(os.path.join(out_dir, 'build.ninja') in stats)
+    _Generate(self.tmpdir, targets, hash_seed='2')
+    for path, stat in stats.items():
+      self.assertEqual(stat, (os.stat(path).st_ino, os.stat(path).st_mtime),
+                       path)
+
+
+class TestSharedRules(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _read(self, path):
+    with open(os.path.join(self.tmpdir, 'out', 'Default', path)) as f:
+      return f.read()
+
+  def test_actions_without_message_share_a_rule(self):
+    # The descriptions of actions without a message name their targets.
+    targets = [{'target_name': name, 'type': 'none',
+                'actions': [{'action_name': 'generate', 'inputs': [],
+                             'outputs': ['%s.h' % name],
+                             'action': ['python', 'generate.py']}]}
+               for name in ('a', 'b')]
+    _Generate(self.tmpdir, targets, args=['-G', 'ninja_shared_rules=1'])
+    rules = [line for line in self._read('shared.ninja').splitlines()
+             if line.startswith('rule ')]
+    self.assertEqual(1, len(rules))
+    for name in ('a', 'b'):
+      self.assertTrue('  description = ACTION %s: generate_' % name in
+                      self._read(os.path.join('obj', '%s.ninja' % name)))
+
+
 if __name__ == '__main__':
   unittest.main()
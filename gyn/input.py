@@ -4,17 +4,31 @@
 
 from __future__ import print_function
 
+import array
+import collections
+import errno
+import functools
 import gyn.common
 import gyn.simple_copy
+import hashlib
+import heapq
+import inspect
+import keyword
+import marshal
 import multiprocessing
+import multiprocessing.pool
 import os.path
+import pickle
 import re
 import shlex
 import signal
 import subprocess
 import sys
+import tempfile
 import threading
+import time
 import traceback
+import zlib
 from gyn.common import GypError
 from gyn.common import OrderedSet
 
@@ -127,6 +141,23 @@ multiple_toolsets = False
 # }
 generator_filelist_paths = None
 
+# Directory where parsed build files are cached between runs (with
+# --build-file-cache), or None if the cache is disabled.  Entries are keyed by
+# the absolute path of the build file.  One is reused as is while the file's
+# size and mtime are unchanged, or after reading the file if its SHA-1 is
+# unchanged; otherwise the file is evaluated again and the entry replaced.
+# Removing the directory drops the whole cache.
+build_file_cache_dir = None
+
+# Bump this whenever the layout of a build file cache entry changes, so stale
+# entries written by older versions are ignored.
+BUILD_FILE_CACHE_VERSION = 1
+
+# A build file whose mtime is this close (in seconds) to the time its cache
+# entry was written may have been modified again within the filesystem's
+# timestamp granularity, so its stat information alone can't be trusted.
+BUILD_FILE_CACHE_RACY_WINDOW = 2
+
 def GetIncludedBuildFiles(build_file_path, aux_data, included=None):
   """Return a list of all build files included into build_file_path.
 
@@ -165,28 +196,10 @@ def LoadOneBuildFile(build_file_path, data, aux_data, includes,
   if build_file_path in data:
     return data[build_file_path]
 
-  if os.path.exists(build_file_path):
-    build_file_contents = open(build_file_path).read()
-  else:
+  if not os.path.exists(build_file_path):
     raise GypError("%s not found (cwd: %s)" % (build_file_path, os.getcwd()))
 
-  build_file_data = None
-  try:
-    if check:
-      # TODO (saghul): this used to be implemented with Python's 'compiler' module
-      # an analyzing the ast, but that module is no longer available in Python 3,
-      # find a replacement.
-      raise NotImplementedError
-    build_file_data = eval(build_file_contents, {'__builtins__': None}, None)
-  except SyntaxError as e:
-    e.filename = build_file_path
-    raise
-  except Exception as e:
-    gyn.common.ExceptionAppend(e, 'while reading ' + build_file_path)
-    raise
-
-  if type(build_file_data) is not dict:
-    raise GypError("%s does not evaluate to a dictionary." % build_file_path)
+  build_file_data = ParseBuildFile(build_file_path, check)
 
   data[build_file_path] = build_file_data
   aux_data[build_file_path] = {}
@@ -209,6 +222,133 @@ def LoadOneBuildFile(build_file_path, data, aux_data, includes,
   return build_file_data
 
 
+def _BuildFileCachePath(build_file_path):
+  """Returns the path of the cache entry for build_file_path."""
+  key = os.path.abspath(build_file_path).encode('utf-8')
+  return os.path.join(build_file_cache_dir, hashlib.sha1(key).hexdigest())
+
+
+def _ReadBuildFileCache(build_file_path):
+  """Returns the cache entry for build_file_path, or None if there is no
+  usable one.
+
+  An entry is a dict with the build file's path, stat information, the SHA-1
+  of its contents and the dict it evaluated to.
+  """
+  try:
+    with open(_BuildFileCachePath(build_file_path), 'rb') as cache_file:
+      entry = marshal.load(cache_file)
+  except (EnvironmentError, EOFError, ValueError, TypeError):
+    return None
+  if (type(entry) is not dict or
+      entry.get('version') != BUILD_FILE_CACHE_VERSION or
+      entry.get('path') != os.path.abspath(build_file_path)):
+    return None
+  return entry
+
+
+def _WriteBuildFileCache(build_file_path, stat, digest, build_file_data):
+  """Stores build_file_data as the cache entry for build_file_path."""
+  entry = {
+    'version': BUILD_FILE_CACHE_VERSION,
+    'path': os.path.abspath(build_file_path),
+    'mtime': stat.st_mtime,
+    'size': stat.st_size,
+    'digest': digest,
+    'written': time.time(),
+    'data': build_file_data,
+  }
+  try:
+    contents = marshal.dumps(entry)
+  except ValueError:
+    # The build file evaluated to something marshal can't represent.
+    return
+  _WriteCacheFile(_BuildFileCachePath(build_file_path), contents)
+
+
+def _WriteCacheFile(cache_path, contents):
+  """Writes contents to cache_path, creating its directory if needed.
+
+  The contents are written to a temporary file and renamed into place, so
+  concurrent processes never see a partially written file.  Failing to write
+  the cache is not an error.
+  """
+  cache_dir = os.path.dirname(cache_path)
+  try:
+    try:
+      os.makedirs(cache_dir)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+    try:
+      with os.fdopen(tmp_fd, 'wb') as tmp_file:
+        tmp_file.write(contents)
+      if sys.platform == 'win32' and os.path.exists(cache_path):
+        os.remove(cache_path)
+      os.rename(tmp_path, cache_path)
+    except Exception:
+      os.unlink(tmp_path)
+      raise
+  except EnvironmentError:
+    pass
+
+
+def ParseBuildFile(build_file_path, check):
+  """Evaluates build_file_path and returns the resulting dict.
+
+  When build_file_cache_dir is set, the result is looked up in and stored to
+  an on-disk cache.  A cache entry is reused without reading the build file
+  if its size and mtime are unchanged, or after reading it if the SHA-1 of its
+  contents is unchanged.  The returned dict is always a fresh object, since
+  callers merge includes into it.
+  """
+  use_cache = build_file_cache_dir and not check
+  if use_cache:
+    stat = os.stat(build_file_path)
+    entry = _ReadBuildFileCache(build_file_path)
+    if (entry and entry['mtime'] == stat.st_mtime and
+        entry['size'] == stat.st_size and
+        entry['written'] - stat.st_mtime > BUILD_FILE_CACHE_RACY_WINDOW):
+      gyn.DebugOutput(gyn.DEBUG_INCLUDES, "Using cached '%s'", build_file_path)
+      return entry['data']
+
+  with open(build_file_path, 'rb') as build_file:
+    build_file_contents = build_file.read()
+
+  if use_cache:
+    digest = hashlib.sha1(build_file_contents).hexdigest()
+    if entry and entry['digest'] == digest:
+      # Only the stat information changed, refresh it so the next run can skip
+      # reading the file.
+      _WriteBuildFileCache(build_file_path, stat, digest, entry['data'])
+      gyn.DebugOutput(gyn.DEBUG_INCLUDES, "Using cached '%s'", build_file_path)
+      return entry['data']
+
+  build_file_data = None
+  try:
+    if check:
+      # TODO (saghul): this used to be implemented with Python's 'compiler' module
+      # an analyzing the ast, but that module is no longer available in Python 3,
+      # find a replacement.
+      raise NotImplementedError
+    build_file_data = eval(build_file_contents, {'__builtins__': None}, None)
+  except SyntaxError as e:
+    e.filename = build_file_path
+    raise
+  except Exception as e:
+    gyn.common.ExceptionAppend(e, 'while reading ' + build_file_path)
+    raise
+
+  if type(build_file_data) is not dict:
+    raise GypError("%s does not evaluate to a dictionary." % build_file_path)
+
+  if use_cache:
+    _WriteBuildFileCache(build_file_path, stat, digest, build_file_data)
+
+  return build_file_data
+
+
 def LoadBuildFileIncludesIntoDict(subdict, subdict_path, data, aux_data,
                                   includes, check):
   includes_list = []
@@ -349,9 +489,19 @@ def LoadTargetBuildFile(build_file_path, data, aux_data, variables, includes,
   # per toolset.
   ProcessToolsetsInDict(build_file_data)
 
+  # Start the commands that are ready to run in parallel, before expansion
+  # needs their results one by one.
+  prefetched = PrefetchCommands(build_file_data, build_file_path)
+
   # Apply "pre"/"early" variable expansions and condition evaluations.
-  ProcessVariablesAndConditionsInDict(
-      build_file_data, PHASE_EARLY, variables, build_file_path)
+  try:
+    ProcessVariablesAndConditionsInDict(
+        build_file_data, PHASE_EARLY, variables, build_file_path)
+  finally:
+    # Drop the results of the prefetched commands that the expansion didn't
+    # get to.
+    for cache_key in prefetched:
+      prefetched_command_results.pop(cache_key, None)
 
   # Since some toolsets might have been defined conditionally, perform
   # a second round of toolsets expansion now.
@@ -410,42 +560,107 @@ def LoadTargetBuildFile(build_file_path, data, aux_data, variables, includes,
   else:
     return (build_file_path, dependencies)
 
-def CallLoadTargetBuildFile(global_flags,
-                            build_file_path, variables,
-                            includes, depth, check,
-                            generator_input_info):
-  """Wrapper around LoadTargetBuildFile for parallel processing.
+# Arguments shared by every LoadTargetBuildFile call made by a worker process
+# of the parallel loader; set up by InitLoadTargetBuildFileWorker.
+per_process_load_args = None
 
-     This wrapper is used when LoadTargetBuildFile is executed in
-     a worker process.
-  """
+# Build files smaller than this many bytes are batched together into a single
+# task by the parallel loader.
+PARALLEL_LOAD_BATCH_BYTES = 64 * 1024
+
+# The maximum number of build files sent to a worker in a single task.
+PARALLEL_LOAD_BATCH_FILES = 8
+
+
+def EncodeParallelPayload(obj, compress):
+  """Serializes obj for sending between processes.
 
+  The results of the parallel loader are plain trees of dicts, lists, strings
+  and ints, which marshal handles much faster and more compactly than pickle.
+  pickle is only used as a fallback for anything marshal can't represent.
+  """
   try:
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    payload = b'm' + marshal.dumps(obj)
+  except ValueError:
+    payload = b'p' + pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+  if compress:
+    payload = b'z' + zlib.compress(payload, 1)
+  return payload
+
+
+def DecodeParallelPayload(payload):
+  """Inverse of EncodeParallelPayload."""
+  if payload[:1] == b'z':
+    payload = zlib.decompress(payload[1:])
+  if payload[:1] == b'm':
+    return marshal.loads(payload[1:])
+  return pickle.loads(payload[1:])
+
+
+def InitLoadTargetBuildFileWorker(global_flags, generator_input_info,
+                                  include_data, include_aux_data, load_args):
+  """Initializer for the worker processes of the parallel loader.
+
+  Applies the globals of the main process so that the worker behaves the
+  same, and seeds the worker's caches with the build files that were already
+  parsed by the main process.  load_args holds the (variables, includes,
+  depth, check, compress) arguments shared by every task.
+  """
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+  for key, value in global_flags.items():
+    globals()[key] = value
+  SetGeneratorGlobals(generator_input_info)
 
-    # Apply globals so that the worker process behaves the same.
-    for key, value in global_flags.items():
-      globals()[key] = value
+  # A no-op if the modules were inherited from the main process.
+  PreloadPymodDoMainModules()
 
-    SetGeneratorGlobals(generator_input_info)
-    result = LoadTargetBuildFile(build_file_path, per_process_data,
-                                 per_process_aux_data, variables,
-                                 includes, depth, check, False)
-    if not result:
-      return result
+  # These are never modified once loaded: LoadBuildFileIncludesIntoDict
+  # merges copies of them into the files that include them.
+  per_process_data.update(include_data)
+  per_process_aux_data.update(include_aux_data)
 
-    (build_file_path, dependencies) = result
+  global per_process_load_args
+  per_process_load_args = load_args
 
-    # We can safely pop the build_file_data from per_process_data because it
-    # will never be referenced by this process again, so we don't need to keep
-    # it in the cache.
-    build_file_data = per_process_data.pop(build_file_path)
 
-    # This gets serialized and sent back to the main process via a pipe.
-    # It's handled in LoadTargetBuildFileCallback.
-    return (build_file_path,
-            build_file_data,
-            dependencies)
+def CallLoadTargetBuildFile(build_file_paths):
+  """Wrapper around LoadTargetBuildFile for parallel processing.
+
+     This wrapper is used when LoadTargetBuildFile is executed in
+     a worker process.  It loads a batch of build files and returns the
+     results for all of them as a single payload from EncodeParallelPayload.
+  """
+
+  (variables, includes, depth, check, compress) = per_process_load_args
+  try:
+    results = []
+    for build_file_path in build_file_paths:
+      # Every build file gets its own copy of the variables, as it would if
+      # they were sent along with each task.
+      result = LoadTargetBuildFile(build_file_path, per_process_data,
+                                   per_process_aux_data,
+                                   gyn.simple_copy.deepcopy(variables),
+                                   includes, depth, check, False)
+      if not result:
+        return result
+
+      (build_file_path, dependencies) = result
+
+      # We can safely pop the build_file_data from per_process_data because it
+      # will never be referenced by this process again, so we don't need to
+      # keep it in the cache.  Included files stay cached, so each worker
+      # parses an include at most once no matter how many build files include
+      # it.
+      build_file_data = per_process_data.pop(build_file_path)
+      results.append((build_file_path, build_file_data, dependencies))
+
+    # This gets sent back to the main process via a pipe.  It's handled in
+    # LoadTargetBuildFileCallback.  The conditions compiled along the way go
+    # with it, so the main process can hand them to later workers and runs.
+    return EncodeParallelPayload(
+        (results, TakeConditionCacheStats(), TakeCommandStats(),
+         TakeListFilterStats()), compress)
   except GypError as e:
     sys.stderr.write("gyp: %s\n" % e)
     return None
@@ -465,6 +680,12 @@ class ParallelState(object):
   If build files are loaded in parallel, use this to keep track of
   state during farming out and processing parallel jobs. It's stored
   in a global so that the callback function can have access to it.
+
+  Build files waiting to be loaded are kept in a priority queue.  Files
+  referenced by more of the build files loaded so far come first, then files
+  found deeper in the dependency chain, then files in discovery order.  Files
+  that many others depend on, and long dependency chains, are usually on the
+  critical path, so they shouldn't wait behind leaf files.
   """
 
   def __init__(self):
@@ -481,10 +702,52 @@ class ParallelState(object):
     # The set of all build files that have been scheduled, so we don't
     # schedule the same one twice.
     self.scheduled = set()
-    # A list of dependency build file paths that haven't been scheduled yet.
+    # A heap of (-references, -depth, sequence, build file) entries for
+    # dependency build files that haven't been sent to a worker yet.  A file
+    # may have several entries as its priority changes; only the first one
+    # popped counts.
     self.dependencies = []
+    # Maps each build file that hasn't been sent to a worker yet to its
+    # current (references, depth) priority.
+    self.waiting = {}
+    # The depth in the dependency chain at which each build file was found.
+    self.depths = {}
+    # Counter used to keep the order of equal priority entries stable.
+    self.sequence = 0
     # Flag to indicate if there was an error in a child process.
     self.error = False
+    # The number of tasks sent to the pool and the number of bytes received
+    # back from it, for reporting.
+    self.tasks = 0
+    self.bytes_received = 0
+
+  def AddDependency(self, build_file_path, depth):
+    """Queues build_file_path, or raises its priority if already queued."""
+    if build_file_path in self.waiting:
+      references, old_depth = self.waiting[build_file_path]
+      references += 1
+      depth = max(depth, old_depth)
+    elif build_file_path in self.scheduled:
+      return
+    else:
+      self.scheduled.add(build_file_path)
+      # The build files given on the command line aren't referenced by any
+      # other.
+      references = 1 if depth else 0
+    self.depths[build_file_path] = depth
+    self.waiting[build_file_path] = (references, depth)
+    self.sequence += 1
+    heapq.heappush(self.dependencies,
+                   (-references, -depth, self.sequence, build_file_path))
+
+  def PopDependency(self):
+    """Returns the highest priority build file waiting to be loaded."""
+    while True:
+      (references, depth, _, build_file_path) = heapq.heappop(
+          self.dependencies)
+      if self.waiting.get(build_file_path) == (-references, -depth):
+        del self.waiting[build_file_path]
+        return build_file_path
 
   def LoadTargetBuildFileCallback(self, result):
     """Handle the results of running LoadTargetBuildFile in another process.
@@ -495,51 +758,129 @@ class ParallelState(object):
       self.condition.notify()
       self.condition.release()
       return
-    (build_file_path0, build_file_data0, dependencies0) = result
-    self.data[build_file_path0] = build_file_data0
-    self.data['target_build_files'].add(build_file_path0)
-    for new_dependency in dependencies0:
-      if new_dependency not in self.scheduled:
-        self.scheduled.add(new_dependency)
-        self.dependencies.append(new_dependency)
+    self.bytes_received += len(result)
+    (results, condition_cache_stats, command_stats,
+     list_filter_stats) = DecodeParallelPayload(result)
+    MergeConditionCacheStats(*condition_cache_stats)
+    MergeCommandStats(*command_stats)
+    MergeListFilterStats(list_filter_stats)
+    for (build_file_path0, build_file_data0, dependencies0) in results:
+      self.data[build_file_path0] = build_file_data0
+      self.data['target_build_files'].add(build_file_path0)
+      depth = self.depths[build_file_path0] + 1
+      for new_dependency in dependencies0:
+        self.AddDependency(new_dependency, depth)
     self.pending -= 1
     self.condition.notify()
     self.condition.release()
 
+  def NextBatch(self, jobs):
+    """Pops the next build files to load in a single task.
+
+    While there is enough queued work to keep every worker busy, small build
+    files are grouped together so that per-task overhead doesn't dominate.
+    """
+    batch = [self.PopDependency()]
+    if len(self.waiting) < jobs:
+      return batch
+    batch_bytes = _BuildFileSize(batch[0])
+    while (len(batch) < PARALLEL_LOAD_BATCH_FILES and
+           len(self.waiting) >= jobs):
+      size = _BuildFileSize(self.dependencies[0][3])
+      if batch_bytes + size > PARALLEL_LOAD_BATCH_BYTES:
+        break
+      batch.append(self.PopDependency())
+      batch_bytes += size
+    return batch
+
+
+def _BuildFileSize(build_file_path):
+  try:
+    return os.path.getsize(build_file_path)
+  except OSError:
+    # Let the worker report the missing file.
+    return 0
+
+
+def GetJobs(jobs=None):
+  """Returns the number of worker processes to use.
+
+  This is |jobs| if given, else the GYP_JOBS environment variable if set, else
+  the number of CPUs.
+  """
+  if jobs is None:
+    value = os.environ.get('GYP_JOBS')
+    if not value:
+      return multiprocessing.cpu_count()
+    try:
+      jobs = int(value)
+    except ValueError:
+      raise GypError('GYP_JOBS must be a positive integer, not %r' % value)
+    if jobs < 1:
+      raise GypError('GYP_JOBS must be a positive integer, not %r' % value)
+  elif jobs < 1:
+    raise GypError('-j/--jobs must be a positive integer, not %d' % jobs)
+  return jobs
+
 
 def LoadTargetBuildFilesParallel(build_files, data, variables, includes, depth,
-                                 check, generator_input_info):
+                                 check, generator_input_info, jobs):
+  """Loads build_files and their dependencies using a pool of |jobs| worker
+  processes.
+
+  The pool is returned, so that it can be reused for later phases of
+  processing.  The caller is responsible for closing it.
+  """
   parallel_state = ParallelState()
   parallel_state.condition = threading.Condition()
-  # Make copies of the build_files argument that we can modify while working.
-  parallel_state.dependencies = list(build_files)
-  parallel_state.scheduled = set(build_files)
+  for build_file in sorted(build_files):
+    parallel_state.AddDependency(build_file, 0)
   parallel_state.pending = 0
   parallel_state.data = data
 
+  # The includes passed on the command line are merged into every target build
+  # file.  Parse them once here and seed each worker with the result, rather
+  # than having every worker read and evaluate them on its own.
+  include_data = {}
+  include_aux_data = {}
+  for include in includes or []:
+    LoadOneBuildFile(include, include_data, include_aux_data, None, False,
+                     check)
+
+  global_flags = {
+    'path_sections': globals()['path_sections'],
+    'non_configuration_keys': globals()['non_configuration_keys'],
+    'multiple_toolsets': globals()['multiple_toolsets']}
+
+  # Compressing results trades worker CPU time for less data through the
+  # pipes, which only pays off on very large trees.
+  compress = bool(os.environ.get('GYP_PARALLEL_COMPRESS'))
+
   try:
+    # Idle workers take the next task from the pool's shared queue, so a
+    # worker stuck on a big build file doesn't hold up the others.
+    parallel_state.pool = multiprocessing.Pool(
+        jobs,
+        initializer=InitLoadTargetBuildFileWorker,
+        initargs=(global_flags, generator_input_info,
+                  include_data, include_aux_data,
+                  (variables, includes, depth, check, compress)))
+
     parallel_state.condition.acquire()
-    while parallel_state.dependencies or parallel_state.pending:
+    while parallel_state.waiting or parallel_state.pending:
       if parallel_state.error:
         break
-      if not parallel_state.dependencies:
+      if not parallel_state.waiting:
         parallel_state.condition.wait()
         continue
 
-      dependency = parallel_state.dependencies.pop()
+      batch = parallel_state.NextBatch(jobs)
 
       parallel_state.pending += 1
-      global_flags = {
-        'path_sections': globals()['path_sections'],
-        'non_configuration_keys': globals()['non_configuration_keys'],
-        'multiple_toolsets': globals()['multiple_toolsets']}
-
-      if not parallel_state.pool:
-        parallel_state.pool = multiprocessing.Pool(multiprocessing.cpu_count())
+      parallel_state.tasks += 1
       parallel_state.pool.apply_async(
           CallLoadTargetBuildFile,
-          args = (global_flags, dependency,
-                  variables, includes, depth, check, generator_input_info),
+          args = (batch,),
           callback = parallel_state.LoadTargetBuildFileCallback)
   except KeyboardInterrupt as e:
     parallel_state.pool.terminate()
@@ -547,35 +888,42 @@ def LoadTargetBuildFilesParallel(build_files, data, variables, includes, depth,
 
   parallel_state.condition.release()
 
-  parallel_state.pool.close()
-  parallel_state.pool.join()
-  parallel_state.pool = None
-
   if parallel_state.error:
+    parallel_state.pool.terminate()
     sys.exit(1)
 
+  gyn.DebugOutput(gyn.DEBUG_GENERAL,
+                  "Parallel load: %d build files in %d tasks on %d workers, "
+                  "%d bytes received", len(parallel_state.scheduled),
+                  parallel_state.tasks, jobs, parallel_state.bytes_received)
+
+  return parallel_state.pool
+
+
 # Look for the bracket that matches the first bracket seen in a
 # string, and return the start and end as a tuple.  For example, if
 # the input is something like "<(foo <(bar)) blah", then it would
 # return (1, 13), indicating the entire string except for the leading
-# "<" and trailing " blah".
+# "<" and trailing " blah".  If offset is given, the search starts there and
+# the result is relative to it, as if called on input_str[offset:].
 LBRACKETS= set('{[(')
 BRACKETS = {'}': '{', ']': '[', ')': '('}
-def FindEnclosingBracketGroup(input_str):
+def FindEnclosingBracketGroup(input_str, offset=0):
   stack = []
   start = -1
-  for index, char in enumerate(input_str):
+  for index in range(offset, len(input_str)):
+    char = input_str[index]
     if char in LBRACKETS:
       stack.append(char)
       if start == -1:
-        start = index
+        start = index - offset
     elif char in BRACKETS:
       if not stack:
         return (-1, -1)
       if stack.pop() != BRACKETS[char]:
         return (-1, -1)
       if not stack:
-        return (start, index + 1)
+        return (start, index - offset + 1)
   return (-1, -1)
 
 
@@ -628,6 +976,11 @@ latelate_variable_re = re.compile(
 # more then once.
 cached_command_results = {}
 
+# The (returncode, stdout, stderr) tuples, or exceptions, of the commands that
+# PrefetchCommands ran, keyed like cached_command_results.  RunCommand uses
+# these when the expansion reaches the command, instead of running it again.
+prefetched_command_results = {}
+
 
 def FixupPlatformCommand(cmd):
   if sys.platform == 'win32':
@@ -638,25 +991,415 @@ def FixupPlatformCommand(cmd):
   return cmd
 
 
+# Path of the file in which command results are cached between runs (with
+# --cache-commands), or None if the persistent command cache is disabled.
+# Results are keyed by the command, the directory it runs in and some
+# environment variables (see _CommandCacheKey).  One is reused while the files
+# named by the command's arguments and those it declares in the
+# command_cache_inputs variable are unchanged (see _CommandInputStamps).  A
+# command with neither, such as <!(pkg-config --cflags foo), is reused until
+# its key changes; commands whose output can change otherwise must use
+# <!nocache() to bypass the cache.  Removing the file drops the whole cache.
+command_cache_path = None
+
+# Bump this whenever the layout of the command cache changes, so that files
+# written by older versions are ignored.
+COMMAND_CACHE_VERSION = 1
+
+# Command results loaded from or to be stored to command_cache_path.  Maps
+# the key from _CommandCacheKey to an (output, declared inputs, input stamps)
+# tuple; see _CommandInputStamps.
+persistent_command_results = {}
+
+# Entries added to persistent_command_results by this process, the number of
+# hits in it, and (seconds, command, directory) for each command run by this
+# process, since the last call to TakeCommandStats.
+new_command_results = {}
+persistent_command_hits = 0
+command_timings = []
+
+
+def _CommandCacheKey(command_string, contents, build_file_dir):
+  """Returns the key of a command in the persistent command cache.
+
+  The key covers the command and the directory it runs in, plus PATH and any
+  environment variables listed in GYP_COMMAND_CACHE_ENV.
+  """
+  env_names = ['PATH'] + os.environ.get('GYP_COMMAND_CACHE_ENV', '').split()
+  env = tuple((name, os.environ.get(name)) for name in env_names)
+  return (command_string or '', str(contents), build_file_dir or '', env)
+
+
+def DeclaredCommandInputs(variables, build_file_dir):
+  """Returns the paths of the files listed in the command_cache_inputs
+  variable, relative to |build_file_dir|.
+
+  The <!() commands expanded where the variable is in scope declare these
+  files as their inputs, for the ones the persistent command cache can't
+  find in their arguments: modules imported by a script, data files it
+  reads, and so on.
+  """
+  inputs = variables.get('command_cache_inputs', [])
+  if type(inputs) is not list:
+    inputs = [inputs]
+  return tuple(sorted(set(os.path.normpath(os.path.join(build_file_dir or '',
+                                                        str(path)))
+                          for path in inputs)))
+
+
+def _CommandInputStamps(contents, build_file_dir, declared_inputs):
+  """Returns (path, mtime, size) for the inputs of a command: the files in
+  |declared_inputs| and each argument of the command that names an existing
+  file, such as the script run by "python script.py".
+
+  A cached result is only reused while these are unchanged.  The mtime and
+  size of a declared input that doesn't exist are None.
+  """
+  if type(contents) is list:
+    args = contents
+  else:
+    try:
+      args = shlex.split(contents)
+    except ValueError:
+      args = []
+  stamps = []
+  for path in declared_inputs:
+    try:
+      stat = os.stat(path)
+      stamps.append((path, stat.st_mtime, stat.st_size))
+    except OSError:
+      stamps.append((path, None, None))
+  for arg in args:
+    path = os.path.join(build_file_dir or '', str(arg))
+    if os.path.isfile(path):
+      stat = os.stat(path)
+      stamps.append((path, stat.st_mtime, stat.st_size))
+  return tuple(stamps)
+
+
+def LookupCommandCache(command_string, contents, build_file_dir,
+                       declared_inputs):
+  """Returns the output of a command from the persistent command cache, or
+  None if it isn't cached, its inputs changed or it declares different ones
+  than when it was cached."""
+  global persistent_command_hits
+  output = _LookupCommandCache(command_string, contents, build_file_dir,
+                               declared_inputs)
+  if output is not None:
+    persistent_command_hits += 1
+  return output
+
+
+def _LookupCommandCache(command_string, contents, build_file_dir,
+                        declared_inputs):
+  """Implements LookupCommandCache, without counting hits.  If
+  |declared_inputs| is None, the declared inputs aren't compared."""
+  if not command_cache_path:
+    return None
+  entry = persistent_command_results.get(
+      _CommandCacheKey(command_string, contents, build_file_dir))
+  if entry is None:
+    return None
+  (output, cached_declared_inputs, stamps) = entry
+  if (declared_inputs is not None and
+      tuple(declared_inputs) != cached_declared_inputs):
+    return None
+  for (path, mtime, size) in stamps:
+    try:
+      stat = os.stat(path)
+    except OSError:
+      if mtime is None:
+        continue
+      return None
+    if stat.st_mtime != mtime or stat.st_size != size:
+      return None
+  return output
+
+
+def StoreCommandCache(command_string, contents, build_file_dir, output,
+                      declared_inputs):
+  """Adds the output of a command to the persistent command cache."""
+  if not command_cache_path:
+    return
+  key = _CommandCacheKey(command_string, contents, build_file_dir)
+  entry = (output, tuple(declared_inputs),
+           _CommandInputStamps(contents, build_file_dir, declared_inputs))
+  persistent_command_results[key] = entry
+  new_command_results[key] = entry
+
+
+def TakeCommandStats():
+  """Returns the new persistent command cache entries, the number of hits in
+  it and the command timings since the last call, and resets them."""
+  global new_command_results, persistent_command_hits, command_timings
+  stats = (new_command_results, persistent_command_hits, command_timings)
+  new_command_results = {}
+  persistent_command_hits = 0
+  command_timings = []
+  return stats
+
+
+def MergeCommandStats(results, hits, timings):
+  """Merges the result of TakeCommandStats in another process into this
+  one."""
+  global persistent_command_hits
+  persistent_command_results.update(results)
+  new_command_results.update(results)
+  persistent_command_hits += hits
+  command_timings.extend(timings)
+
+
+def LoadCommandCache():
+  """Loads the command results cached by previous runs."""
+  global persistent_command_results
+  if not command_cache_path:
+    return
+  try:
+    with open(command_cache_path, 'rb') as cache_file:
+      contents = marshal.load(cache_file)
+  except (EnvironmentError, EOFError, ValueError, TypeError):
+    return
+  if (type(contents) is tuple and len(contents) == 2 and
+      contents[0] == COMMAND_CACHE_VERSION and type(contents[1]) is dict):
+    persistent_command_results = contents[1]
+
+
+def SaveCommandCache():
+  """Stores the command results of this run for later runs."""
+  if not command_cache_path or not new_command_results:
+    return
+  _WriteCacheFile(command_cache_path,
+                  marshal.dumps((COMMAND_CACHE_VERSION,
+                                 persistent_command_results)))
+
+
+def ReportCommandTimings():
+  """Reports the time spent running commands with -d general."""
+  if not command_timings and not persistent_command_hits:
+    return
+  gyn.DebugOutput(gyn.DEBUG_GENERAL,
+                  "Commands: %d run in %.2fs, %d from the persistent cache",
+                  len(command_timings), sum(t[0] for t in command_timings),
+                  persistent_command_hits)
+  for (seconds, contents, build_file_dir) in sorted(
+      command_timings, key=lambda timing: timing[0], reverse=True):
+    gyn.DebugOutput(gyn.DEBUG_GENERAL, "  %.3fs '%s' in '%s'",
+                    seconds, contents, build_file_dir or '.')
+
+
+# The modules loaded for <!pymod_do_main(), by name, along with whether their
+# DoMain() takes a cwd argument.  They stay loaded for the life of the
+# process.
+pymod_do_main_modules = {}
+
+# Serializes changing the current directory for modules whose DoMain() doesn't
+# take a cwd argument.
+pymod_do_main_lock = threading.RLock()
+
+
+def _ImportPymodDoMainModule(name, build_file_dir):
+  """Returns (module, takes_cwd) for a <!pymod_do_main() module.
+
+  Modules are imported as if from |build_file_dir|, the way they were when
+  the current directory was changed around the import.  A module's DoMain()
+  can take the directory it should work in as a cwd keyword argument, in
+  which case it's called without changing the current directory at all.
+  """
+  if name in pymod_do_main_modules:
+    return pymod_do_main_modules[name]
+
+  with pymod_do_main_lock:
+    # An empty entry in sys.path stands for the current directory.
+    old_path = sys.path[:]
+    if build_file_dir:
+      sys.path[:] = [os.path.abspath(build_file_dir) if path == '' else path
+                     for path in sys.path]
+    try:
+      py_module = __import__(name)
+    except ImportError as e:
+      raise GypError("Error importing pymod_do_main"
+                     "module (%s): %s" % (name, e))
+    finally:
+      sys.path[:] = old_path
+
+  try:
+    if hasattr(inspect, 'getfullargspec'):
+      argspec = inspect.getfullargspec(py_module.DoMain)
+      takes_cwd = 'cwd' in argspec.args or 'cwd' in argspec.kwonlyargs
+    else:
+      takes_cwd = 'cwd' in inspect.getargspec(py_module.DoMain).args
+  except (AttributeError, TypeError):
+    takes_cwd = False
+
+  pymod_do_main_modules[name] = (py_module, takes_cwd)
+  return pymod_do_main_modules[name]
+
+
+def PreloadPymodDoMainModules():
+  """Imports the <!pymod_do_main() modules listed in GYP_PYMOD_PRELOAD.
+
+  Worker processes of the parallel loader start with whatever was loaded in
+  the main process, so this saves each of them the cost of importing the
+  modules on first use.
+  """
+  for name in os.environ.get('GYP_PYMOD_PRELOAD', '').split():
+    _ImportPymodDoMainModule(name, None)
+
+
+def RunCommand(contents, command_string, use_shell, build_file_dir):
+  """Runs the command of a <!() expansion and returns its output."""
+  gyn.DebugOutput(gyn.DEBUG_VARIABLES,
+                  "Executing command '%s' in directory '%s'",
+                  contents, build_file_dir)
+  start_time = time.time()
+
+  if command_string == 'pymod_do_main':
+    # <!pymod_do_main(modulename param eters) loads |modulename| as a
+    # python module and then calls that module's DoMain() function,
+    # passing ["param", "eters"] as a single list argument. For modules
+    # that don't load quickly, this can be faster than
+    # <!(python modulename param eters). Do this in |build_file_dir|.
+    parsed_contents = shlex.split(contents)
+    (py_module, takes_cwd) = _ImportPymodDoMainModule(parsed_contents[0],
+                                                      build_file_dir)
+    if takes_cwd:
+      # The module accepts the directory to work in, so there's no need to
+      # change the process-wide current directory.
+      replacement = py_module.DoMain(parsed_contents[1:],
+                                     cwd=build_file_dir or os.getcwd())
+    else:
+      with pymod_do_main_lock:
+        oldwd = os.getcwd()  # Python doesn't like os.open('.'): no fchdir.
+        if build_file_dir:  # build_file_dir may be None (see above).
+          os.chdir(build_file_dir)
+        try:
+          replacement = py_module.DoMain(parsed_contents[1:])
+        finally:
+          os.chdir(oldwd)
+    replacement = str(replacement).rstrip()
+  elif command_string and command_string != 'nocache':
+    raise GypError("Unknown command string '%s' in '%s'." %
+                   (command_string, contents))
+  else:
+    result = prefetched_command_results.pop((str(contents), build_file_dir),
+                                            None)
+    if result is not None:
+      # PrefetchCommands already accounted for the time it took.
+      start_time = None
+    else:
+      result = _RunShellCommand(contents, use_shell, build_file_dir)
+    if isinstance(result, Exception):
+      raise result
+    (returncode, p_stdout, p_stderr) = result
+    if returncode != 0 or p_stderr:
+      sys.stderr.write(p_stderr)
+      # Simulate check_call behavior, since check_call only exists
+      # in python 2.5 and later.
+      raise GypError("Call to '%s' returned exit status %d." %
+                     (FixupPlatformCommand(contents), returncode))
+    replacement = p_stdout.rstrip()
+
+  if start_time is not None:
+    command_timings.append((time.time() - start_time, str(contents),
+                            build_file_dir))
+  return replacement
+
+
+def _RunShellCommand(contents, use_shell, build_file_dir):
+  """Runs a command and returns its exit status, stdout and stderr."""
+  # Fix up command with platform specific workarounds.
+  contents = FixupPlatformCommand(contents)
+  p = subprocess.Popen(contents, shell=use_shell,
+                       stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE,
+                       stdin=subprocess.PIPE,
+                       cwd=build_file_dir)
+
+  p_stdout, p_stderr = p.communicate('')
+  if not isinstance(p_stdout, str):
+    p_stdout = p_stdout.decode('utf-8')
+    p_stderr = p_stderr.decode('utf-8')
+  return (p.wait(), p_stdout, p_stderr)
+
+
 PHASE_EARLY = 0
 PHASE_LATE = 1
 PHASE_LATELATE = 2
 
+# The symbol that starts a variable expansion in each phase.
+expansion_symbols = {
+  PHASE_EARLY: '<',
+  PHASE_LATE: '>',
+  PHASE_LATELATE: '^',
+}
+
+
+# The strings seen by ExpandVariables, split into literal text and variable
+# references, keyed by (string, phase).  See ParseExpansions.  The cache is
+# cleared whenever it grows past EXPANSION_PARSE_CACHE_SIZE entries, so that
+# the strings of large trees aren't all kept alive until the end of the run.
+cached_expansion_parses = {}
+EXPANSION_PARSE_CACHE_SIZE = 1 << 14
+
+
+def ParseExpansions(input_str, phase):
+  """Splits input_str into the literal text and variable references in it.
+
+  Returns a (literals, references) tuple, where input_str is literals[0] +
+  the text of references[0] + literals[1] + ... + literals[-1].  Each
+  reference is a (start, end, contents_start, contents_end, match) tuple,
+  where match is the groupdict of the variable regex for the phase.
+  References nested in another reference's brackets are part of its contents
+  rather than separate references.  Results are cached.
+  """
+  key = (input_str, phase)
+  parsed = cached_expansion_parses.get(key)
+  if parsed is not None:
+    return parsed
 
-def ExpandVariables(input, phase, variables, build_file):
-  # Look for the pattern that gets expanded into variables
   if phase == PHASE_EARLY:
     variable_re = early_variable_re
-    expansion_symbol = '<'
   elif phase == PHASE_LATE:
     variable_re = late_variable_re
-    expansion_symbol = '>'
   elif phase == PHASE_LATELATE:
     variable_re = latelate_variable_re
-    expansion_symbol = '^'
   else:
     assert False
 
+  literals = []
+  references = []
+  position = 0
+  for match_group in variable_re.finditer(input_str):
+    replace_start = match_group.start('replace')
+    if replace_start < position:
+      # Inside the previous reference, which will expand it as part of its
+      # contents.
+      continue
+
+    # Find the ending paren.  The variable_re probably doesn't match the
+    # entire reference if it contained nested variables.
+    (c_start, c_end) = FindEnclosingBracketGroup(input_str, replace_start)
+    if c_start == -1:
+      raise GypError("Unbalanced brackets in '%s'" % input_str)
+    replace_end = replace_start + c_end
+
+    literals.append(input_str[position:replace_start])
+    references.append((replace_start, replace_end,
+                       replace_start + c_start + 1, replace_end - 1,
+                       match_group.groupdict()))
+    position = replace_end
+  literals.append(input_str[position:])
+
+  parsed = (literals, references)
+  if len(cached_expansion_parses) >= EXPANSION_PARSE_CACHE_SIZE:
+    cached_expansion_parses.clear()
+  cached_expansion_parses[key] = parsed
+  return parsed
+
+
+def ExpandVariables(input, phase, variables, build_file):
+  expansion_symbol = expansion_symbols[phase]
+
   input_str = str(input)
   if IsStrCanonicalInt(input_str):
     return int(input_str)
@@ -665,20 +1408,20 @@ def ExpandVariables(input, phase, variables, build_file):
   if expansion_symbol not in input_str:
     return input_str
 
-  # Get the entire list of matches as a list of MatchObject instances.
-  # (using findall here would return strings instead of MatchObjects).
-  matches = list(variable_re.finditer(input_str))
-  if not matches:
+  # Look for the pattern that gets expanded into variables.
+  (literals, references) = ParseExpansions(input_str, phase)
+  if not references:
     return input_str
 
-  output = input_str
-  # Reverse the list of matches so that replacements are done right-to-left.
-  # That ensures that earlier replacements won't mess up the string in a
-  # way that causes later calls to find the earlier substituted text instead
-  # of what's intended for replacement.
-  matches.reverse()
-  for match_group in matches:
-    match = match_group.groupdict()
+  # Replacements are done right-to-left, like they always have been, and the
+  # output is assembled from the pieces in one go at the end.  |pieces| holds
+  # the expanded text to the right of the current reference, in reverse.
+  output = None
+  pieces = [literals[-1]]
+  tail_is_empty = not literals[-1]
+  for index in range(len(references) - 1, -1, -1):
+    (replace_start, replace_end, contents_start, contents_end,
+     match) = references[index]
     gyn.DebugOutput(gyn.DEBUG_VARIABLES, "Matches: %r", match)
     # match['replace'] is the substring to look for, match['type']
     # is the character code for the replacement type (< > <! >! <| >| <@
@@ -694,26 +1437,7 @@ def ExpandVariables(input, phase, variables, build_file):
     # file_list is true if a | variant is used.
     file_list = '|' in match['type']
 
-    # Capture these now so we can adjust them later.
-    replace_start = match_group.start('replace')
-    replace_end = match_group.end('replace')
-
-    # Find the ending paren, and re-evaluate the contained string.
-    (c_start, c_end) = FindEnclosingBracketGroup(input_str[replace_start:])
-
-    # Adjust the replacement range to match the entire command
-    # found by FindEnclosingBracketGroup (since the variable_re
-    # probably doesn't match the entire command if it contained
-    # nested variables).
-    replace_end = replace_start + c_end
-
-    # Find the "real" replacement, matching the appropriate closing
-    # paren, and adjust the replacement start and end.
-    replacement = input_str[replace_start:replace_end]
-
     # Figure out what the contents of the variable parens are.
-    contents_start = replace_start + c_start + 1
-    contents_end = replace_end - 1
     contents = input_str[contents_start:contents_end]
 
     # Do filter substitution now for <|().
@@ -739,8 +1463,10 @@ def ExpandVariables(input, phase, variables, build_file):
     # is to be expecting a list in return, and not all callers do
     # because not all are working in list context.  Also, for list
     # expansions, there can be no other text besides the variable
-    # expansion in the input string.
-    expand_to_list = '@' in match['type'] and input_str == replacement
+    # expansion in the input string, once everything to its right has been
+    # expanded.
+    expand_to_list = ('@' in match['type'] and replace_start == 0 and
+                      tail_is_empty)
 
     if run_command or file_list:
       # Find the build file's directory, so commands can be run or file lists
@@ -793,65 +1519,27 @@ def ExpandVariables(input, phase, variables, build_file):
       # Check for a cached value to avoid executing commands, or generating
       # file lists more than once. The cache key contains the command to be
       # run as well as the directory to run it from, to account for commands
-      # that depend on their current directory.
-      # TODO(http://code.google.com/p/gyp/issues/detail?id=111): In theory,
-      # someone could author a set of GYP files where each time the command
-      # is invoked it produces different output by design. When the need
-      # arises, the syntax should be extended to support no caching off a
-      # command's output so it is run every time.
+      # that depend on their current directory.  Commands that produce
+      # different output each time they're run can use <!nocache(...) to
+      # bypass the caches.
+      use_cache = command_string != 'nocache'
       cache_key = (str(contents), build_file_dir)
-      cached_value = cached_command_results.get(cache_key, None)
+      cached_value = None
+      if use_cache:
+        cached_value = cached_command_results.get(cache_key, None)
+        if cached_value is None:
+          declared_inputs = DeclaredCommandInputs(variables, build_file_dir)
+          cached_value = LookupCommandCache(command_string, contents,
+                                            build_file_dir, declared_inputs)
+          if cached_value is not None:
+            cached_command_results[cache_key] = cached_value
       if cached_value is None:
-        gyn.DebugOutput(gyn.DEBUG_VARIABLES,
-                        "Executing command '%s' in directory '%s'",
-                        contents, build_file_dir)
-
-        replacement = ''
-
-        if command_string == 'pymod_do_main':
-          # <!pymod_do_main(modulename param eters) loads |modulename| as a
-          # python module and then calls that module's DoMain() function,
-          # passing ["param", "eters"] as a single list argument. For modules
-          # that don't load quickly, this can be faster than
-          # <!(python modulename param eters). Do this in |build_file_dir|.
-          oldwd = os.getcwd()  # Python doesn't like os.open('.'): no fchdir.
-          if build_file_dir:  # build_file_dir may be None (see above).
-            os.chdir(build_file_dir)
-          try:
-
-            parsed_contents = shlex.split(contents)
-            try:
-              py_module = __import__(parsed_contents[0])
-            except ImportError as e:
-              raise GypError("Error importing pymod_do_main"
-                             "module (%s): %s" % (parsed_contents[0], e))
-            replacement = str(py_module.DoMain(parsed_contents[1:])).rstrip()
-          finally:
-            os.chdir(oldwd)
-          assert replacement != None
-        elif command_string:
-          raise GypError("Unknown command string '%s' in '%s'." %
-                         (command_string, contents))
-        else:
-          # Fix up command with platform specific workarounds.
-          contents = FixupPlatformCommand(contents)
-          p = subprocess.Popen(contents, shell=use_shell,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               stdin=subprocess.PIPE,
-                               cwd=build_file_dir)
-
-          p_stdout, p_stderr = p.communicate('')
-
-          if p.wait() != 0 or p_stderr:
-            sys.stderr.write(p_stderr)
-            # Simulate check_call behavior, since check_call only exists
-            # in python 2.5 and later.
-            raise GypError("Call to '%s' returned exit status %d." %
-                           (contents, p.returncode))
-          replacement = p_stdout.rstrip()
-
-        cached_command_results[cache_key] = replacement
+        replacement = RunCommand(contents, command_string, use_shell,
+                                 build_file_dir)
+        if use_cache:
+          cached_command_results[cache_key] = replacement
+          StoreCommandCache(command_string, contents, build_file_dir,
+                            replacement, declared_inputs)
       else:
         gyn.DebugOutput(gyn.DEBUG_VARIABLES,
                         "Had cache value for command '%s' in directory '%s'",
@@ -920,10 +1608,15 @@ def ExpandVariables(input, phase, variables, build_file):
       else:
         encoded_replacement = replacement
 
-      output = output[:replace_start] + str(encoded_replacement) + \
-               output[replace_end:]
-    # Prepare for the next match iteration.
-    input_str = output
+      encoded_replacement = str(encoded_replacement)
+      pieces.append(encoded_replacement)
+      pieces.append(literals[index])
+      tail_is_empty = (tail_is_empty and not encoded_replacement and
+                       not literals[index])
+
+  if output is None:
+    pieces.reverse()
+    output = ''.join(pieces)
 
   if output == input:
     gyn.DebugOutput(gyn.DEBUG_VARIABLES,
@@ -959,9 +1652,226 @@ def ExpandVariables(input, phase, variables, build_file):
 
   return output
 
+# The maximum number of commands run at the same time by PrefetchCommands.
+PREFETCH_COMMAND_JOBS = 8
+
+
+def _FindPrefetchableCommands(value, build_file_dir, commands):
+  """Adds the <!() commands in |value| that can be run before expansion to
+  |commands|, a dict mapping their cached_command_results key to their
+  (contents, use_shell) arguments.
+
+  Only shell commands whose contents contain no further expansions qualify.
+  Conditions sections are skipped, since commands there may never run, and so
+  are strings that can't be parsed, which are left for the expansion to report
+  if it gets to them.
+  """
+  if type(value) is dict:
+    for key, item in value.items():
+      if key not in ('conditions', 'target_conditions'):
+        _FindPrefetchableCommands(item, build_file_dir, commands)
+  elif type(value) is list:
+    for item in value:
+      _FindPrefetchableCommands(item, build_file_dir, commands)
+  elif type(value) is str and '<!' in value:
+    try:
+      (_, references) = ParseExpansions(value, PHASE_EARLY)
+    except GypError:
+      return
+    for (_, _, contents_start, contents_end, match) in references:
+      if match['command_string'] or '!' not in match['type']:
+        continue
+      contents = value[contents_start:contents_end]
+      if '<' in contents:
+        continue
+      contents = contents.strip()
+      use_shell = True
+      if match['is_array']:
+        try:
+          contents = eval(contents)
+        except Exception:
+          # Let the expansion report it.
+          continue
+        use_shell = False
+      cache_key = (str(contents), build_file_dir)
+      if cache_key not in cached_command_results:
+        commands[cache_key] = (contents, use_shell)
+
+
+def _PrefetchCommand(args):
+  (contents, use_shell, build_file_dir) = args
+  start_time = time.time()
+  try:
+    result = _RunShellCommand(contents, use_shell, build_file_dir)
+  except Exception as e:
+    return e
+  command_timings.append((time.time() - start_time, str(contents),
+                          build_file_dir))
+  return result
+
+
+def PrefetchCommands(build_file_data, build_file_path):
+  """Runs the <!() commands of a loaded build file concurrently, so that
+  expanding them later doesn't wait on each one in turn.  Returns the keys of
+  the commands run.
+
+  The results are kept in prefetched_command_results for RunCommand, which
+  reports failures and lets the expansion cache the output of the others, so
+  that the commands don't run twice.  Commands already in the persistent
+  command cache aren't run.
+
+  The commands run at the same time and out of their order in the build file,
+  including ones the expansion would never have run.  Commands with side
+  effects should use <!nocache(), which is never prefetched.
+  """
+  build_file_dir = os.path.dirname(build_file_path) or None
+  commands = {}
+  _FindPrefetchableCommands(build_file_data, build_file_dir, commands)
+
+  to_run = []
+  for cache_key, (contents, use_shell) in commands.items():
+    # The expansion looks the command up again, along with its declared
+    # inputs.
+    if _LookupCommandCache(None, contents, build_file_dir, None) is None:
+      to_run.append((cache_key, contents, use_shell))
+  if len(to_run) < 2:
+    # Nothing to gain, let expansion run it.
+    return []
+
+  gyn.DebugOutput(gyn.DEBUG_VARIABLES, "Prefetching %d commands for '%s'",
+                  len(to_run), build_file_path)
+  pool = multiprocessing.pool.ThreadPool(min(len(to_run),
+                                             PREFETCH_COMMAND_JOBS))
+  try:
+    results = pool.map(_PrefetchCommand,
+                       [(contents, use_shell, build_file_dir)
+                        for (_, contents, use_shell) in to_run])
+  finally:
+    pool.close()
+    pool.join()
+  for ((cache_key, _, _), result) in zip(to_run, results):
+    prefetched_command_results[cache_key] = result
+  return [cache_key for (cache_key, _, _) in to_run]
+
+
 # The same condition is often evaluated over and over again so it
 # makes sense to cache as much as possible between evaluations.
-cached_conditions_asts = {}
+# Compiled conditions, keyed by the condition's source.  The values are either
+# code objects to evaluate, or functions that take the variables dict, for
+# simple comparisons that don't need the full evaluator.
+cached_conditions = {}
+
+# The code objects of all conditions in cached_conditions, by source.
+compiled_conditions = {}
+
+# Code objects compiled by this process since the last call to
+# TakeConditionCacheStats, along with cache hit and miss counters.
+new_conditions = {}
+condition_cache_hits = 0
+condition_cache_misses = 0
+
+# The sources of the conditions evaluated by this run, and the ones loaded
+# from the on-disk cache.  Only the conditions used by a run are saved, so the
+# cache drops the ones that are no longer evaluated.
+used_conditions = set()
+loaded_conditions = set()
+
+# Matches conditions of the form NAME==VALUE or NAME!=VALUE, where VALUE is a
+# string or integer literal.
+simple_condition_re = re.compile(
+    r'^\s*(?P<name>[A-Za-z_][A-Za-z0-9_]*)\s*(?P<op>==|!=)\s*'
+    r'(?:"(?P<dq>[^"\\]*)"|\'(?P<sq>[^\'\\]*)\'|(?P<int>-?(?:0|[1-9][0-9]*)))'
+    r'\s*$')
+
+
+def _CompileSimpleCondition(cond_expr):
+  """Returns a function evaluating cond_expr if it's a simple comparison, or
+  None otherwise."""
+  match = simple_condition_re.match(cond_expr)
+  if not match:
+    return None
+  name = match.group('name')
+  if keyword.iskeyword(name) or name.startswith('__'):
+    return None
+  if match.group('int') is not None:
+    value = int(match.group('int'))
+  elif match.group('dq') is not None:
+    value = match.group('dq')
+  else:
+    value = match.group('sq')
+  equal = match.group('op') == '=='
+
+  def EvalSimpleCondition(variables):
+    try:
+      return (variables[name] == value) == equal
+    except KeyError:
+      raise NameError("name '%s' is not defined" % name)
+  return EvalSimpleCondition
+
+
+def _AddCompiledCondition(cond_expr, ast_code):
+  compiled_conditions[cond_expr] = ast_code
+  cached_conditions[cond_expr] = (_CompileSimpleCondition(cond_expr) or
+                                  ast_code)
+
+
+def TakeConditionCacheStats():
+  """Returns the conditions compiled and used by this process and the hit and
+  miss counts since the last call, and resets them."""
+  global new_conditions, used_conditions
+  global condition_cache_hits, condition_cache_misses
+  stats = (new_conditions, used_conditions, condition_cache_hits,
+           condition_cache_misses)
+  new_conditions = {}
+  used_conditions = set()
+  condition_cache_hits = 0
+  condition_cache_misses = 0
+  return stats
+
+
+def MergeConditionCacheStats(conditions, used, hits, misses):
+  """Merges the result of TakeConditionCacheStats in another process into this
+  one."""
+  global condition_cache_hits, condition_cache_misses
+  for cond_expr, ast_code in conditions.items():
+    if cond_expr not in cached_conditions:
+      _AddCompiledCondition(cond_expr, ast_code)
+      new_conditions[cond_expr] = ast_code
+  used_conditions.update(used)
+  condition_cache_hits += hits
+  condition_cache_misses += misses
+
+
+def _ConditionCachePath():
+  # Code objects can only be loaded by the Python version that created them.
+  return os.path.join(build_file_cache_dir,
+                      'conditions-%x' % sys.hexversion)
+
+
+def LoadConditionCache():
+  """Loads the conditions compiled by previous runs, if cached on disk."""
+  if not build_file_cache_dir:
+    return
+  try:
+    with open(_ConditionCachePath(), 'rb') as cache_file:
+      conditions = marshal.load(cache_file)
+  except (EnvironmentError, EOFError, ValueError, TypeError):
+    return
+  for cond_expr, ast_code in conditions.items():
+    _AddCompiledCondition(cond_expr, ast_code)
+  loaded_conditions.update(conditions)
+
+
+def SaveConditionCache():
+  """Replaces the on-disk cache with the conditions used by this run, unless
+  they are the ones it already holds."""
+  if not build_file_cache_dir or used_conditions == loaded_conditions:
+    return
+  conditions = dict((cond_expr, compiled_conditions[cond_expr])
+                    for cond_expr in used_conditions
+                    if cond_expr in compiled_conditions)
+  _WriteCacheFile(_ConditionCachePath(), marshal.dumps(conditions))
+
 
 def EvalCondition(condition, conditions_key, phase, variables, build_file):
   """Returns the dict that should be used or None if the result was
@@ -1006,20 +1916,36 @@ def EvalSingleCondition(
   # contain variable references without needing to resort to GYP expansion
   # syntax, this is of dubious value for variables, but someone might want to
   # use a command expansion directly inside a condition.
-  cond_expr_expanded = ExpandVariables(cond_expr, phase, variables,
-                                       build_file)
+  global condition_cache_hits, condition_cache_misses
+  # Most conditions contain no expansions at all, look those up by their source
+  # without going through ExpandVariables.
+  if (type(cond_expr) is str and cond_expr in cached_conditions and
+      expansion_symbols[phase] not in cond_expr):
+    cond_expr_expanded = cond_expr
+  else:
+    cond_expr_expanded = ExpandVariables(cond_expr, phase, variables,
+                                         build_file)
   if type(cond_expr_expanded) not in (str, int):
     raise ValueError(
           'Variable expansion in this context permits str and int ' + \
             'only, found ' + cond_expr_expanded.__class__.__name__)
 
   try:
-    if cond_expr_expanded in cached_conditions_asts:
-      ast_code = cached_conditions_asts[cond_expr_expanded]
-    else:
+    evaluator = cached_conditions.get(cond_expr_expanded)
+    if evaluator is None:
+      condition_cache_misses += 1
       ast_code = compile(cond_expr_expanded, '<string>', 'eval')
-      cached_conditions_asts[cond_expr_expanded] = ast_code
-    if eval(ast_code, {'__builtins__': None}, variables):
+      _AddCompiledCondition(cond_expr_expanded, ast_code)
+      new_conditions[cond_expr_expanded] = ast_code
+      evaluator = cached_conditions[cond_expr_expanded]
+    else:
+      condition_cache_hits += 1
+    used_conditions.add(cond_expr_expanded)
+    if callable(evaluator):
+      result = evaluator(variables)
+    else:
+      result = eval(evaluator, {'__builtins__': None}, variables)
+    if result:
       return true_dict
     return false_dict
   except SyntaxError as e:
@@ -1445,110 +2371,210 @@ def RemoveLinkDependenciesFromNoneTargets(targets):
                   Filter(target_dict[dependency_key], t)
 
 
-class DependencyGraphNode(object):
-  """
+class DependencyGraph(object):
+  """A dependency graph with its nodes interned as integers.
 
-  Attributes:
-    ref: A reference to an object that this DependencyGraphNode represents.
-    dependencies: List of DependencyGraphNodes on which this one depends.
-    dependents: List of DependencyGraphNodes that depend on this one.
+  Node i stands for refs[i], and nodes are numbered in sorted order of their
+  refs.  The dependencies of node i are
+  dependency_indices[dependency_offsets[i]:dependency_offsets[i + 1]], in the
+  order they were given, and its dependents are found the same way in
+  dependent_offsets and dependent_indices, in node order.  The whole graph is
+  held in these four integer arrays, and the closures computed over it in
+  arrays of node indices.
   """
 
+  __slots__ = ('refs', 'index', 'dependency_offsets', 'dependency_indices',
+               'dependent_offsets', 'dependent_indices', '_deep_dependencies',
+               '_link_dependencies')
+
   class CircularException(GypError):
     pass
 
-  def __init__(self, ref):
-    self.ref = ref
-    self.dependencies = []
-    self.dependents = []
-
-  def __repr__(self):
-    return '<DependencyGraphNode: %r>' % self.ref
+  def __init__(self, dependencies):
+    """|dependencies| maps every ref to a list of the refs it depends on."""
+    self.refs = sorted(dependencies)
+    self.index = index = dict((ref, i) for i, ref in enumerate(self.refs))
+    count = len(self.refs)
+
+    self.dependency_offsets = dependency_offsets = array.array('i', [0])
+    self.dependency_indices = dependency_indices = array.array('i')
+    dependent_counts = [0] * count
+    for ref in self.refs:
+      for dependency in dependencies[ref]:
+        dependency_index = index[dependency]
+        dependency_indices.append(dependency_index)
+        dependent_counts[dependency_index] += 1
+      dependency_offsets.append(len(dependency_indices))
+
+    # Turn every edge around, keeping the dependents of each node in order.
+    self.dependent_offsets = dependent_offsets = array.array('i', [0])
+    for dependent_count in dependent_counts:
+      dependent_offsets.append(dependent_offsets[-1] + dependent_count)
+    self.dependent_indices = dependent_indices = \
+        array.array('i', [0]) * len(dependency_indices)
+    fill = dependent_offsets[:-1]
+    for i in range(count):
+      for k in range(dependency_offsets[i], dependency_offsets[i + 1]):
+        dependency_index = dependency_indices[k]
+        dependent_indices[fill[dependency_index]] = i
+        fill[dependency_index] += 1
+
+    # Memoized closures by node index, see DeepDependenciesWithKey and
+    # _ChainedLinkDependencies.
+    self._deep_dependencies = {}
+    self._link_dependencies = {}
+
+  def __len__(self):
+    return len(self.refs)
 
   def FlattenToList(self):
-    # flat_list is the sorted list of dependencies - actually, the list items
-    # are the "ref" attributes of DependencyGraphNodes.  Every target will
-    # appear in flat_list after all of its dependencies, and before all of its
-    # dependents.
-    flat_list = OrderedSet()
-
-    # in_degree_zeros is the list of DependencyGraphNodes that have no
-    # dependencies not in flat_list.  Initially, it is a copy of the children
-    # of this node, because when the graph was built, nodes with no
-    # dependencies were made implicit dependents of the root node.
-    in_degree_zeros = set(self.dependents[:])
+    """Returns the refs sorted so that every one appears after all of its
+    dependencies, leaving out any that are on or behind a cycle.
 
-    while in_degree_zeros:
-      # Nodes in in_degree_zeros have no dependencies not in flat_list, so they
-      # can be appended to flat_list.  Take these nodes out of in_degree_zeros
-      # as work progresses, so that the next node to process from the list can
-      # always be accessed at a consistent position.
-      node = in_degree_zeros.pop()
-      flat_list.add(node.ref)
-
-      # Look at dependents of the node just added to flat_list.  Some of them
-      # may now belong in in_degree_zeros.
-      for node_dependent in node.dependents:
-        is_in_degree_zero = True
-        # TODO: We want to check through the
-        # node_dependent.dependencies list but if it's long and we
-        # always start at the beginning, then we get O(n^2) behaviour.
-        for node_dependent_dependency in node_dependent.dependencies:
-          if not node_dependent_dependency.ref in flat_list:
-            # The dependent one or more dependencies not in flat_list.  There
-            # will be more chances to add it to flat_list when examining
-            # it again as a dependent of those other dependencies, provided
-            # that there are no cycles.
-            is_in_degree_zero = False
-            break
-
-        if is_in_degree_zero:
-          # All of the dependent's dependencies are already in flat_list.  Add
-          # it to in_degree_zeros where it will be processed in a future
-          # iteration of the outer loop.
-          in_degree_zeros.add(node_dependent)
-
-    return list(flat_list)
-
-  def FindCycles(self):
+    Refs are taken in the order they become ready, starting with those
+    without dependencies in sorted order, which keeps the result stable from
+    run to run.
     """
-    Returns a list of cycles in the graph, where each cycle is its own list.
+    dependency_offsets = self.dependency_offsets
+    dependent_offsets = self.dependent_offsets
+    dependent_indices = self.dependent_indices
+    in_degrees = array.array('i', [dependency_offsets[i + 1] -
+                                   dependency_offsets[i]
+                                   for i in range(len(self.refs))])
+    in_degree_zeros = collections.deque(
+        i for i, in_degree in enumerate(in_degrees) if in_degree == 0)
+    flat_list = []
+    while in_degree_zeros:
+      i = in_degree_zeros.popleft()
+      flat_list.append(self.refs[i])
+      for k in range(dependent_offsets[i], dependent_offsets[i + 1]):
+        dependent_index = dependent_indices[k]
+        in_degrees[dependent_index] -= 1
+        if in_degrees[dependent_index] == 0:
+          in_degree_zeros.append(dependent_index)
+    return flat_list
+
+  def StronglyConnectedComponents(self):
+    """Returns the strongly connected components of the graph as lists of
+    node indices, using an iterative version of Tarjan's algorithm.
+
+    Every node is in exactly one component.  A component comes after all of
+    the components it depends on.
     """
-    results = []
-    visited = set()
-
-    def Visit(node, path):
-      for child in node.dependents:
-        if child in path:
-          results.append([child] + path[:path.index(child) + 1])
-        elif not child in visited:
-          visited.add(child)
-          Visit(child, [child] + path)
-
-    visited.add(self)
-    Visit(self, [self])
+    dependency_offsets = self.dependency_offsets
+    dependency_indices = self.dependency_indices
+    count = len(self.refs)
+    indices = array.array('i', [-1]) * count
+    lowlinks = array.array('i', [0]) * count
+    on_stack = bytearray(count)
+    stack = []
+    components = []
+    next_index = 0
+
+    for root in range(count):
+      if indices[root] != -1:
+        continue
+      indices[root] = lowlinks[root] = next_index
+      next_index += 1
+      stack.append(root)
+      on_stack[root] = 1
+      # Each entry is a node being visited and the position in
+      # dependency_indices of the next of its dependencies to look at.
+      work = [[root, dependency_offsets[root]]]
+      while work:
+        top = work[-1]
+        node = top[0]
+        if top[1] < dependency_offsets[node + 1]:
+          dependency = dependency_indices[top[1]]
+          top[1] += 1
+          if indices[dependency] == -1:
+            indices[dependency] = lowlinks[dependency] = next_index
+            next_index += 1
+            stack.append(dependency)
+            on_stack[dependency] = 1
+            work.append([dependency, dependency_offsets[dependency]])
+          elif on_stack[dependency] and indices[dependency] < lowlinks[node]:
+            lowlinks[node] = indices[dependency]
+          continue
 
-    return results
+        work.pop()
+        if work and lowlinks[node] < lowlinks[work[-1][0]]:
+          lowlinks[work[-1][0]] = lowlinks[node]
+        if lowlinks[node] == indices[node]:
+          component = []
+          while True:
+            member = stack.pop()
+            on_stack[member] = 0
+            component.append(member)
+            if member == node:
+              break
+          components.append(component)
+
+    return components
 
-  def DirectDependencies(self, dependencies=None):
-    """Returns a list of just direct dependencies."""
-    if dependencies == None:
-      dependencies = []
+  def FindCycles(self):
+    """Returns one cycle for each strongly connected component that has one,
+    as a list of refs starting and ending with the component's first ref.
 
-    for dependency in self.dependencies:
-      # Check for None, corresponding to the root node.
-      if dependency.ref != None and dependency.ref not in dependencies:
-        dependencies.append(dependency.ref)
+    Each ref in a cycle depends on the one after it, and the cycle is one of
+    the shortest through that ref.  Cycles are sorted by their first ref.
+    """
+    dependency_offsets = self.dependency_offsets
+    dependency_indices = self.dependency_indices
+    cycles = []
+    for component in self.StronglyConnectedComponents():
+      start = min(component)
+      if len(component) == 1 and start not in dependency_indices[
+          dependency_offsets[start]:dependency_offsets[start + 1]]:
+        continue
 
+      # Breadth-first search from |start| back to itself, staying within the
+      # component.
+      members = set(component)
+      parents = {}
+      queue = collections.deque([start])
+      while queue:
+        node = queue.popleft()
+        for k in range(dependency_offsets[node], dependency_offsets[node + 1]):
+          dependency = dependency_indices[k]
+          if dependency in members and dependency not in parents:
+            parents[dependency] = node
+            queue.append(dependency)
+        if start in parents:
+          break
+
+      cycle = [start]
+      node = parents[start]
+      while node != start:
+        cycle.append(node)
+        node = parents[node]
+      cycle.append(start)
+      cycle.reverse()
+      cycles.append([self.refs[i] for i in cycle])
+
+    cycles.sort()
+    return cycles
+
+  def DirectDependencies(self, ref):
+    """Returns a list of just |ref|'s direct dependencies."""
+    dependency_indices = self.dependency_indices
+    i = self.index[ref]
+    dependencies = []
+    present = set()
+    for k in range(self.dependency_offsets[i], self.dependency_offsets[i + 1]):
+      dependency = self.refs[dependency_indices[k]]
+      if dependency not in present:
+        present.add(dependency)
+        dependencies.append(dependency)
     return dependencies
 
-  def _AddImportedDependencies(self, targets, dependencies=None):
+  def _AddImportedDependencies(self, targets, dependencies):
     """Given a list of direct dependencies, adds indirect dependencies that
     other dependencies have declared to export their settings.
 
-    This method does not operate on self.  Rather, it operates on the list
-    of dependencies in the |dependencies| argument.  For each dependency in
-    that list, if any declares that it exports the settings of one of its
+    This method does not operate on the graph.  Rather, it operates on the
+    list of dependencies in the |dependencies| argument.  For each dependency
+    in that list, if any declares that it exports the settings of one of its
     own dependencies, those dependencies whose settings are "passed through"
     are added to the list.  As new items are added to the list, they too will
     be processed, so it is possible to import settings through multiple levels
@@ -1559,10 +2585,6 @@ class DependencyGraphNode(object):
     DirectDependencies.  DirectAndImportedDependencies is intended to be the
     public entry point.
     """
-
-    if dependencies == None:
-      dependencies = []
-
     index = 0
     while index < len(dependencies):
       dependency = dependencies[index]
@@ -1583,121 +2605,192 @@ class DependencyGraphNode(object):
 
     return dependencies
 
-  def DirectAndImportedDependencies(self, targets, dependencies=None):
-    """Returns a list of a target's direct dependencies and all indirect
+  def DirectAndImportedDependencies(self, ref, targets):
+    """Returns a list of |ref|'s direct dependencies and all indirect
     dependencies that a dependency has advertised settings should be exported
     through the dependency for.
     """
+    return self._AddImportedDependencies(targets, self.DirectDependencies(ref))
 
-    dependencies = self.DirectDependencies(dependencies)
-    return self._AddImportedDependencies(targets, dependencies)
-
-  def DeepDependencies(self, dependencies=None):
-    """Returns an OrderedSet of all of a target's dependencies, recursively."""
-    if dependencies is None:
-      # Using a list to get ordered output and a set to do fast "is it
-      # already added" checks.
-      dependencies = OrderedSet()
+  def _Memoize(self, i, memo, compute, needs_dependencies):
+    """Returns memo[i], filling it in with compute(j) for node i and, first,
+    for the dependencies of every node j that needs_dependencies(j), so that
+    compute can take theirs from |memo|.
 
-    for dependency in self.dependencies:
-      # Check for None, corresponding to the root node.
-      if dependency.ref is None:
+    The dependencies are visited with an explicit stack, however deep the
+    graph is.  It must have no cycles.
+    """
+    dependency_offsets = self.dependency_offsets
+    dependency_indices = self.dependency_indices
+    if memo[i] is not None:
+      return memo[i]
+    # Each entry is a node and the position in dependency_indices of the next
+    # of its dependencies to visit, or None if it needs none.
+    stack = [[i, dependency_offsets[i] if needs_dependencies(i) else None]]
+    while stack:
+      top = stack[-1]
+      node = top[0]
+      if top[1] is not None and top[1] < dependency_offsets[node + 1]:
+        dependency = dependency_indices[top[1]]
+        top[1] += 1
+        if memo[dependency] is None:
+          stack.append([dependency, dependency_offsets[dependency]
+                        if needs_dependencies(dependency) else None])
         continue
-      if dependency.ref not in dependencies:
-        dependencies.add(dependency.ref)
-        dependency.DeepDependencies(dependencies)
-
-    return dependencies
-
-  def _LinkDependenciesInternal(self, targets, include_shared_libraries,
-                                dependencies=None, initial=True):
+      stack.pop()
+      memo[node] = compute(node)
+    return memo[i]
+
+  def DeepDependencies(self, ref):
+    """Returns a list of all of |ref|'s dependencies, recursively, in the order
+    of a depth-first walk."""
+    dependency_offsets = self.dependency_offsets
+    dependency_indices = self.dependency_indices
+    seen = bytearray(len(self.refs))
+    deep = []
+    i = self.index[ref]
+    # A stack of [next, end] ranges of dependency_indices still to visit,
+    # standing in for the recursion of a depth-first walk.
+    stack = [[dependency_offsets[i], dependency_offsets[i + 1]]]
+    while stack:
+      top = stack[-1]
+      if top[0] == top[1]:
+        stack.pop()
+        continue
+      dependency_index = dependency_indices[top[0]]
+      top[0] += 1
+      if not seen[dependency_index]:
+        seen[dependency_index] = 1
+        deep.append(self.refs[dependency_index])
+        stack.append([dependency_offsets[dependency_index],
+                      dependency_offsets[dependency_index + 1]])
+    return deep
+
+  def DeepDependenciesWithKey(self, ref, targets, key):
+    """Returns the refs among |ref|'s dependencies, recursively, whose target
+    dicts have |key|, in the order DeepDependencies lists them.
+
+    Each node's result is built from those of its dependencies and kept, so
+    every closure is computed once no matter how many dependents ask for it.
+    Only the nodes with |key| are kept, which are usually few.  A node is
+    checked for |key| when a dependent first asks, so asking in flat_list
+    order sees the keys that settings merged into earlier targets.
+    """
+    dependency_offsets = self.dependency_offsets
+    dependency_indices = self.dependency_indices
+    refs = self.refs
+    memo = self._deep_dependencies.get(key)
+    if memo is None:
+      memo = self._deep_dependencies[key] = [None] * len(refs)
+
+    def Compute(node):
+      # Everything below a dependency that's already present was added along
+      # with it, so merging the dependencies' closures in order, skipping
+      # what's present, gives the same order as a depth-first walk.
+      seen = set()
+      deep = array.array('i')
+      for k in range(dependency_offsets[node], dependency_offsets[node + 1]):
+        dependency = dependency_indices[k]
+        if dependency not in seen and key in targets[refs[dependency]]:
+          seen.add(dependency)
+          deep.append(dependency)
+        for j in memo[dependency]:
+          if j not in seen:
+            seen.add(j)
+            deep.append(j)
+      return deep
+
+    closure = self._Memoize(self.index[ref], memo, Compute, lambda node: True)
+    return [refs[j] for j in closure]
+
+  def _LinkTargetType(self, i, targets):
+    spec = targets[self.refs[i]]
+    if 'target_name' not in spec:
+      raise GypError("Missing 'target_name' field in target.")
+    if 'type' not in spec:
+      raise GypError("Missing 'type' field in target %s" % spec['target_name'])
+    return spec['type']
+
+  def _MergeLinkDependencies(self, i, memo):
+    """Returns node i followed by what the link dependency walk picks up
+    through each of its dependencies in |memo|, without duplicates."""
+    seen = set([i])
+    merged = array.array('i', [i])
+    for k in range(self.dependency_offsets[i], self.dependency_offsets[i + 1]):
+      for j in memo[self.dependency_indices[k]]:
+        if j not in seen:
+          seen.add(j)
+          merged.append(j)
+    return merged
+
+  def _LinkDependencyMemo(self, include_shared_libraries):
+    memo = self._link_dependencies.get(include_shared_libraries)
+    if memo is None:
+      memo = self._link_dependencies[include_shared_libraries] = \
+          [None] * len(self.refs)
+    return memo
+
+  def _ChainedLinkDependencies(self, i, targets, include_shared_libraries):
+    """Returns an array of the indices of the link dependencies a dependent
+    picks up through node i.
+
+    Executables and loadable modules are fully linked, so they contribute
+    nothing; neither do shared libraries unless |include_shared_libraries|.
+    Other linkable targets contribute themselves but nothing below them, since
+    their own dependencies are already linked into them.  'none' targets with
+    'dependencies_traverse' off contribute only themselves, and other
+    non-linkable targets themselves and what their dependencies contribute.
+
+    The result is memoized per |include_shared_libraries| value, the same way
+    as in DeepDependenciesWithKey.  It depends only on target types, which
+    don't change once dependent settings are being processed.
+    """
+    memo = self._LinkDependencyMemo(include_shared_libraries)
+
+    def ChainsThrough(node):
+      target_type = self._LinkTargetType(node, targets)
+      if target_type == 'none':
+        return targets[self.refs[node]].get('dependencies_traverse', True)
+      return target_type not in linkable_types
+
+    def Compute(node):
+      target_type = self._LinkTargetType(node, targets)
+      if target_type in ('executable', 'loadable_module'):
+        return array.array('i')
+      if target_type == 'shared_library' and not include_shared_libraries:
+        return array.array('i')
+      if not ChainsThrough(node):
+        return array.array('i', [node])
+      return self._MergeLinkDependencies(node, memo)
+
+    return self._Memoize(i, memo, Compute, ChainsThrough)
+
+  def _LinkDependenciesInternal(self, ref, targets, include_shared_libraries):
     """Returns an OrderedSet of dependency targets that are linked
-    into this target.
-
-    This function has a split personality, depending on the setting of
-    |initial|.  Outside callers should always leave |initial| at its default
-    setting.
+    into |ref|.
 
-    When adding a target to the list of dependencies, this function will
-    recurse into itself with |initial| set to False, to collect dependencies
-    that are linked into the linkable target for which the list is being built.
+    A target that isn't linkable has none.  A linkable target has itself,
+    followed by what each of its dependencies contributes (see
+    _ChainedLinkDependencies).
 
     If |include_shared_libraries| is False, the resulting dependencies will not
     include shared_library targets that are linked into this target.
     """
-    if dependencies is None:
-      # Using a list to get ordered output and a set to do fast "is it
-      # already added" checks.
-      dependencies = OrderedSet()
-
-    # Check for None, corresponding to the root node.
-    if self.ref is None:
-      return dependencies
-
-    # It's kind of sucky that |targets| has to be passed into this function,
-    # but that's presently the easiest way to access the target dicts so that
-    # this function can find target types.
-
-    if 'target_name' not in targets[self.ref]:
-      raise GypError("Missing 'target_name' field in target.")
-
-    if 'type' not in targets[self.ref]:
-      raise GypError("Missing 'type' field in target %s" %
-                     targets[self.ref]['target_name'])
-
-    target_type = targets[self.ref]['type']
-
-    is_linkable = target_type in linkable_types
-
-    if initial and not is_linkable:
-      # If this is the first target being examined and it's not linkable,
-      # return an empty list of link dependencies, because the link
-      # dependencies are intended to apply to the target itself (initial is
-      # True) and this target won't be linked.
-      return dependencies
-
-    # Don't traverse 'none' targets if explicitly excluded.
-    if (target_type == 'none' and
-        not targets[self.ref].get('dependencies_traverse', True)):
-      dependencies.add(self.ref)
-      return dependencies
-
-    # Executables and loadable modules are already fully and finally linked.
-    # Nothing else can be a link dependency of them, there can only be
-    # dependencies in the sense that a dependent target might run an
-    # executable or load the loadable_module.
-    if not initial and target_type in ('executable', 'loadable_module'):
-      return dependencies
-
-    # Shared libraries are already fully linked.  They should only be included
-    # in |dependencies| when adjusting static library dependencies (in order to
-    # link against the shared_library's import lib), but should not be included
-    # in |dependencies| when propagating link_settings.
-    # The |include_shared_libraries| flag controls which of these two cases we
-    # are handling.
-    if (not initial and target_type == 'shared_library' and
-        not include_shared_libraries):
-      return dependencies
-
-    # The target is linkable, add it to the list of link dependencies.
-    if self.ref not in dependencies:
-      dependencies.add(self.ref)
-      if initial or not is_linkable:
-        # If this is a subsequent target and it's linkable, don't look any
-        # further for linkable dependencies, as they'll already be linked into
-        # this target linkable.  Always look at dependencies of the initial
-        # target, and always look at dependencies of non-linkables.
-        for dependency in self.dependencies:
-          dependency._LinkDependenciesInternal(targets,
-                                               include_shared_libraries,
-                                               dependencies, False)
-
-    return dependencies
-
-  def DependenciesForLinkSettings(self, targets):
+    i = self.index[ref]
+    if self._LinkTargetType(i, targets) not in linkable_types:
+      return OrderedSet()
+    dependency_offsets = self.dependency_offsets
+    for k in range(dependency_offsets[i], dependency_offsets[i + 1]):
+      self._ChainedLinkDependencies(self.dependency_indices[k], targets,
+                                    include_shared_libraries)
+    merged = self._MergeLinkDependencies(
+        i, self._LinkDependencyMemo(include_shared_libraries))
+    return OrderedSet(self.refs[j] for j in merged)
+
+  def DependenciesForLinkSettings(self, ref, targets):
     """
     Returns a list of dependency targets whose link_settings should be merged
-    into this target.
+    into |ref|.
     """
 
     # TODO(sbaig) Currently, chrome depends on the bug that shared libraries'
@@ -1705,83 +2798,67 @@ class DependencyGraphNode(object):
     # 'allow_sharedlib_linksettings_propagation' flag is explicitly set to
     # False.  Once chrome is fixed, we can remove this flag.
     include_shared_libraries = \
-        targets[self.ref].get('allow_sharedlib_linksettings_propagation', True)
-    return self._LinkDependenciesInternal(targets, include_shared_libraries)
+        targets[ref].get('allow_sharedlib_linksettings_propagation', True)
+    return self._LinkDependenciesInternal(ref, targets,
+                                          include_shared_libraries)
 
-  def DependenciesToLinkAgainst(self, targets):
+  def DependenciesToLinkAgainst(self, ref, targets):
     """
-    Returns a list of dependency targets that are linked into this target.
+    Returns a list of dependency targets that are linked into |ref|.
     """
-    return self._LinkDependenciesInternal(targets, True)
+    return self._LinkDependenciesInternal(ref, targets, True)
 
 
-def BuildDependencyList(targets):
-  # Create a DependencyGraphNode for each target.  Put it into a dict for easy
-  # access.
-  dependency_nodes = {}
-  for target, spec in targets.items():
-    if target not in dependency_nodes:
-      dependency_nodes[target] = DependencyGraphNode(target)
+def _RaiseCircularException(dependency_graph, what):
+  cycles = []
+  for cycle in dependency_graph.FindCycles():
+    cycles.append('Cycle: %s' % ' -> '.join(cycle))
+  raise DependencyGraph.CircularException(
+      'Cycles in %s detected:\n' % what + '\n'.join(cycles))
+
 
-  # Set up the dependency links.  Targets that have no dependencies are treated
-  # as dependent on root_node.
-  root_node = DependencyGraphNode(None)
+def BuildDependencyList(targets):
+  # Collect the dependencies of each target, checking that they exist.
+  dependencies = {}
   for target, spec in targets.items():
-    target_node = dependency_nodes[target]
-    target_build_file = gyn.common.BuildFile(target)
-    dependencies = spec.get('dependencies')
-    if not dependencies:
-      target_node.dependencies = [root_node]
-      root_node.dependents.append(target_node)
-    else:
-      for dependency in dependencies:
-        dependency_node = dependency_nodes.get(dependency)
-        if not dependency_node:
-          raise GypError("Dependency '%s' not found while "
-                         "trying to load target %s" % (dependency, target))
-        target_node.dependencies.append(dependency_node)
-        dependency_node.dependents.append(target_node)
+    target_dependencies = spec.get('dependencies') or []
+    for dependency in target_dependencies:
+      if dependency not in targets:
+        raise GypError("Dependency '%s' not found while "
+                       "trying to load target %s" % (dependency, target))
+    dependencies[target] = target_dependencies
 
-  flat_list = root_node.FlattenToList()
+  dependency_graph = DependencyGraph(dependencies)
+  flat_list = dependency_graph.FlattenToList()
 
   # If there's anything left unvisited, there must be a circular dependency
   # (cycle).
   if len(flat_list) != len(targets):
-    if not root_node.dependents:
-      # If all targets have dependencies, add the first target as a dependent
-      # of root_node so that the cycle can be discovered from root_node.
-      target = list(targets.keys())[0]
-      target_node = dependency_nodes[target]
-      target_node.dependencies.append(root_node)
-      root_node.dependents.append(target_node)
-
-    cycles = []
-    for cycle in root_node.FindCycles():
-      paths = [node.ref for node in cycle]
-      cycles.append('Cycle: %s' % ' -> '.join(paths))
-    raise DependencyGraphNode.CircularException(
-        'Cycles in dependency graph detected:\n' + '\n'.join(cycles))
+    _RaiseCircularException(dependency_graph, 'dependency graph')
 
-  return [dependency_nodes, flat_list]
+  return [dependency_graph, flat_list]
 
 
 def VerifyNoGYPFileCircularDependencies(targets):
-  # Create a DependencyGraphNode for each gyp file containing a target.  Put
-  # it into a dict for easy access.
-  dependency_nodes = {}
-  for target in targets.keys():
-    build_file = gyn.common.BuildFile(target)
-    if not build_file in dependency_nodes:
-      dependency_nodes[build_file] = DependencyGraphNode(build_file)
+  # Collect the other .gyp files each gyp file containing a target depends on.
+  # Targets are named as dependencies many times over, so remember which
+  # file each one is in.
+  build_files = {}
+  dependencies = {}
+  for target in targets:
+    build_file = build_files[target] = gyn.common.BuildFile(target)
+    dependencies.setdefault(build_file, [])
 
-  # Set up the dependency links.
-  for target, spec in targets.items():
-    build_file = gyn.common.BuildFile(target)
-    build_file_node = dependency_nodes[build_file]
+  edges = set()
+  for target in sorted(targets):
+    spec = targets[target]
+    build_file = build_files[target]
     target_dependencies = spec.get('dependencies', [])
     for dependency in target_dependencies:
       try:
-        dependency_build_file = gyn.common.BuildFile(dependency)
+        dependency_build_file = build_files.get(dependency)
+        if dependency_build_file is None:
+          dependency_build_file = gyn.common.BuildFile(dependency)
       except GypError as e:
         gyn.common.ExceptionAppend(
             e, 'while computing dependencies of .gyp file %s' % build_file)
@@ -1790,41 +2867,23 @@ def VerifyNoGYPFileCircularDependencies(targets):
       if dependency_build_file == build_file:
         # A .gyp file is allowed to refer back to itself.
         continue
-      dependency_node = dependency_nodes.get(dependency_build_file)
-      if not dependency_node:
+      if dependency_build_file not in dependencies:
         raise GypError("Dependancy '%s' not found" % dependency_build_file)
-      if dependency_node not in build_file_node.dependencies:
-        build_file_node.dependencies.append(dependency_node)
-        dependency_node.dependents.append(build_file_node)
-
+      if (build_file, dependency_build_file) not in edges:
+        edges.add((build_file, dependency_build_file))
+        dependencies[build_file].append(dependency_build_file)
 
-  # Files that have no dependencies are treated as dependent on root_node.
-  root_node = DependencyGraphNode(None)
-  for build_file_node in dependency_nodes.values():
-    if len(build_file_node.dependencies) == 0:
-      build_file_node.dependencies.append(root_node)
-      root_node.dependents.append(build_file_node)
-
-  flat_list = root_node.FlattenToList()
+  dependency_graph = DependencyGraph(dependencies)
+  flat_list = dependency_graph.FlattenToList()
 
   # If there's anything left unvisited, there must be a circular dependency
   # (cycle).
-  if len(flat_list) != len(dependency_nodes):
-    if not root_node.dependents:
-      # If all files have dependencies, add the first file as a dependent
-      # of root_node so that the cycle can be discovered from root_node.
-      file_node = list(dependency_nodes.values())[0]
-      file_node.dependencies.append(root_node)
-      root_node.dependents.append(file_node)
-    cycles = []
-    for cycle in root_node.FindCycles():
-      paths = [node.ref for node in cycle]
-      cycles.append('Cycle: %s' % ' -> '.join(paths))
-    raise DependencyGraphNode.CircularException(
-        'Cycles in .gyp file dependency graph detected:\n' + '\n'.join(cycles))
+  if len(flat_list) != len(dependencies):
+    _RaiseCircularException(dependency_graph,
+                            '.gyp file dependency graph')
 
 
-def DoDependentSettings(key, flat_list, targets, dependency_nodes):
+def DoDependentSettings(key, flat_list, targets, dependency_graph):
   # key should be one of all_dependent_settings, direct_dependent_settings,
   # or link_settings.
 
@@ -1833,13 +2892,14 @@ def DoDependentSettings(key, flat_list, targets, dependency_nodes):
     build_file = gyn.common.BuildFile(target)
 
     if key == 'all_dependent_settings':
-      dependencies = dependency_nodes[target].DeepDependencies()
+      dependencies = \
+          dependency_graph.DeepDependenciesWithKey(target, targets, key)
     elif key == 'direct_dependent_settings':
       dependencies = \
-          dependency_nodes[target].DirectAndImportedDependencies(targets)
+          dependency_graph.DirectAndImportedDependencies(target, targets)
     elif key == 'link_settings':
       dependencies = \
-          dependency_nodes[target].DependenciesForLinkSettings(targets)
+          dependency_graph.DependenciesForLinkSettings(target, targets)
     else:
       raise GypError("DoDependentSettings doesn't know how to determine "
                       'dependencies for ' + key)
@@ -1853,7 +2913,7 @@ def DoDependentSettings(key, flat_list, targets, dependency_nodes):
                  build_file, dependency_build_file)
 
 
-def AdjustStaticLibraryDependencies(flat_list, targets, dependency_nodes,
+def AdjustStaticLibraryDependencies(flat_list, targets, dependency_graph,
                                     sort_dependencies):
   # Recompute target "dependencies" properties.  For each static library
   # target, remove "dependencies" entries referring to other static libraries,
@@ -1881,7 +2941,8 @@ def AdjustStaticLibraryDependencies(flat_list, targets, dependency_nodes,
       # dependency must be added to the target to keep the same dependency
       # ordering.
       dependencies = \
-          dependency_nodes[target].DirectAndImportedDependencies(targets)
+          dependency_graph.DirectAndImportedDependencies(target, targets)
+      direct_dependencies = set(target_dict['dependencies'])
       index = 0
       while index < len(dependencies):
         dependency = dependencies[index]
@@ -1892,7 +2953,7 @@ def AdjustStaticLibraryDependencies(flat_list, targets, dependency_nodes,
         if (dependency_dict['type'] == 'static_library' and \
             not dependency_dict.get('hard_dependency', False)) or \
            (dependency_dict['type'] != 'static_library' and \
-            not dependency in target_dict['dependencies']):
+            not dependency in direct_dependencies):
           # Take the dependency out of the list, and don't increment index
           # because the next dependency to analyze will shift into the index
           # formerly occupied by the one being removed.
@@ -1913,13 +2974,15 @@ def AdjustStaticLibraryDependencies(flat_list, targets, dependency_nodes,
       # present.
 
       link_dependencies = \
-          dependency_nodes[target].DependenciesToLinkAgainst(targets)
+          dependency_graph.DependenciesToLinkAgainst(target, targets)
+      present = set(target_dict.get('dependencies', []))
       for dependency in link_dependencies:
         if dependency == target:
           continue
         if not 'dependencies' in target_dict:
           target_dict['dependencies'] = []
-        if not dependency in target_dict['dependencies']:
+        if not dependency in present:
+          present.add(dependency)
           target_dict['dependencies'].append(dependency)
       # Sort the dependencies list in the order from dependents to dependencies.
       # e.g. If A and B depend on C and C depends on D, sort them in A, B, C, D.
@@ -1927,12 +2990,23 @@ def AdjustStaticLibraryDependencies(flat_list, targets, dependency_nodes,
       # dependents.
       if sort_dependencies and 'dependencies' in target_dict:
         target_dict['dependencies'] = [dep for dep in reversed(flat_list)
-                                       if dep in target_dict['dependencies']]
+                                       if dep in present]
 
 
 # Initialize this here to speed up MakePathRelative.
 exception_re = re.compile(r'''["']?[-/$<>^]''')
 
+# The path leading from one build file's directory to another's, keyed by the
+# (from, to) build file pair.  See MakePathRelative.
+cached_relative_dirs = {}
+
+# MakePathRelative results, keyed by (to_file, fro_file, item).  The same
+# dependent settings are merged into many targets, so the same items are
+# rebased over and over again.  The memo is cleared whenever it grows past
+# MAKE_PATH_RELATIVE_CACHE_SIZE entries.
+cached_relative_paths = {}
+MAKE_PATH_RELATIVE_CACHE_SIZE = 1 << 16
+
 
 def MakePathRelative(to_file, fro_file, item):
   # If item is a relative path, it's relative to the build file dict that it's
@@ -1952,36 +3026,49 @@ def MakePathRelative(to_file, fro_file, item):
   #   "/' Used when a value is quoted.  If these are present, then we
   #       check the second character instead.
   #
-  if to_file == fro_file or exception_re.match(item):
+  if to_file == fro_file:
     return item
+  key = (to_file, fro_file, item)
+  ret = cached_relative_paths.get(key)
+  if ret is not None:
+    return ret
+  if exception_re.match(item):
+    ret = item
   else:
+    files = (fro_file, to_file)
+    relative_dir = cached_relative_dirs.get(files)
+    if relative_dir is None:
+      relative_dir = gyn.common.RelativePath(os.path.dirname(fro_file),
+                                             os.path.dirname(to_file))
+      cached_relative_dirs[files] = relative_dir
+    if sys.platform == 'win32':
+      # Let os.path.join deal with drive letters.
+      path = os.path.join(relative_dir, item)
+    elif relative_dir:
+      path = relative_dir + '/' + item
+    else:
+      path = item
     # TODO(dglazkov) The backslash/forward-slash replacement at the end is a
     # temporary measure. This should really be addressed by keeping all paths
     # in POSIX until actual project generation.
-    ret = os.path.normpath(os.path.join(
-        gyn.common.RelativePath(os.path.dirname(fro_file),
-                                os.path.dirname(to_file)),
-                                item)).replace('\\', '/')
+    ret = os.path.normpath(path).replace('\\', '/')
     if item[-1] == '/':
       ret += '/'
-    return ret
+  if len(cached_relative_paths) >= MAKE_PATH_RELATIVE_CACHE_SIZE:
+    cached_relative_paths.clear()
+  cached_relative_paths[key] = ret
+  return ret
 
 def MergeLists(to, fro, to_file, fro_file, is_paths=False, append=True):
   # Python documentation recommends objects which do not support hash
   # set this value to None. Python library objects follow this rule.
   is_hashable = lambda val: val.__hash__
 
-  # If x is hashable, returns whether x is in s. Else returns whether x is in l.
-  def is_in_set_or_list(x, s, l):
-    if is_hashable(x):
-      return x in s
-    return x in l
-
-  prepend_index = 0
-
-  # Make membership testing of hashables in |to| (in particular, strings)
-  # faster.
-  hashable_to_set = set(x for x in to if is_hashable(x))
+  # Copy the items of |fro|, noting which of them are singletons.  Only
+  # strings and ints can be singletons, so singletons are always hashable.
+  items = []
+  singletons = set()
+  repeated_singletons = False
   for item in fro:
     singleton = False
     if type(item) in (str, int):
@@ -1996,6 +3083,9 @@ def MergeLists(to, fro, to_file, fro_file, is_paths=False, append=True):
         # only appear once in a list, to be enforced by the list merge append
         # or prepend.
         singleton = True
+        if to_item in singletons:
+          repeated_singletons = True
+        singletons.add(to_item)
     elif type(item) is dict:
       # Make a copy of the dictionary, continuing to look for paths to fix.
       # The other intelligent aspects of merge processing won't apply because
@@ -2014,27 +3104,40 @@ def MergeLists(to, fro, to_file, fro_file, is_paths=False, append=True):
       raise TypeError(
           'Attempt to merge list item of unsupported type ' + \
           item.__class__.__name__)
+    items.append((to_item, singleton))
 
-    if append:
-      # If appending a singleton that's already in the list, don't append.
-      # This ensures that the earliest occurrence of the item will stay put.
-      if not singleton or not is_in_set_or_list(to_item, hashable_to_set, to):
+  if append:
+    # If appending a singleton that's already in the list, don't append.
+    # This ensures that the earliest occurrence of the item will stay put.
+    if not singletons:
+      to.extend([to_item for (to_item, singleton) in items])
+      return
+    # Make membership testing of hashables in |to| (in particular, strings)
+    # faster.
+    hashable_to_set = set(x for x in to if is_hashable(x))
+    for (to_item, singleton) in items:
+      if not singleton or not to_item in hashable_to_set:
         to.append(to_item)
         if is_hashable(to_item):
           hashable_to_set.add(to_item)
-    else:
-      # If prepending a singleton that's already in the list, remove the
-      # existing instance and proceed with the prepend.  This ensures that the
-      # item appears at the earliest possible position in the list.
+  elif not repeated_singletons:
+    # If prepending a singleton that's already in the list, remove the
+    # existing instances.  This ensures that the item appears at the earliest
+    # possible position in the list.  The new items keep their order; they
+    # aren't just inserted one by one at index 0.  Only other strings and ints
+    # can be equal to a singleton, and those are all hashable.
+    kept = [x for x in to if not (is_hashable(x) and x in singletons)]
+    to[:] = [to_item for (to_item, singleton) in items]
+    to.extend(kept)
+  else:
+    # A singleton listed more than once in |fro| is removed again by its later
+    # occurrence, which shifts where the following items land.  Keep doing
+    # exactly that, one item at a time.
+    prepend_index = 0
+    for (to_item, singleton) in items:
       while singleton and to_item in to:
         to.remove(to_item)
-
-      # Don't just insert everything at index 0.  That would prepend the new
-      # items to the list in reverse order, which would be an unwelcome
-      # surprise.
       to.insert(prepend_index, to_item)
-      if is_hashable(to_item):
-        hashable_to_set.add(to_item)
       prepend_index = prepend_index + 1
 
 
@@ -2160,6 +3263,38 @@ def MergeConfigWithInheritance(new_configuration_dict, build_file,
     del new_configuration_dict['abstract']
 
 
+def _ConfigurationKeyBases(target_dict, configuration, key_suffixes,
+                           bases, visited):
+  """Adds to |bases| the suffix-less names of all keys that
+  MergeConfigWithInheritance will merge into |configuration|."""
+  if configuration in visited:
+    return
+  configuration_dict = target_dict['configurations'][configuration]
+  for parent in configuration_dict.get('inherit_from', []):
+    _ConfigurationKeyBases(target_dict, parent, key_suffixes, bases,
+                           visited + [configuration])
+  for key in configuration_dict:
+    if key[-1:] in key_suffixes:
+      bases.add(key[:-1])
+    else:
+      bases.add(key)
+
+
+def _IsShareableConfigurationList(key, value, target_dict):
+  """Returns True if the list |value| can be shared by several configurations.
+
+  Nothing after SetUpConfigurations modifies a configuration list made only of
+  plain strings, unless it still has late-late variables to expand or an
+  exclusion or regex filter operates on it.
+  """
+  if key + '!' in target_dict or key + '/' in target_dict:
+    return False
+  for item in value:
+    if type(item) is not str or '^' in item:
+      return False
+  return True
+
+
 def SetUpConfigurations(target, target_dict):
   # key_suffixes is a list of key suffixes that might appear on key names.
   # These suffixes are handled in conditional evaluations (for =, +, and ?)
@@ -2179,6 +3314,23 @@ def SetUpConfigurations(target, target_dict):
                 if not config.get('abstract')]
     target_dict['default_configuration'] = sorted(concrete)[0]
 
+  # The target-level settings every configuration inherits.  Lists that no
+  # configuration will modify are shared between the configurations instead
+  # of being copied into each of them.
+  inherited = []
+  for (key, target_val) in target_dict.items():
+    key_ext = key[-1:]
+    if key_ext in key_suffixes:
+      key_base = key[:-1]
+    else:
+      key_base = key
+    if not key_base in non_configuration_keys:
+      if type(target_val) is list:
+        shareable = _IsShareableConfigurationList(key, target_val, target_dict)
+      else:
+        shareable = type(target_val) is not dict
+      inherited.append((key, key_base, target_val, shareable))
+
   merged_configurations = {}
   configs = target_dict['configurations']
   for (configuration, old_configuration_dict) in configs.items():
@@ -2187,15 +3339,15 @@ def SetUpConfigurations(target, target_dict):
       continue
     # Configurations inherit (most) settings from the enclosing target scope.
     # Get the inheritance relationship right by making a copy of the target
-    # dict.
+    # dict, at least of the parts that merging the configuration will modify.
+    merged_bases = set()
+    _ConfigurationKeyBases(target_dict, configuration, key_suffixes,
+                           merged_bases, [])
     new_configuration_dict = {}
-    for (key, target_val) in target_dict.items():
-      key_ext = key[-1:]
-      if key_ext in key_suffixes:
-        key_base = key[:-1]
+    for (key, key_base, target_val, shareable) in inherited:
+      if shareable and not key_base in merged_bases:
+        new_configuration_dict[key] = target_val
       else:
-        key_base = key
-      if not key_base in non_configuration_keys:
         new_configuration_dict[key] = gyn.simple_copy.deepcopy(target_val)
 
     # Merge in configuration (with all its parents first).
@@ -2240,6 +3392,202 @@ def SetUpConfigurations(target, target_dict):
 
 
 
+# Patterns that can't be searched for as one branch of a combined pattern:
+# backreferences and conditionals, which would refer to the wrong group, named
+# groups, whose names could clash, and inline flags, which apply to the whole
+# pattern.
+uncombinable_filter_re = re.compile(r'\\[1-9]|\\g|\(\?P|\(\?\(|\(\?[aiLmsux]')
+
+
+class SuffixListFilter(object):
+  """A list filter for patterns that match nothing but a fixed set of
+  endings, which is quicker to test with str.endswith than with a regex.
+
+  Like the regex, it also matches those endings followed by a newline, which
+  '$' allows for.
+  """
+
+  __slots__ = ('suffixes', 'pattern_re')
+
+  def __init__(self, suffixes, pattern_re):
+    self.suffixes = tuple(suffixes) + tuple(suffix + '\n'
+                                            for suffix in suffixes)
+    self.pattern_re = pattern_re
+
+  def search(self, list_item):
+    if type(list_item) is str:
+      return list_item.endswith(self.suffixes)
+    return self.pattern_re.search(list_item)
+
+
+def _LiteralFilterText(text):
+  """Returns what |text| matches if it's a regex of nothing but literal
+  characters, or None."""
+  literal = []
+  i = 0
+  while i < len(text):
+    c = text[i]
+    if c == '\\':
+      # An escaped punctuation character stands for itself, anything else
+      # (\d, \b, \n...) is left to the regex engine.
+      if i + 1 == len(text) or text[i + 1].isalnum():
+        return None
+      literal.append(text[i + 1])
+      i += 2
+      continue
+    if c in '.^$*+?{}[]()|':
+      return None
+    literal.append(c)
+    i += 1
+  return ''.join(literal)
+
+
+def _FilterSuffixes(pattern):
+  """Returns the list of endings that |pattern| matches, if it's a suffix
+  pattern like '_win\\.cc$' or '_(linux|mac|win)\\.cc$', or None.
+
+  A suffix pattern is literal text ending in '$', which may contain one
+  group of literal alternatives.
+  """
+  if not pattern.endswith('$'):
+    return None
+  body = pattern[:-1]
+  # The '$' mustn't itself be escaped.
+  if (len(body) - len(body.rstrip('\\'))) % 2:
+    return None
+
+  group_start = body.find('(')
+  if group_start == -1:
+    suffix = _LiteralFilterText(body)
+    return suffix is not None and [suffix] or None
+
+  group_end = body.find(')', group_start)
+  if group_end == -1 or body[group_start - 1:group_start] == '\\':
+    return None
+  contents = body[group_start + 1:group_end]
+  if contents.startswith('?:'):
+    contents = contents[2:]
+  before = _LiteralFilterText(body[:group_start])
+  after = _LiteralFilterText(body[group_end + 1:])
+  if before is None or after is None:
+    return None
+  suffixes = []
+  for alternative in contents.split('|'):
+    alternative = _LiteralFilterText(alternative)
+    if alternative is None:
+      return None
+    suffixes.append(before + alternative + after)
+  return suffixes
+
+
+# Compiled list filters, keyed by the tuple of patterns they search for at
+# once, shared by every list filtered in the process.
+cached_list_filters = {}
+
+# The number of list items each filter has been tried on since the last call
+# to TakeListFilterStats, keyed like cached_list_filters.
+list_filter_evaluations = {}
+
+
+def _CompileListFilter(patterns):
+  """Returns an object whose search() method finds a match for any of
+  |patterns| in a list item."""
+  list_filter = cached_list_filters.get(patterns)
+  if list_filter is None:
+    if len(patterns) == 1:
+      pattern_re = re.compile(patterns[0])
+    else:
+      pattern_re = re.compile(
+          '|'.join('(?:%s)' % pattern for pattern in patterns))
+    suffixes = []
+    for pattern in patterns:
+      pattern_suffixes = (isinstance(pattern, str) and
+                          _FilterSuffixes(pattern))
+      if not pattern_suffixes:
+        suffixes = None
+        break
+      suffixes.extend(pattern_suffixes)
+    if suffixes:
+      list_filter = SuffixListFilter(suffixes, pattern_re)
+    else:
+      list_filter = pattern_re
+    cached_list_filters[patterns] = list_filter
+  return patterns, list_filter
+
+
+def TakeListFilterStats():
+  """Returns the list filter evaluation counts since the last call, and
+  resets them."""
+  global list_filter_evaluations
+  stats = list_filter_evaluations
+  list_filter_evaluations = {}
+  return stats
+
+
+def MergeListFilterStats(evaluations):
+  """Merges the result of TakeListFilterStats in another process into this
+  one."""
+  for patterns, count in evaluations.items():
+    list_filter_evaluations[patterns] = (
+        list_filter_evaluations.get(patterns, 0) + count)
+
+
+def ReportListFilterStats():
+  """Reports how many list items each list filter was tried on with -d
+  general."""
+  for patterns, count in sorted(list_filter_evaluations.items(),
+                                key=lambda item: item[1], reverse=True):
+    suffix = isinstance(cached_list_filters.get(patterns), SuffixListFilter)
+    gyn.DebugOutput(gyn.DEBUG_GENERAL, "List filter %s: %d evaluations%s",
+                    ' | '.join(patterns), count,
+                    suffix and ' (suffix)' or '')
+
+
+def _ListFilterGroups(name, regex_key, regex_items):
+  """Returns a list of (action_value, (patterns, list_filter)) for the filters
+  in a "/" list, where action_value is 0 to exclude and 1 to include, and
+  list_filter comes from _CompileListFilter.
+
+  Runs of filters with the same action are searched for with a single pattern
+  that matches wherever any of them would, so the list only has to be gone
+  through once per run.
+  """
+  groups = []
+  for regex_item in regex_items:
+    [action, pattern] = regex_item
+    if action == 'exclude':
+      # This item matches an exclude regex, so set its value to 0 (exclude).
+      action_value = 0
+    elif action == 'include':
+      # This item matches an include regex, so set its value to 1 (include).
+      action_value = 1
+    else:
+      # This is an action that doesn't make any sense.
+      raise ValueError('Unrecognized action ' + action + ' in ' + name + \
+                       ' key ' + regex_key)
+
+    combinable = (isinstance(pattern, str) and
+                  not uncombinable_filter_re.search(pattern))
+    if (combinable and groups and groups[-1][0] == action_value and
+        groups[-1][2]):
+      groups[-1][1].append(pattern)
+    else:
+      groups.append([action_value, [pattern], combinable])
+
+  compiled = []
+  for action_value, patterns, combinable in groups:
+    if len(patterns) > 1:
+      try:
+        compiled.append((action_value, _CompileListFilter(tuple(patterns))))
+        continue
+      except re.error:
+        # Let the pattern at fault raise its own error below.
+        pass
+    for pattern in patterns:
+      compiled.append((action_value, _CompileListFilter((pattern,))))
+  return compiled
+
+
 def ProcessListFiltersInDict(name, the_dict):
   """Process regular expression and exclusion-based filters on lists.
 
@@ -2320,42 +3668,45 @@ def ProcessListFiltersInDict(name, the_dict):
 
     exclude_key = list_key + '!'
     if exclude_key in the_dict:
-      for exclude_item in the_dict[exclude_key]:
-        for index in range(0, len(the_list)):
-          if exclude_item == the_list[index]:
-            # This item matches the exclude_item, so set its action to 0
-            # (exclude).
-            list_actions[index] = 0
+      # Look items up in a set where possible.  Lists and dicts can't go in
+      # one, so those are compared with each exclude_item instead.
+      exclude_items = the_dict[exclude_key]
+      exclude_set = set()
+      for exclude_item in exclude_items:
+        try:
+          exclude_set.add(exclude_item)
+        except TypeError:
+          pass
+      for index, list_item in enumerate(the_list):
+        try:
+          excluded = list_item in exclude_set
+        except TypeError:
+          excluded = list_item in exclude_items
+        if excluded:
+          # This item matches an exclude_item, so set its action to 0
+          # (exclude).
+          list_actions[index] = 0
 
       # The "whatever!" list is no longer needed, dump it.
       del the_dict[exclude_key]
 
     regex_key = list_key + '/'
     if regex_key in the_dict:
-      for regex_item in the_dict[regex_key]:
-        [action, pattern] = regex_item
-        pattern_re = re.compile(pattern)
-
-        if action == 'exclude':
-          # This item matches an exclude regex, so set its value to 0 (exclude).
-          action_value = 0
-        elif action == 'include':
-          # This item matches an include regex, so set its value to 1 (include).
-          action_value = 1
-        else:
-          # This is an action that doesn't make any sense.
-          raise ValueError('Unrecognized action ' + action + ' in ' + name + \
-                           ' key ' + regex_key)
-
+      for action_value, (patterns, pattern_re) in _ListFilterGroups(
+          name, regex_key, the_dict[regex_key]):
+        evaluations = 0
         for index in range(0, len(the_list)):
           list_item = the_list[index]
           if list_actions[index] == action_value:
             # Even if the regex matches, nothing will change so continue (regex
             # searches are expensive).
             continue
+          evaluations += 1
           if pattern_re.search(list_item):
             # Regular expression match.
             list_actions[index] = action_value
+        list_filter_evaluations[patterns] = (
+            list_filter_evaluations.get(patterns, 0) + evaluations)
 
       # The "whatever/" list is no longer needed, dump it.
       del the_dict[regex_key]
@@ -2372,18 +3723,18 @@ def ProcessListFiltersInDict(name, the_dict):
                      ' must not be present prior '
                      ' to applying exclusion/regex filters for ' + list_key)
 
+    # Dump anything with action 0 (exclude).  Keep anything with action 1
+    # (include) or -1 (no include or exclude seen for the item).  The list is
+    # rebuilt in place, so that anything else referring to it sees the result.
+    kept_list = []
     excluded_list = []
-
-    # Go backwards through the list_actions list so that as items are deleted,
-    # the indices of items that haven't been seen yet don't shift.  That means
-    # that things need to be prepended to excluded_list to maintain them in the
-    # same order that they existed in the_list.
-    for index in range(len(list_actions) - 1, -1, -1):
-      if list_actions[index] == 0:
-        # Dump anything with action 0 (exclude).  Keep anything with action 1
-        # (include) or -1 (no include or exclude seen for the item).
-        excluded_list.insert(0, the_list[index])
-        del the_list[index]
+    for list_item, list_action in zip(the_list, list_actions):
+      if list_action == 0:
+        excluded_list.append(list_item)
+      else:
+        kept_list.append(list_item)
+    if excluded_list:
+      the_list[:] = kept_list
 
     # If anything was excluded, put the excluded list into the_dict at
     # excluded_key.
@@ -2555,6 +3906,23 @@ def TurnIntIntoStrInDict(the_dict):
       the_dict[str(k)] = v
 
 
+def TurnIntIntoStrInBuildFiles(data):
+  """Does what TurnIntIntoStrInDict(data) would, but leaves out the target
+  dicts of the target build files.
+  """
+  target_build_files = data['target_build_files']
+  for build_file, build_file_data in data.items():
+    if type(build_file_data) is not dict:
+      continue
+    if build_file in target_build_files and 'targets' in build_file_data:
+      build_file_targets = build_file_data['targets']
+      build_file_data['targets'] = []
+      TurnIntIntoStrInDict(build_file_data)
+      build_file_data['targets'] = build_file_targets
+    else:
+      TurnIntIntoStrInDict(build_file_data)
+
+
 def TurnIntIntoStrInList(the_list):
   """Given list the_list, recursively converts all integers into strings.
   """
@@ -2568,7 +3936,7 @@ def TurnIntIntoStrInList(the_list):
       TurnIntIntoStrInList(item)
 
 
-def PruneUnwantedTargets(targets, flat_list, dependency_nodes, root_targets,
+def PruneUnwantedTargets(targets, flat_list, dependency_graph, root_targets,
                          data):
   """Return only the targets that are deep dependencies of |root_targets|."""
   qualified_root_targets = []
@@ -2582,7 +3950,7 @@ def PruneUnwantedTargets(targets, flat_list, dependency_nodes, root_targets,
   wanted_targets = {}
   for target in qualified_root_targets:
     wanted_targets[target] = targets[target]
-    for dependency in dependency_nodes[target].DeepDependencies():
+    for dependency in dependency_graph.DeepDependencies(target):
       wanted_targets[dependency] = targets[dependency]
 
   wanted_flat_list = [t for t in flat_list if t in wanted_targets]
@@ -2630,6 +3998,210 @@ def VerifyNoCollidingTargets(targets):
     used[key] = gyp
 
 
+def ExpandLateTarget(target, target_dict, variables, extra_sources_for_rules):
+  # Apply "post"/"late"/"target" variable expansions and condition evaluations.
+  build_file = gyn.common.BuildFile(target)
+  ProcessVariablesAndConditionsInDict(
+      target_dict, PHASE_LATE, variables, build_file)
+
+
+def SetUpTargetConfigurations(target, target_dict, variables,
+                              extra_sources_for_rules):
+  # Move everything that can go into a "configurations" section into one.
+  SetUpConfigurations(target, target_dict)
+
+
+def FilterTargetLists(target, target_dict, variables, extra_sources_for_rules):
+  # Apply exclude (!) and regex (/) list filters.
+  ProcessListFiltersInDict(target, target_dict)
+
+
+def ExpandLateLateTarget(target, target_dict, variables,
+                         extra_sources_for_rules):
+  # Apply "latelate" variable expansions and condition evaluations.
+  build_file = gyn.common.BuildFile(target)
+  ProcessVariablesAndConditionsInDict(
+      target_dict, PHASE_LATELATE, variables, build_file)
+
+
+def ValidateTarget(target, target_dict, variables, extra_sources_for_rules):
+  # Make sure that the rules make sense, and build up rule_sources lists as
+  # needed.  Not all generators will need to use the rule_sources lists, but
+  # some may, and it seems best to build the list in a common spot.
+  # Also validate actions and run_as elements in targets.
+  build_file = gyn.common.BuildFile(target)
+  ValidateTargetType(target, target_dict)
+  ValidateRulesInTarget(target, target_dict, extra_sources_for_rules)
+  ValidateRunAsInTarget(target, target_dict, build_file)
+  ValidateActionsInTarget(target, target_dict, build_file)
+
+
+def StringifyTarget(target, target_dict, variables, extra_sources_for_rules):
+  # Generators might not expect ints.  Turn them into strs.
+  TurnIntIntoStrInDict(target_dict)
+
+
+# The processing each target goes through once dependent settings are done, in
+# order.  Every stage only looks at the target it's given, so targets can be
+# processed independently of each other.
+late_target_stages = [
+  ExpandLateTarget,
+  SetUpTargetConfigurations,
+  FilterTargetLists,
+  ExpandLateLateTarget,
+  ValidateTarget,
+  StringifyTarget,
+]
+
+# Below this many targets, the late stages are cheaper to run in the main
+# process than to ship the targets to the workers and back.
+PARALLEL_LATE_MIN_TARGETS = 256
+
+# The number of shards per worker.  More shards even out the load between
+# workers at the cost of more tasks.
+PARALLEL_LATE_SHARDS_PER_JOB = 4
+
+
+def ProcessTargetsLate(targets, variables, extra_sources_for_rules):
+  """Runs late_target_stages on each of a list of (position, target,
+  target_dict) tuples, sorted by position.
+
+  Each target goes through every stage before the next one is started, so
+  that a target dict is only walked while it's still in the CPU caches.  The
+  error reported is still the one for the first stage that fails, and the
+  first target within that stage, as if the stages ran one at a time over
+  all of the targets: once a target fails, the targets after it only go
+  through the stages before the one that failed.
+
+  Returns (processed, error, timings), where processed is a list of
+  (position, target_dict) for the targets that made it through every stage,
+  error is None or (stage_index, position, exception), and timings is the
+  time spent in each stage.
+  """
+  processed = []
+  error = None
+  timings = [0.0] * len(late_target_stages)
+  stage_limit = len(late_target_stages)
+  for position, target, target_dict in targets:
+    for stage_index in range(stage_limit):
+      start = time.time()
+      try:
+        late_target_stages[stage_index](target, target_dict, variables,
+                                        extra_sources_for_rules)
+      except Exception as e:
+        error = (stage_index, position, e)
+        stage_limit = stage_index
+        break
+      finally:
+        timings[stage_index] += time.time() - start
+    else:
+      processed.append((position, target_dict))
+  return processed, error, timings
+
+
+def ReportLateStageTimings(timings):
+  for stage, timing in zip(late_target_stages, timings):
+    gyn.DebugOutput(gyn.DEBUG_GENERAL, "Late stage %s: %.3fs", stage.__name__,
+                    timing)
+
+
+def CallProcessTargetsLate(shard, extra_sources_for_rules):
+  """Wrapper around ProcessTargetsLate for the workers of the parallel loader.
+
+  |shard| is a list of (position, target, payload) tuples, where the payload
+  is the target dict encoded by EncodeParallelPayload.
+  """
+  (variables, includes, depth, check, compress) = per_process_load_args
+  targets = [(position, target, DecodeParallelPayload(payload))
+             for position, target, payload in shard]
+  processed, error, timings = ProcessTargetsLate(targets, variables,
+                                                 extra_sources_for_rules)
+  if error:
+    # Not every exception survives pickling with its message intact, so send
+    # GypErrors as they are and anything else as a GypError with the message
+    # and traceback it would have printed.
+    (stage_index, position, e) = error
+    if not isinstance(e, GypError):
+      e = GypError('%s: %s\n%s' % (type(e).__name__, e,
+                                    traceback.format_exc()))
+    error = (stage_index, position, e)
+  return (EncodeParallelPayload(
+              (processed, timings, TakeConditionCacheStats(),
+               TakeCommandStats(), TakeListFilterStats()),
+              compress),
+          error)
+
+
+def _ShardTargets(targets, count):
+  """Splits a list of (position, target, payload) tuples into |count| shards
+  of about the same total payload size.
+
+  Targets are placed largest first, each on the lightest shard so far, which
+  is never more than a third or so worse than the best possible split.  Each
+  shard is sorted by position.
+  """
+  heap = [(0, i, []) for i in range(count)]
+  for item in sorted(targets, key=lambda item: -len(item[2])):
+    (size, i, shard) = heapq.heappop(heap)
+    shard.append(item)
+    heapq.heappush(heap, (size + len(item[2]), i, shard))
+  return [sorted(shard) for (size, i, shard) in sorted(heap, key=lambda x: x[1])
+          if shard]
+
+
+def ProcessTargetsLateParallel(pool, jobs, flat_list, targets,
+                               extra_sources_for_rules):
+  """Runs late_target_stages over flat_list on the workers of |pool|.
+
+  The target dicts are updated in place, in flat_list order, so the dicts in
+  |targets| and in the build file data stay the same objects.  The error
+  raised, if any, is the one ProcessTargetsLate would have reported for the
+  whole of flat_list.  Returns the time spent in each stage, summed over the
+  workers.
+  """
+  compress = bool(os.environ.get('GYP_PARALLEL_COMPRESS'))
+  encoded = [(position, target, EncodeParallelPayload(targets[target],
+                                                      compress))
+             for position, target in enumerate(flat_list)]
+  shards = _ShardTargets(encoded, jobs * PARALLEL_LATE_SHARDS_PER_JOB)
+  del encoded
+
+  results = pool.map(
+      functools.partial(CallProcessTargetsLate,
+                        extra_sources_for_rules=extra_sources_for_rules),
+      shards, chunksize=1)
+
+  processed = [None] * len(flat_list)
+  errors = []
+  timings = [0.0] * len(late_target_stages)
+  bytes_received = 0
+  for payload, error in results:
+    bytes_received += len(payload)
+    (shard_processed, shard_timings, condition_cache_stats, command_stats,
+     list_filter_stats) = DecodeParallelPayload(payload)
+    timings = [a + b for a, b in zip(timings, shard_timings)]
+    MergeConditionCacheStats(*condition_cache_stats)
+    MergeCommandStats(*command_stats)
+    MergeListFilterStats(list_filter_stats)
+    for position, target_dict in shard_processed:
+      processed[position] = target_dict
+    if error:
+      errors.append(error)
+  if errors:
+    raise min(errors, key=lambda error: error[:2])[2]
+
+  for position, target in enumerate(flat_list):
+    target_dict = targets[target]
+    target_dict.clear()
+    target_dict.update(processed[position])
+
+  gyn.DebugOutput(gyn.DEBUG_GENERAL,
+                  "Parallel late processing: %d targets in %d shards on %d "
+                  "workers, %d bytes received", len(flat_list), len(shards),
+                  jobs, bytes_received)
+  return timings
+
+
 def SetGeneratorGlobals(generator_input_info):
   # Set up path_sections and non_configuration_keys with the default data plus
   # the generator-specific data.
@@ -2648,10 +4220,19 @@ def SetGeneratorGlobals(generator_input_info):
   global generator_filelist_paths
   generator_filelist_paths = generator_input_info['generator_filelist_paths']
 
+  global build_file_cache_dir
+  build_file_cache_dir = generator_input_info.get('build_file_cache_dir')
+
+  global command_cache_path
+  command_cache_path = generator_input_info.get('command_cache_path')
+
 
 def Load(build_files, variables, includes, depth, generator_input_info, check,
-         circular_check, parallel, root_targets):
+         circular_check, parallel, root_targets, jobs=None):
   SetGeneratorGlobals(generator_input_info)
+  LoadConditionCache()
+  LoadCommandCache()
+  PreloadPymodDoMainModules()
   # A generator can have other lists (in addition to sources) be processed
   # for rules.
   extra_sources_for_rules = generator_input_info['extra_sources_for_rules']
@@ -2667,9 +4248,11 @@ def Load(build_files, variables, includes, depth, generator_input_info, check,
   # Normalize paths everywhere.  This is important because paths will be
   # used as keys to the data dict and for references between input files.
   build_files = set(map(os.path.normpath, build_files))
+  pool = None
   if parallel:
-    LoadTargetBuildFilesParallel(build_files, data, variables, includes, depth,
-                                 check, generator_input_info)
+    pool = LoadTargetBuildFilesParallel(build_files, data, variables, includes,
+                                        depth, check, generator_input_info,
+                                        GetJobs(jobs))
   else:
     aux_data = {}
     for build_file in build_files:
@@ -2680,114 +4263,114 @@ def Load(build_files, variables, includes, depth, generator_input_info, check,
         gyn.common.ExceptionAppend(e, 'while trying to load %s' % build_file)
         raise
 
-  # Build a dict to access each target's subdict by qualified name.
-  targets = BuildTargetsDict(data)
-
-  # Fully qualify all dependency links.
-  QualifyDependencies(targets)
-
-  # Remove self-dependencies from targets that have 'prune_self_dependencies'
-  # set to 1.
-  RemoveSelfDependencies(targets)
-
-  # Expand dependencies specified as build_file:*.
-  ExpandWildcardDependencies(targets, data)
-
-  # Remove all dependencies marked as 'link_dependency' from the targets of
-  # type 'none'.
-  RemoveLinkDependenciesFromNoneTargets(targets)
-
-  # Apply exclude (!) and regex (/) list filters only for dependency_sections.
-  for target_name, target_dict in targets.items():
-    tmp_dict = {}
-    for key_base in dependency_sections:
-      for op in ('', '!', '/'):
-        key = key_base + op
-        if key in target_dict:
-          tmp_dict[key] = target_dict[key]
-          del target_dict[key]
-    ProcessListFiltersInDict(target_name, tmp_dict)
-    # Write the results back to |target_dict|.
-    for key in tmp_dict:
-      target_dict[key] = tmp_dict[key]
-
-  # Make sure every dependency appears at most once.
-  RemoveDuplicateDependencies(targets)
-
-  if circular_check:
-    # Make sure that any targets in a.gyp don't contain dependencies in other
-    # .gyp files that further depend on a.gyn.
-    VerifyNoGYPFileCircularDependencies(targets)
-
-  [dependency_nodes, flat_list] = BuildDependencyList(targets)
-
-  if root_targets:
-    # Remove, from |targets| and |flat_list|, the targets that are not deep
-    # dependencies of the targets specified in |root_targets|.
-    targets, flat_list = PruneUnwantedTargets(
-        targets, flat_list, dependency_nodes, root_targets, data)
-
-  # Check that no two targets in the same directory have the same name.
-  VerifyNoCollidingTargets(flat_list)
-
-  # Handle dependent settings of various types.
-  for settings_type in ['all_dependent_settings',
-                        'direct_dependent_settings',
-                        'link_settings']:
-    DoDependentSettings(settings_type, flat_list, targets, dependency_nodes)
-
-    # Take out the dependent settings now that they've been published to all
-    # of the targets that require them.
-    for target in flat_list:
-      if settings_type in targets[target]:
-        del targets[target][settings_type]
-
-  # Make sure static libraries don't declare dependencies on other static
-  # libraries, but that linkables depend on all unlinked static libraries
-  # that they need so that their link steps will be correct.
-  gii = generator_input_info
-  if gii['generator_wants_static_library_dependencies_adjusted']:
-    AdjustStaticLibraryDependencies(flat_list, targets, dependency_nodes,
-                                    gii['generator_wants_sorted_dependencies'])
-
-  # Apply "post"/"late"/"target" variable expansions and condition evaluations.
-  for target in flat_list:
-    target_dict = targets[target]
-    build_file = gyn.common.BuildFile(target)
-    ProcessVariablesAndConditionsInDict(
-        target_dict, PHASE_LATE, variables, build_file)
-
-  # Move everything that can go into a "configurations" section into one.
-  for target in flat_list:
-    target_dict = targets[target]
-    SetUpConfigurations(target, target_dict)
-
-  # Apply exclude (!) and regex (/) list filters.
-  for target in flat_list:
-    target_dict = targets[target]
-    ProcessListFiltersInDict(target, target_dict)
-
-  # Apply "latelate" variable expansions and condition evaluations.
-  for target in flat_list:
-    target_dict = targets[target]
-    build_file = gyn.common.BuildFile(target)
-    ProcessVariablesAndConditionsInDict(
-        target_dict, PHASE_LATELATE, variables, build_file)
+  # The loader's pool is reused by the late stages below; make sure it is
+  # shut down if any of the steps in between fails.
+  try:
+    # Build a dict to access each target's subdict by qualified name.
+    targets = BuildTargetsDict(data)
+
+    # Fully qualify all dependency links.
+    QualifyDependencies(targets)
+
+    # Remove self-dependencies from targets that have 'prune_self_dependencies'
+    # set to 1.
+    RemoveSelfDependencies(targets)
+
+    # Expand dependencies specified as build_file:*.
+    ExpandWildcardDependencies(targets, data)
+
+    # Remove all dependencies marked as 'link_dependency' from the targets of
+    # type 'none'.
+    RemoveLinkDependenciesFromNoneTargets(targets)
+
+    # Apply exclude (!) and regex (/) list filters only for dependency_sections.
+    for target_name, target_dict in targets.items():
+      tmp_dict = {}
+      for key_base in dependency_sections:
+        for op in ('', '!', '/'):
+          key = key_base + op
+          if key in target_dict:
+            tmp_dict[key] = target_dict[key]
+            del target_dict[key]
+      ProcessListFiltersInDict(target_name, tmp_dict)
+      # Write the results back to |target_dict|.
+      for key in tmp_dict:
+        target_dict[key] = tmp_dict[key]
+
+    # Make sure every dependency appears at most once.
+    RemoveDuplicateDependencies(targets)
+
+    if circular_check:
+      # Make sure that any targets in a.gyp don't contain dependencies in other
+      # .gyp files that further depend on a.gyn.
+      VerifyNoGYPFileCircularDependencies(targets)
+
+    [dependency_graph, flat_list] = BuildDependencyList(targets)
+
+    if root_targets:
+      # Remove, from |targets| and |flat_list|, the targets that are not deep
+      # dependencies of the targets specified in |root_targets|.
+      targets, flat_list = PruneUnwantedTargets(
+          targets, flat_list, dependency_graph, root_targets, data)
+
+    # Check that no two targets in the same directory have the same name.
+    VerifyNoCollidingTargets(flat_list)
+
+    # Handle dependent settings of various types.
+    for settings_type in ['all_dependent_settings',
+                          'direct_dependent_settings',
+                          'link_settings']:
+      DoDependentSettings(settings_type, flat_list, targets, dependency_graph)
+
+      # Take out the dependent settings now that they've been published to all
+      # of the targets that require them.
+      for target in flat_list:
+        if settings_type in targets[target]:
+          del targets[target][settings_type]
+
+    # Make sure static libraries don't declare dependencies on other static
+    # libraries, but that linkables depend on all unlinked static libraries
+    # that they need so that their link steps will be correct.
+    gii = generator_input_info
+    if gii['generator_wants_static_library_dependencies_adjusted']:
+      AdjustStaticLibraryDependencies(
+          flat_list, targets, dependency_graph,
+          gii['generator_wants_sorted_dependencies'])
+
+    # Run the rest of the per-target processing, on the workers if it's worth
+    # it.  A single worker would only add the cost of the round trip.
+    if (pool and GetJobs(jobs) > 1 and
+        len(flat_list) >= PARALLEL_LATE_MIN_TARGETS):
+      timings = ProcessTargetsLateParallel(pool, GetJobs(jobs), flat_list,
+                                           targets, extra_sources_for_rules)
+    else:
+      processed, error, timings = ProcessTargetsLate(
+          [(position, target, targets[target])
+           for position, target in enumerate(flat_list)],
+          variables, extra_sources_for_rules)
+      if error:
+        raise error[2]
+    ReportLateStageTimings(timings)
+
+    # Generators might not expect ints.  Turn them into strs.  The targets have
+    # already been done by StringifyTarget.
+    TurnIntIntoStrInBuildFiles(data)
+  except:
+    if pool:
+      pool.terminate()
+      pool.join()
+    raise
 
-  # Make sure that the rules make sense, and build up rule_sources lists as
-  # needed.  Not all generators will need to use the rule_sources lists, but
-  # some may, and it seems best to build the list in a common spot.
-  # Also validate actions and run_as elements in targets.
-  for target in flat_list:
-    target_dict = targets[target]
-    build_file = gyn.common.BuildFile(target)
-    ValidateTargetType(target, target_dict)
-    ValidateRulesInTarget(target, target_dict, extra_sources_for_rules)
-    ValidateRunAsInTarget(target, target_dict, build_file)
-    ValidateActionsInTarget(target, target_dict, build_file)
+  if pool:
+    pool.close()
+    pool.join()
 
-  # Generators might not expect ints.  Turn them into strs.
-  TurnIntIntoStrInDict(data)
+  gyn.DebugOutput(gyn.DEBUG_GENERAL, "Condition cache: %d hits, %d misses",
+                  condition_cache_hits, condition_cache_misses)
+  SaveConditionCache()
+  ReportCommandTimings()
+  SaveCommandCache()
+  ReportListFilterStats()
 
   # TODO(mark): Return |data| for now because the generator needs a list of
   # build files that came in.  In the future, maybe it should just accept
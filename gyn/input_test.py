@@ -6,83 +6,766 @@
 
 """Unit tests for the input.py file."""
 
+import gyn.common
 import gyn.input
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 
 
 class TestFindCycles(unittest.TestCase):
-  def setUp(self):
-    self.nodes = {}
+  def _find_cycles(self, dependencies):
     for x in ('a', 'b', 'c', 'd', 'e'):
-      self.nodes[x] = gyn.input.DependencyGraphNode(x)
-
-  def _create_dependency(self, dependent, dependency):
-    dependent.dependencies.append(dependency)
-    dependency.dependents.append(dependent)
+      dependencies.setdefault(x, [])
+    return gyn.input.DependencyGraph(dependencies).FindCycles()
 
   def test_no_cycle_empty_graph(self):
-    for label, node in self.nodes.items():
-      self.assertEqual([], node.FindCycles())
+    self.assertEqual([], self._find_cycles({}))
 
   def test_no_cycle_line(self):
-    self._create_dependency(self.nodes['a'], self.nodes['b'])
-    self._create_dependency(self.nodes['b'], self.nodes['c'])
-    self._create_dependency(self.nodes['c'], self.nodes['d'])
-
-    for label, node in self.nodes.items():
-      self.assertEqual([], node.FindCycles())
+    self.assertEqual([], self._find_cycles({'a': ['b'], 'b': ['c'],
+                                            'c': ['d']}))
 
   def test_no_cycle_dag(self):
-    self._create_dependency(self.nodes['a'], self.nodes['b'])
-    self._create_dependency(self.nodes['a'], self.nodes['c'])
-    self._create_dependency(self.nodes['b'], self.nodes['c'])
-
-    for label, node in self.nodes.items():
-      self.assertEqual([], node.FindCycles())
+    self.assertEqual([], self._find_cycles({'a': ['b', 'c'], 'b': ['c']}))
 
   def test_cycle_self_reference(self):
-    self._create_dependency(self.nodes['a'], self.nodes['a'])
-
-    self.assertEqual([[self.nodes['a'], self.nodes['a']]],
-                      self.nodes['a'].FindCycles())
+    self.assertEqual([['a', 'a']], self._find_cycles({'a': ['a']}))
 
   def test_cycle_two_nodes(self):
-    self._create_dependency(self.nodes['a'], self.nodes['b'])
-    self._create_dependency(self.nodes['b'], self.nodes['a'])
-
-    self.assertEqual([[self.nodes['a'], self.nodes['b'], self.nodes['a']]],
-                      self.nodes['a'].FindCycles())
-    self.assertEqual([[self.nodes['b'], self.nodes['a'], self.nodes['b']]],
-                      self.nodes['b'].FindCycles())
+    self.assertEqual([['a', 'b', 'a']], self._find_cycles({'a': ['b'],
+                                                           'b': ['a']}))
 
   def test_two_cycles(self):
-    self._create_dependency(self.nodes['a'], self.nodes['b'])
-    self._create_dependency(self.nodes['b'], self.nodes['a'])
+    # Cycles that share a node are reported once, through the first ref of
+    # the strongly connected component they form.
+    self.assertEqual([['a', 'b', 'a']],
+                     self._find_cycles({'a': ['b'], 'b': ['a', 'c'],
+                                        'c': ['b']}))
+    self.assertEqual([['a', 'b', 'a'], ['c', 'd', 'c']],
+                     self._find_cycles({'a': ['b'], 'b': ['a', 'c'],
+                                        'c': ['d'], 'd': ['c']}))
 
-    self._create_dependency(self.nodes['b'], self.nodes['c'])
-    self._create_dependency(self.nodes['c'], self.nodes['b'])
+  def test_big_cycle(self):
+    self.assertEqual([['a', 'b', 'c', 'd', 'e', 'a']],
+                     self._find_cycles({'a': ['b'], 'b': ['c'], 'c': ['d'],
+                                        'd': ['e'], 'e': ['a']}))
 
-    cycles = self.nodes['a'].FindCycles()
-    self.assertTrue(
-       [self.nodes['a'], self.nodes['b'], self.nodes['a']] in cycles)
-    self.assertTrue(
-       [self.nodes['b'], self.nodes['c'], self.nodes['b']] in cycles)
-    self.assertEqual(2, len(cycles))
 
-  def test_big_cycle(self):
-    self._create_dependency(self.nodes['a'], self.nodes['b'])
-    self._create_dependency(self.nodes['b'], self.nodes['c'])
-    self._create_dependency(self.nodes['c'], self.nodes['d'])
-    self._create_dependency(self.nodes['d'], self.nodes['e'])
-    self._create_dependency(self.nodes['e'], self.nodes['a'])
-
-    self.assertEqual([[self.nodes['a'],
-                        self.nodes['b'],
-                        self.nodes['c'],
-                        self.nodes['d'],
-                        self.nodes['e'],
-                        self.nodes['a']]],
-                      self.nodes['a'].FindCycles())
+class TestFlattenToList(unittest.TestCase):
+  def _flatten(self, dependencies):
+    for x in ('a', 'b', 'c', 'd', 'e'):
+      dependencies.setdefault(x, [])
+    return gyn.input.DependencyGraph(dependencies).FlattenToList()
+
+  def test_dependencies_come_first(self):
+    self.assertEqual(['d', 'c', 'b', 'a', 'e'],
+                     self._flatten({'a': ['b', 'c'], 'b': ['c'], 'c': ['d'],
+                                    'e': ['a']}))
+
+  def test_stable_order(self):
+    self.assertEqual(['a', 'b', 'd', 'c', 'e'],
+                     self._flatten({'c': ['a', 'b'], 'e': ['d']}))
+
+  def test_cycle_is_left_out(self):
+    self.assertEqual(['d', 'e'],
+                     self._flatten({'a': ['b'], 'b': ['a'], 'c': ['a']}))
+
+
+def _DeepDependencies(graph, ref, dependencies):
+  """The recursive walk DependencyGraph.DeepDependencies is checked
+  against.  |graph| maps each ref to the refs it depends on."""
+  for dependency in graph[ref]:
+    if dependency not in dependencies:
+      dependencies.add(dependency)
+      _DeepDependencies(graph, dependency, dependencies)
+  return dependencies
+
+
+def _LinkDependencies(graph, ref, targets, include_shared_libraries,
+                      dependencies, initial=True):
+  """The recursive walk DependencyGraph._LinkDependenciesInternal is checked
+  against."""
+  target_type = targets[ref]['type']
+  is_linkable = target_type in gyn.input.linkable_types
+  if initial and not is_linkable:
+    return dependencies
+  if (target_type == 'none' and
+      not targets[ref].get('dependencies_traverse', True)):
+    dependencies.add(ref)
+    return dependencies
+  if not initial and target_type in ('executable', 'loadable_module'):
+    return dependencies
+  if (not initial and target_type == 'shared_library' and
+      not include_shared_libraries):
+    return dependencies
+  if ref not in dependencies:
+    dependencies.add(ref)
+    if initial or not is_linkable:
+      for dependency in graph[ref]:
+        _LinkDependencies(graph, dependency, targets,
+                          include_shared_libraries, dependencies, False)
+  return dependencies
+
+
+class TestDependencyClosures(unittest.TestCase):
+  def setUp(self):
+    # A random DAG of targets of mixed types; each target only depends on
+    # targets created before it.
+    rand = random.Random(4)
+    types = ['static_library', 'shared_library', 'executable',
+             'loadable_module', 'none']
+    self.targets = {}
+    self.dependencies = {}
+    self.names = []
+    for i in range(200):
+      name = 't%d' % i
+      self.targets[name] = {'target_name': name, 'type': rand.choice(types)}
+      if rand.random() < 0.1:
+        self.targets[name]['dependencies_traverse'] = 0
+      self.dependencies[name] = [
+          self.names[j]
+          for j in sorted(set(rand.randrange(i) for _ in range(min(i, 4))))]
+      self.names.append(name)
+
+  def test_deep_dependencies(self):
+    graph = gyn.input.DependencyGraph(self.dependencies)
+    for name in self.names:
+      expected = list(_DeepDependencies(self.dependencies, name,
+                                        gyn.common.OrderedSet()))
+      self.assertEqual(expected, graph.DeepDependencies(name))
+
+  def test_deep_dependencies_with_key(self):
+    for name in self.names[::3]:
+      self.targets[name]['all_dependent_settings'] = {}
+    graph = gyn.input.DependencyGraph(self.dependencies)
+    for name in self.names:
+      expected = [dependency for dependency in _DeepDependencies(
+                      self.dependencies, name, gyn.common.OrderedSet())
+                  if 'all_dependent_settings' in self.targets[dependency]]
+      self.assertEqual(expected, graph.DeepDependenciesWithKey(
+          name, self.targets, 'all_dependent_settings'))
+
+  def test_link_dependencies(self):
+    for include_shared_libraries in (True, False):
+      graph = gyn.input.DependencyGraph(self.dependencies)
+      for name in reversed(self.names):
+        expected = list(_LinkDependencies(
+            self.dependencies, name, self.targets, include_shared_libraries,
+            gyn.common.OrderedSet()))
+        self.assertEqual(expected, list(graph._LinkDependenciesInternal(
+            name, self.targets, include_shared_libraries)))
+
+  def test_deep_chain(self):
+    # Long enough to overflow the stack of a recursive walk.
+    count = 1500
+    dependencies = dict(('t%05d' % i, ['t%05d' % (i + 1)])
+                        for i in range(count - 1))
+    dependencies['t%05d' % (count - 1)] = []
+    targets = dict((ref, {'target_name': ref, 'type': 'none'})
+                   for ref in dependencies)
+    targets['t00000']['type'] = 'executable'
+    graph = gyn.input.DependencyGraph(dependencies)
+    self.assertEqual(count - 1, len(graph.DeepDependencies('t00000')))
+    self.assertEqual(count - 1, len(graph.DeepDependenciesWithKey(
+        't00000', targets, 'type')))
+    self.assertEqual(count, len(graph.DependenciesToLinkAgainst('t00000',
+                                                                targets)))
+
+
+class TestDependencyGraph(unittest.TestCase):
+  def setUp(self):
+    rand = random.Random(7)
+    self.dependencies = {}
+    for i in range(300):
+      self.dependencies['t%03d' % i] = [
+          't%03d' % j for j in sorted(set(rand.randrange(i)
+                                          for _ in range(min(i, 3))))]
+    self.graph = gyn.input.DependencyGraph(self.dependencies)
+
+  def test_edges(self):
+    for ref, dependencies in self.dependencies.items():
+      self.assertEqual(dependencies, self.graph.DirectDependencies(ref))
+      i = self.graph.index[ref]
+      for k in range(self.graph.dependent_offsets[i],
+                     self.graph.dependent_offsets[i + 1]):
+        dependent = self.graph.refs[self.graph.dependent_indices[k]]
+        self.assertTrue(ref in self.dependencies[dependent])
+
+  def test_flatten_to_list(self):
+    flat_list = self.graph.FlattenToList()
+    self.assertEqual(sorted(self.dependencies), sorted(flat_list))
+    positions = dict((ref, i) for i, ref in enumerate(flat_list))
+    for ref, dependencies in self.dependencies.items():
+      for dependency in dependencies:
+        self.assertTrue(positions[dependency] < positions[ref])
+
+  def test_deep_dependencies(self):
+    for ref in self.dependencies:
+      self.assertEqual(list(_DeepDependencies(self.dependencies, ref,
+                                              gyn.common.OrderedSet())),
+                       self.graph.DeepDependencies(ref))
+
+  def test_cycle(self):
+    self.dependencies['t000'] = ['t299']
+    graph = gyn.input.DependencyGraph(self.dependencies)
+    self.assertTrue(len(graph.FlattenToList()) < len(graph))
+
+  def test_no_cycles(self):
+    self.assertEqual([], self.graph.FindCycles())
+    self.assertEqual(len(self.graph),
+                     len(self.graph.StronglyConnectedComponents()))
+
+  def test_find_cycles(self):
+    graph = gyn.input.DependencyGraph({
+        'a': ['b'], 'b': ['c', 'e'], 'c': ['a', 'b'], 'd': ['d', 'a'],
+        'e': [], 'f': ['g'], 'g': ['f']})
+    self.assertEqual([['a', 'b', 'c', 'a'], ['d', 'd'], ['f', 'g', 'f']],
+                     graph.FindCycles())
+    components = sorted(sorted(graph.refs[i] for i in component)
+                        for component in graph.StronglyConnectedComponents())
+    self.assertEqual([['a', 'b', 'c'], ['d'], ['e'], ['f', 'g']], components)
+
+  def test_deep_chain(self):
+    # Long enough to overflow the stack of a recursive walk.
+    count = 20000
+    dependencies = dict(('t%05d' % i, ['t%05d' % (i + 1)])
+                        for i in range(count - 1))
+    dependencies['t%05d' % (count - 1)] = ['t00000']
+    graph = gyn.input.DependencyGraph(dependencies)
+    cycles = graph.FindCycles()
+    self.assertEqual(1, len(cycles))
+    self.assertEqual(count + 1, len(cycles[0]))
+
+
+class TestProcessTargetsLate(unittest.TestCase):
+  def setUp(self):
+    self.old_non_configuration_keys = gyn.input.non_configuration_keys
+    gyn.input.non_configuration_keys = gyn.input.base_non_configuration_keys
+
+  def tearDown(self):
+    gyn.input.non_configuration_keys = self.old_non_configuration_keys
+
+  def _target(self, name, **kwargs):
+    target_dict = {'target_name': name, 'type': 'none', 'toolset': 'target',
+                   'configurations': {'Default': {}},
+                   'default_configuration': 'Default'}
+    target_dict.update(kwargs)
+    return target_dict
+
+  def test_processes_in_place(self):
+    target_dict = self._target('a', sources=['a.c', 'b.c'],
+                               **{'sources!': ['b.c']})
+    processed, error, timings = gyn.input.ProcessTargetsLate(
+        [(0, 'a.gyp:a#target', target_dict)], {}, [])
+    self.assertEqual(None, error)
+    self.assertEqual([(0, target_dict)], processed)
+    self.assertEqual(['a.c'], target_dict['sources'])
+
+  def test_shares_unmodified_configuration_lists(self):
+    target_dict = self._target(
+        'a', defines=['A'], cflags=['-O2'], ldflags=['-a', '-b'],
+        configurations={'Debug': {'defines': ['D']}, 'Release': {}},
+        default_configuration='Debug', **{'ldflags!': ['-b']})
+    processed, error, timings = gyn.input.ProcessTargetsLate(
+        [(0, 'a.gyp:a#target', target_dict)], {}, [])
+    self.assertEqual(None, error)
+    debug = target_dict['configurations']['Debug']
+    release = target_dict['configurations']['Release']
+    self.assertFalse('cflags' in target_dict)
+    self.assertTrue(debug['cflags'] is release['cflags'])
+    self.assertEqual(['A', 'D'], debug['defines'])
+    self.assertEqual(['A'], release['defines'])
+    self.assertEqual(['-a'], debug['ldflags'])
+    self.assertEqual(['-a'], release['ldflags'])
+    self.assertFalse(debug['ldflags'] is release['ldflags'])
+
+  def test_reports_first_stage_to_fail(self):
+    # The bad type is only caught by the last stage, the bad filter by an
+    # earlier one, so the second target's error is the one to report.
+    bad_type = self._target('a', type='bogus')
+    bad_filter = self._target('b', sources=['a.c'],
+                              **{'sources/': [['bogus', 'a']]})
+    processed, error, timings = gyn.input.ProcessTargetsLate(
+        [(0, 'a.gyp:a#target', bad_type), (1, 'a.gyp:b#target', bad_filter)],
+        {}, [])
+    self.assertEqual([], processed)
+    self.assertEqual((2, 1), error[:2])
+
+  def test_shard_targets(self):
+    targets = [(i, 't%d' % i, b'x' * size)
+               for i, size in enumerate([2, 4, 3, 2, 4, 3])]
+    shards = gyn.input._ShardTargets(targets, 2)
+    self.assertEqual(sorted(targets), sorted(sum(shards, [])))
+    self.assertEqual([9, 9],
+                     sorted(sum(len(t[2]) for t in shard) for shard in shards))
+    for shard in shards:
+      self.assertEqual(sorted(shard), shard)
+
+
+class TestMakePathRelative(unittest.TestCase):
+  def setUp(self):
+    self.old_cache_size = gyn.input.MAKE_PATH_RELATIVE_CACHE_SIZE
+    gyn.input.cached_relative_paths.clear()
+
+  def tearDown(self):
+    gyn.input.MAKE_PATH_RELATIVE_CACHE_SIZE = self.old_cache_size
+    gyn.input.cached_relative_paths.clear()
+
+  def test_make_path_relative(self):
+    cases = [('a/b.gyp', 'c/d.gyp', 'x/y', '../c/x/y'),
+             ('a/b.gyp', 'a/c/d.gyp', '../x/', 'x/'),
+             ('a/b.gyp', 'c/d.gyp', '<(x)/y', '<(x)/y'),
+             ('c/d.gyp', 'c/d.gyp', 'x/y', 'x/y')]
+    for i in range(2):
+      for to_file, fro_file, item, expected in cases:
+        self.assertEqual(expected,
+                         gyn.input.MakePathRelative(to_file, fro_file, item))
+
+  def test_cache_is_bounded(self):
+    gyn.input.MAKE_PATH_RELATIVE_CACHE_SIZE = 10
+    for i in range(25):
+      self.assertEqual('../c/%d' % i,
+                       gyn.input.MakePathRelative('a/b.gyp', 'c/d.gyp', str(i)))
+      self.assertTrue(len(gyn.input.cached_relative_paths) <= 10)
+
+
+class TestMergeLists(unittest.TestCase):
+  def _merge(self, to, fro, append):
+    gyn.input.MergeLists(to, fro, 'a.gyp', 'a.gyp', append=append)
+    return to
+
+  def _reference_merge(self, to, fro, append):
+    # The item by item merge MergeLists used to do.
+    prepend_index = 0
+    for item in fro:
+      singleton = type(item) is int or not item.startswith('-')
+      if append:
+        if not singleton or item not in to:
+          to.append(item)
+      else:
+        while singleton and item in to:
+          to.remove(item)
+        to.insert(prepend_index, item)
+        prepend_index += 1
+    return to
+
+  def test_append(self):
+    self.assertEqual(['a', '-x', 'b', '-x', 1],
+                     self._merge(['a', '-x'], ['b', 'a', '-x', 1, 'b'], True))
+
+  def test_prepend(self):
+    self.assertEqual(['c', 'a', '-x', '-x', 'b', [1]],
+                     self._merge(['a', '-x', 'b', 'c', [1]],
+                                 ['c', 'a', '-x'], False))
+
+  def test_prepend_repeated_singleton(self):
+    self.assertEqual(['x', 'a', 'b'], self._merge(['x'], ['a', 'a', 'b'], False))
+
+  def test_matches_reference(self):
+    rand = random.Random(3)
+    values = ['a', 'b', 'c', 'd', '-x', '-y', 1, 2]
+    for i in range(500):
+      to = [rand.choice(values) for j in range(rand.randint(0, 8))]
+      fro = [rand.choice(values) for j in range(rand.randint(0, 8))]
+      for append in (True, False):
+        self.assertEqual(self._reference_merge(to[:], fro, append),
+                         self._merge(to[:], fro, append), (to, fro, append))
+
+
+class TestProcessListFiltersInDict(unittest.TestCase):
+  def test_exclusions(self):
+    sources = ['a.c', 'b.c', ['x'], 'c.c', 'b.c']
+    the_dict = {'sources': sources, 'sources!': ['b.c', ['x'], 'd.c']}
+    gyn.input.ProcessListFiltersInDict('t', the_dict)
+    self.assertEqual({'sources': ['a.c', 'c.c'],
+                      'sources_excluded': ['b.c', ['x'], 'b.c']}, the_dict)
+    self.assertTrue(the_dict['sources'] is sources)
+
+  def test_regex_filters(self):
+    the_dict = {
+        'sources': ['a_win.cc', 'a_mac.cc', 'a_linux.cc', 'a.cc', 'a.mm'],
+        'sources/': [['exclude', '_win\\.cc$'],
+                     ['exclude', '_(mac|linux)\\.cc$'],
+                     ['include', '_mac\\.cc$'],
+                     ['include', '^a\\.cc$'],
+                     ['exclude', '\\.mm$']],
+        'sources!': ['a.cc']}
+    gyn.input.ProcessListFiltersInDict('t', the_dict)
+    self.assertEqual({'sources': ['a_mac.cc', 'a.cc'],
+                      'sources_excluded': ['a_win.cc', 'a_linux.cc', 'a.mm']},
+                     the_dict)
+
+  def test_uncombinable_filters(self):
+    the_dict = {'sources': ['aa.c', 'ab.c', 'B.c'],
+                'sources/': [['exclude', '(a)\\1'],
+                             ['exclude', '(?i)^b']]}
+    gyn.input.ProcessListFiltersInDict('t', the_dict)
+    self.assertEqual({'sources': ['ab.c'],
+                      'sources_excluded': ['aa.c', 'B.c']}, the_dict)
+
+  def test_filter_suffixes(self):
+    self.assertEqual(['_win.cc'], gyn.input._FilterSuffixes('_win\\.cc$'))
+    self.assertEqual(['_linux.cc', '_mac.cc'],
+                     gyn.input._FilterSuffixes('_(linux|mac)\\.cc$'))
+    self.assertEqual(['.mm', '.m'], gyn.input._FilterSuffixes('\\.(?:mm|m)$'))
+    for pattern in ['_win\\.cc', '.cc$', '_win\\$', '\\d\\.cc$',
+                    '(a|b)?\\.cc$', '(a|b)(c|d)$', '^a\\.cc$', '[ab]$']:
+      self.assertEqual(None, gyn.input._FilterSuffixes(pattern), pattern)
+
+  def test_suffix_filters_match_like_regexes(self):
+    items = ['a_mac.cc', 'a_mac.cc\n', 'a_mac.ccx', 'a_mac.cc\n\n',
+             'a.mm', 'a.m', 'a_win.cc', '']
+    for patterns in [('_(linux|mac)\\.cc$',), ('\\.mm$', '\\.(m|h)$'),
+                     ('$',)]:
+      patterns, list_filter = gyn.input._CompileListFilter(patterns)
+      self.assertTrue(isinstance(list_filter, gyn.input.SuffixListFilter))
+      pattern_re = re.compile('|'.join(patterns))
+      for item in items:
+        self.assertEqual(bool(pattern_re.search(item)),
+                         bool(list_filter.search(item)), (patterns, item))
+
+  def test_bad_action(self):
+    the_dict = {'sources': ['a.c'], 'sources/': [['exclude', 'a'],
+                                                 ['bogus', 'b']]}
+    self.assertRaises(ValueError, gyn.input.ProcessListFiltersInDict, 't',
+                      the_dict)
+
+
+class TestGetJobs(unittest.TestCase):
+  def setUp(self):
+    self.old_jobs = os.environ.pop('GYP_JOBS', None)
+
+  def tearDown(self):
+    os.environ.pop('GYP_JOBS', None)
+    if self.old_jobs is not None:
+      os.environ['GYP_JOBS'] = self.old_jobs
+
+  def test_jobs(self):
+    self.assertEqual(3, gyn.input.GetJobs(3))
+    os.environ['GYP_JOBS'] = '2'
+    self.assertEqual(2, gyn.input.GetJobs())
+    self.assertEqual(3, gyn.input.GetJobs(3))
+
+  def test_invalid_jobs(self):
+    self.assertRaises(gyn.common.GypError, gyn.input.GetJobs, 0)
+    self.assertRaises(gyn.common.GypError, gyn.input.GetJobs, -2)
+    for value in ('abc', '0', '-2'):
+      os.environ['GYP_JOBS'] = value
+      self.assertRaises(gyn.common.GypError, gyn.input.GetJobs)
+
+
+class TestBuildFileCache(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.build_file = os.path.join(self.tmpdir, 'test.gyp')
+    self.old_cache_dir = gyn.input.build_file_cache_dir
+    gyn.input.build_file_cache_dir = os.path.join(self.tmpdir, 'cache')
+
+  def tearDown(self):
+    gyn.input.build_file_cache_dir = self.old_cache_dir
+    shutil.rmtree(self.tmpdir)
+
+  def _write_build_file(self, contents, mtime):
+    with open(self.build_file, 'w') as f:
+      f.write(contents)
+    # Whole seconds, which os.utime() sets exactly on every Python version.
+    mtime = int(mtime)
+    os.utime(self.build_file, (mtime, mtime))
+
+  def test_reuses_entry(self):
+    self._write_build_file("{'targets': []}", time.time() - 60)
+    self.assertEqual({'targets': []},
+                     gyn.input.ParseBuildFile(self.build_file, False))
+    # Make the file unreadable as a build file without touching its stat
+    # information; the cached result must be used.
+    st = os.stat(self.build_file)
+    self._write_build_file("{'targets':[1]}", st.st_mtime)
+    self.assertEqual({'targets': []},
+                     gyn.input.ParseBuildFile(self.build_file, False))
+
+  def test_invalidates_on_change(self):
+    self._write_build_file("{'targets': []}", time.time() - 60)
+    gyn.input.ParseBuildFile(self.build_file, False)
+    self._write_build_file("{'targets': [1]}", time.time() - 30)
+    self.assertEqual({'targets': [1]},
+                     gyn.input.ParseBuildFile(self.build_file, False))
+
+  def test_returns_fresh_dicts(self):
+    self._write_build_file("{'targets': []}", time.time() - 60)
+    first = gyn.input.ParseBuildFile(self.build_file, False)
+    first['targets'].append('mutated')
+    self.assertEqual({'targets': []},
+                     gyn.input.ParseBuildFile(self.build_file, False))
+
+
+class TestCommandCache(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.build_file = os.path.join(self.tmpdir, 'test.gyp')
+    self.old_cache_path = gyn.input.command_cache_path
+    gyn.input.command_cache_path = os.path.join(self.tmpdir, 'commands')
+    gyn.input.persistent_command_results = {}
+    gyn.input.cached_command_results.clear()
+    # A script whose output depends on a file it doesn't name.
+    self._write('gen.sh', 'cat data.txt\n')
+
+  def tearDown(self):
+    gyn.input.command_cache_path = self.old_cache_path
+    gyn.input.persistent_command_results = {}
+    gyn.input.cached_command_results.clear()
+    gyn.input.TakeCommandStats()
+    shutil.rmtree(self.tmpdir)
+
+  def _write(self, name, contents):
+    with open(os.path.join(self.tmpdir, name), 'w') as f:
+      f.write(contents)
+
+  def _expand(self, variables):
+    # Each expansion stands for a new run, which only has the persistent
+    # cache.
+    gyn.input.cached_command_results.clear()
+    return gyn.input.ExpandVariables('<!(sh gen.sh)', gyn.input.PHASE_EARLY,
+                                     variables, self.build_file)
+
+  def test_declared_inputs(self):
+    variables = {'command_cache_inputs': ['data.txt']}
+    self._write('data.txt', 'a')
+    self.assertEqual('a', self._expand(variables))
+    self._write('data.txt', 'bb')
+    self.assertEqual('bb', self._expand(variables))
+    self.assertEqual('bb', self._expand(variables))
+    self.assertEqual(1, gyn.input.TakeCommandStats()[1])
+
+  def test_undeclared_inputs(self):
+    self._write('data.txt', 'a')
+    self.assertEqual('a', self._expand({}))
+    self._write('data.txt', 'bb')
+    self.assertEqual('a', self._expand({}))
+
+  def test_declaration_changes(self):
+    self._write('data.txt', 'a')
+    self.assertEqual('a', self._expand({}))
+    self._write('data.txt', 'bb')
+    self.assertEqual('bb', self._expand({'command_cache_inputs': 'data.txt'}))
+
+  def test_without_build_file_cache(self):
+    with open(os.path.join(self.tmpdir, 'test.gyp'), 'w') as f:
+      f.write(repr({'variables': {'v': '<!(echo v)'},
+                    'targets': [{'target_name': 'a', 'type': 'none'}]}))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(gyn.__file__)))] +
+        os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+    subprocess.check_call([sys.executable, '-m', 'gyn', '--depth=.',
+                           '--cache-commands', 'test.gyp'],
+                          cwd=self.tmpdir, env=env)
+    cache_dir = os.path.join(self.tmpdir, 'out', 'gypfiles',
+                             'build_file_cache')
+    self.assertEqual(['commands'], os.listdir(cache_dir))
+
+
+class TestPymodDoMain(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = os.path.realpath(tempfile.mkdtemp())
+    self.old_path = sys.path[:]
+    sys.path.insert(0, '')
+
+  def tearDown(self):
+    sys.path[:] = self.old_path
+    for name in ('pymod_cwd', 'pymod_chdir'):
+      gyn.input.pymod_do_main_modules.pop(name, None)
+      sys.modules.pop(name, None)
+    shutil.rmtree(self.tmpdir)
+
+  def _write_module(self, name, contents):
+    with open(os.path.join(self.tmpdir, name + '.py'), 'w') as f:
+      f.write(contents)
+
+  def _run(self, contents):
+    return gyn.input.RunCommand(contents, 'pymod_do_main', False, self.tmpdir)
+
+  def test_passes_cwd(self):
+    self._write_module('pymod_cwd', 'import os\n'
+                       'def DoMain(argv, cwd=None):\n'
+                       '  return "%s %s %s" % (argv[0], cwd, os.getcwd())\n')
+    oldwd = os.getcwd()
+    self.assertEqual('x %s %s' % (self.tmpdir, oldwd),
+                     self._run('pymod_cwd x'))
+    self.assertTrue(gyn.input.pymod_do_main_modules['pymod_cwd'][1])
+
+  def test_changes_directory(self):
+    self._write_module('pymod_chdir', 'import os\n'
+                       'def DoMain(argv):\n'
+                       '  return os.getcwd()\n')
+    oldwd = os.getcwd()
+    self.assertEqual(self.tmpdir, self._run('pymod_chdir'))
+    self.assertEqual(oldwd, os.getcwd())
+
+
+class TestPrefetchCommands(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.build_file = os.path.join(self.tmpdir, 'test.gyp')
+    self.counter = os.path.join(self.tmpdir, 'counter')
+    gyn.input.cached_command_results.clear()
+    gyn.input.prefetched_command_results.clear()
+
+  def tearDown(self):
+    gyn.input.cached_command_results.clear()
+    gyn.input.prefetched_command_results.clear()
+    shutil.rmtree(self.tmpdir)
+
+  def test_failures_run_once(self):
+    failing = '<!(echo x >> counter; exit 1)'
+    data = {'variables': {'ok': '<!(echo ok)', 'failing': failing,
+                          'unbalanced': '<!(echo (a)'}}
+    gyn.input.PrefetchCommands(data, self.build_file)
+    self.assertEqual('ok', gyn.input.ExpandVariables(
+        '<!(echo ok)', gyn.input.PHASE_EARLY, {}, self.build_file))
+    self.assertRaises(gyn.common.GypError, gyn.input.ExpandVariables,
+                      failing, gyn.input.PHASE_EARLY, {}, self.build_file)
+    with open(self.counter) as f:
+      self.assertEqual('x\n', f.read())
+
+  def test_nocache_is_not_prefetched(self):
+    data = {'variables': {'a': '<!(echo a)', 'b': '<!(echo b)',
+                          'c': '<!nocache(echo c >> counter)'}}
+    self.assertEqual(2, len(gyn.input.PrefetchCommands(data,
+                                                       self.build_file)))
+    self.assertFalse(os.path.exists(self.counter))
+
+  def test_unreached_results_are_dropped(self):
+    with open(self.build_file, 'w') as f:
+      # The first target fails to expand before the commands are reached.
+      f.write(repr({'targets': [{'target_name': '<(undefined)'},
+                                {'target_name': 'b',
+                                 'sources': ['<!(echo a)', '<!(echo b)']}]}))
+    self.assertRaises(gyn.common.GypError, gyn.input.LoadTargetBuildFile,
+                      self.build_file, {}, {}, {}, [], self.tmpdir, False,
+                      False)
+    self.assertEqual({}, gyn.input.prefetched_command_results)
+
+
+class TestEvalSingleCondition(unittest.TestCase):
+  def _eval(self, cond_expr, variables):
+    return gyn.input.EvalSingleCondition(cond_expr, 'true', 'false',
+                                         gyn.input.PHASE_EARLY, variables,
+                                         'build.gyp')
+
+  def test_matches_python_semantics(self):
+    variables = {'OS': 'linux', 'bits': 64, 'name': 'x'}
+    for cond_expr in ('OS=="linux"', 'OS == "win"', "OS!='win'",
+                      'bits==64', 'bits != 64', 'bits==-1', 'name=="x"',
+                      'OS=="linux" and bits==64', 'bits>32'):
+      expected = 'true' if eval(cond_expr, {}, variables) else 'false'
+      # Evaluate twice to go through both the compiling and cached paths.
+      for _ in range(2):
+        self.assertEqual(expected, self._eval(cond_expr, variables),
+                         cond_expr)
+
+  def test_undefined_variable(self):
+    self.assertRaises(gyn.common.GypError, self._eval, 'undefined=="x"', {})
+
+  def test_expanded_condition(self):
+    self.assertEqual('true', self._eval('"<(OS)"=="linux"', {'OS': 'linux'}))
+    self.assertEqual('false', self._eval('"<(OS)"=="linux"', {'OS': 'win'}))
+
+
+class TestConditionCache(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.old_cache_dir = gyn.input.build_file_cache_dir
+    gyn.input.build_file_cache_dir = self.tmpdir
+    self._new_run()
+
+  def tearDown(self):
+    gyn.input.build_file_cache_dir = self.old_cache_dir
+    self._new_run()
+    shutil.rmtree(self.tmpdir)
+
+  def _new_run(self):
+    for name in ('cached_conditions', 'compiled_conditions'):
+      getattr(gyn.input, name).clear()
+    gyn.input.loaded_conditions.clear()
+    gyn.input.TakeConditionCacheStats()
+
+  def _run(self, cond_exprs):
+    """Evaluates cond_exprs in a new run, and returns the conditions that were
+    loaded from the on-disk cache."""
+    self._new_run()
+    gyn.input.LoadConditionCache()
+    loaded = set(gyn.input.compiled_conditions)
+    for cond_expr in cond_exprs:
+      gyn.input.EvalSingleCondition(cond_expr, 'true', 'false',
+                                    gyn.input.PHASE_EARLY, {'a': 1, 'b': 2},
+                                    'build.gyp')
+    gyn.input.SaveConditionCache()
+    return loaded
+
+  def test_keeps_used_conditions_only(self):
+    self.assertEqual(set(), self._run(['a==1', 'b==2']))
+    self.assertEqual(set(['a==1', 'b==2']), self._run(['a==1']))
+    self.assertEqual(set(['a==1']), self._run(['a==1']))
+
+
+class TestExpandVariables(unittest.TestCase):
+  def _expand(self, input, variables, phase=gyn.input.PHASE_EARLY):
+    return gyn.input.ExpandVariables(input, phase, variables, 'build.gyp')
+
+  def test_string_context(self):
+    variables = {'a': 'x', 'b': 'y', 'list': ['p q', 'r']}
+    self.assertEqual('x', self._expand('<(a)', variables))
+    self.assertEqual('-x/y.cc', self._expand('-<(a)/<(b).cc', variables))
+    self.assertEqual('<x', self._expand('<<(a)', variables))
+    self.assertEqual('--l "p q" r', self._expand('--l <@(list)', variables))
+    self.assertEqual('>(a)x', self._expand('>(a)<(a)', variables))
+
+  def test_list_context(self):
+    variables = {'list': ['a', '<(b)', 5], 'b': 'c', 'flags': '-x "y z"'}
+    self.assertEqual(['a', 'c', 5], self._expand('<@(list)', variables))
+    self.assertEqual(['-x', 'y z'], self._expand('<@(flags)', variables))
+
+  def test_nested_and_recursive(self):
+    variables = {'name': 'a', 'a': 'value', 'ref': '<(a)!'}
+    self.assertEqual('value', self._expand('<(<(name))', variables))
+    self.assertEqual('value!', self._expand('<(ref)', variables))
+    self.assertEqual(3, self._expand('<(n)', {'n': '3'}))
+
+  def test_phases(self):
+    variables = {'a': 'x'}
+    self.assertEqual('<(a)x', self._expand('<(a)>(a)', variables,
+                                           gyn.input.PHASE_LATE))
+    self.assertEqual('x', self._expand('^(a)', variables,
+                                       gyn.input.PHASE_LATELATE))
+
+  def test_undefined(self):
+    self.assertRaises(gyn.common.GypError, self._expand, '<(a)', {})
+    self.assertEqual('', self._expand('<(_sources!)', {}))
+
+  def test_unbalanced_brackets(self):
+    # References whose brackets don't close are errors, rather than being
+    # replaced by whatever text the bracket search ended up with.
+    self.assertRaises(gyn.common.GypError, self._expand, '<(<(a)', {'a': 'x'})
+    self.assertRaises(gyn.common.GypError, self._expand, '<!(echo (a)', {})
+    # Text that isn't a reference is left alone.
+    self.assertEqual('-I<(a', self._expand('-I<(a', {'a': 'x'}))
+    self.assertEqual('x)', self._expand('<(a))', {'a': 'x'}))
+
+  def test_parse_cache_is_bounded(self):
+    old_size = gyn.input.EXPANSION_PARSE_CACHE_SIZE
+    gyn.input.EXPANSION_PARSE_CACHE_SIZE = 4
+    try:
+      for i in range(10):
+        self.assertEqual('x%d' % i, self._expand('<(a)%d' % i, {'a': 'x'}))
+        self.assertTrue(len(gyn.input.cached_expansion_parses) <= 4)
+    finally:
+      gyn.input.EXPANSION_PARSE_CACHE_SIZE = old_size
 
 
 if __name__ == '__main__':